@@ -0,0 +1,272 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from benchmarks import synthetic
+from buildings_manager import BuildingsManager
+from connectivity_manager import ConnectivityManager
+from elevation_manager import ElevationManager
+from image_manager import ImageManager
+from instrumentation import metrics
+from stub_services import StubWCSServer, StubWMSServer
+
+# Offline benchmark suite: generates a synthetic corpus, runs every manager against it (and the WCS/WMS
+# stand-ins from stub_services) and writes one JSON document per run.
+#
+#     python -m benchmarks.run_benchmarks --scale small --output bench.json
+
+SCALES = {
+    "small": {"sessions": 8, "rows_per_session": 2000, "towers": 40, "buildings": 5000, "dem_tiles": 2,
+              "dem_px": 500, "queries": 200, "kriging_queries": 20, "batch": 5000, "route_points": 200, "images": 10},
+    "medium": {"sessions": 40, "rows_per_session": 10000, "towers": 200, "buildings": 50000, "dem_tiles": 4,
+               "dem_px": 1000, "queries": 500, "kriging_queries": 50, "batch": 50000, "route_points": 1000, "images": 25},
+    "large": {"sessions": 200, "rows_per_session": 20000, "towers": 1000, "buildings": 200000, "dem_tiles": 8,
+              "dem_px": 2000, "queries": 1000, "kriging_queries": 100, "batch": 200000, "route_points": 5000, "images": 50},
+}
+
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    # The managers report progress with print; keep it out of the benchmark output
+    if not enabled:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def latency_stats(samples_s):
+    samples_ms = np.asarray(samples_s) * 1000
+    return {
+        "n": len(samples_ms),
+        "mean_ms": float(samples_ms.mean()),
+        "p50_ms": float(np.percentile(samples_ms, 50)),
+        "p90_ms": float(np.percentile(samples_ms, 90)),
+        "p99_ms": float(np.percentile(samples_ms, 99)),
+        "max_ms": float(samples_ms.max())
+    }
+
+
+def measure_latency(fn, points):
+    samples = []
+    for lat, lon in zip(*points):
+        start = time.perf_counter()
+        fn(lat, lon)
+        samples.append(time.perf_counter() - start)
+    return latency_stats(samples)
+
+
+def throughput(fn, lats, lons):
+    elapsed, _ = timed(fn, lats, lons)
+    return {"points": len(lats), "seconds": elapsed, "points_per_s": len(lats) / elapsed if elapsed > 0 else None}
+
+
+def bench_connectivity(work_dir, scale, seed):
+    towers = synthetic.make_towers(scale["towers"], seed=seed)
+    tower_file = synthetic.write_towers(os.path.join(work_dir, "towers", "towers.clf"), towers)
+    generated, dataset_dirs = timed(
+        synthetic.write_drive_tests, os.path.join(work_dir, "connectivity"), towers, scale["sessions"],
+        scale["rows_per_session"], seed=seed
+    )
+    cache_dir = os.path.join(work_dir, "connectivity", "cache")
+
+    def start():
+        return ConnectivityManager(dataset_dirs=dataset_dirs, tower_files=[tower_file], cache_dir=cache_dir).load()
+
+    cold_s, manager = timed(start)
+    warm_s, manager = timed(start)
+
+    # Query where the data is: random observation positions. Single live-kriging queries cost a full
+    # solve each, so there are fewer of them than for the other managers.
+    n_queries = scale["kriging_queries"]
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(manager.store.data), n_queries + scale["batch"])
+    lats, lons = np.asarray(manager.store.data["lat"][rows]), np.asarray(manager.store.data["lon"][rows])
+    queries = (lats[:n_queries], lons[:n_queries])
+    batch = (lats[n_queries:], lons[n_queries:])
+
+    first_s, _ = timed(manager.get_covering_towers_batch, *batch)  # fits the kriging models
+    return {
+        "corpus": {"observations": len(manager.store.data), "towers": len(manager.towers),
+                   "generate_s": generated},
+        "cold_start_s": cold_s,
+        "warm_start_s": warm_s,
+        "first_batch_s": first_s,
+        "query_latency": measure_latency(lambda lat, lon: manager.get_covering_towers_batch([lat], [lon]), queries),
+        "batch_throughput": throughput(manager.get_covering_towers_batch, *batch)
+    }
+
+
+def bench_buildings(work_dir, scale, seed):
+    tiles_dir = os.path.join(work_dir, "buildings")
+    generated, bounds = timed(synthetic.write_building_tiles, tiles_dir, scale["buildings"], seed=seed)
+    queries = synthetic.random_points(bounds, scale["queries"], seed)
+    batch = synthetic.random_points(bounds, scale["batch"], seed + 1)
+
+    def start_and_query():
+        # Tiles load lazily, so startup only completes with the first query
+        manager = BuildingsManager(tiles_dir=tiles_dir)
+        manager.get_height_buildings(queries[0][:1], queries[1][:1])
+        return manager
+
+    cold_s, manager = timed(start_and_query)  # GeoJSON -> GeoParquet conversion
+    warm_s, manager = timed(start_and_query)
+    return {
+        "corpus": {"buildings": scale["buildings"], "generate_s": generated},
+        "cold_start_s": cold_s,
+        "warm_start_s": warm_s,
+        "query_latency": measure_latency(manager.get_height_building, queries),
+        "batch_throughput": throughput(manager.get_height_buildings, *batch)
+    }
+
+
+def bench_elevation(work_dir, scale, seed):
+    elevation_dir = os.path.join(work_dir, "elevation")
+    generated, bounds = timed(synthetic.write_dem_tiles, elevation_dir, scale["dem_tiles"], scale["dem_px"])
+    queries = synthetic.random_points(bounds, scale["queries"], seed)
+    batch = synthetic.random_points(bounds, scale["batch"], seed + 1)
+
+    def start_and_query():
+        manager = ElevationManager(elevation_dir=elevation_dir, wcs_cache_dir=os.path.join(work_dir, "wcs_cache"))
+        manager.get_elevations(queries[0][:1], queries[1][:1])
+        return manager
+
+    cold_s, manager = timed(start_and_query)  # raster catalog built
+    warm_s, manager = timed(start_and_query)
+    results = {
+        "corpus": {"tiles": scale["dem_tiles"] ** 2, "tile_px": scale["dem_px"], "generate_s": generated},
+        "cold_start_s": cold_s,
+        "warm_start_s": warm_s,
+        "query_latency": measure_latency(manager.get_elevation_tiff, queries),
+        "batch_throughput": throughput(manager.get_elevations, *batch)
+    }
+
+    # WCS route lookups against the local stand-in: empty cache, in-memory tiles, then tiles on disk
+    route = synthetic.random_points(bounds, scale["route_points"], seed + 2)
+    with StubWCSServer() as server:
+        def wcs_manager():
+            return ElevationManager(service_url=server.url, wcs_cache_dir=os.path.join(work_dir, "wcs_cache"))
+
+        manager = wcs_manager()
+        cold_s, _ = timed(manager.get_elevations_wcs, *route)
+        warm_s, _ = timed(manager.get_elevations_wcs, *route)
+        disk_s, _ = timed(wcs_manager().get_elevations_wcs, *route)
+        results["wcs_route"] = {"points": len(route[0]), "cold_s": cold_s, "warm_memory_s": warm_s,
+                                "warm_disk_s": disk_s, "requests": len(server.requests)}
+    return results
+
+
+def bench_images(work_dir, scale, seed):
+    lats, lons = synthetic.random_points(
+        (synthetic.CENTER[1] - 0.01, synthetic.CENTER[0] - 0.01, synthetic.CENTER[1] + 0.01, synthetic.CENTER[0] + 0.01),
+        scale["images"], seed
+    )
+    with StubWMSServer() as server:
+        def image_manager():
+            return ImageManager(wms_url=server.url, cache_dir=os.path.join(work_dir, "images"))
+
+        manager = image_manager()
+        cold = measure_latency(manager.get_image_array, (lats, lons))
+        warm = measure_latency(manager.get_image_array, (lats, lons))
+        disk = measure_latency(image_manager().get_image_array, (lats, lons))
+        return {"cold_latency": cold, "warm_memory_latency": warm, "warm_disk_latency": disk,
+                "requests": len(server.requests)}
+
+
+BENCHMARKS = {
+    "connectivity": bench_connectivity,
+    "buildings": bench_buildings,
+    "elevation": bench_elevation,
+    "images": bench_images,
+}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scale_name="small", only=None, work_dir=None, seed=0, verbose=False):
+    scale = SCALES[scale_name]
+    own_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="uav-bench-")
+    report = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "scale": scale_name,
+            "parameters": scale,
+            "seed": seed
+        },
+        "results": {}
+    }
+
+    try:
+        for name, bench in BENCHMARKS.items():
+            if only and name not in only:
+                continue
+            print(f"## {name}", file=sys.stderr)
+            try:
+                with quiet(not verbose):
+                    report["results"][name] = bench(os.path.join(work_dir, name), scale, seed)
+            except Exception as e:
+                print(f"[WARN] Benchmark {name} failed: {e}", file=sys.stderr)
+                report["results"][name] = {"error": str(e)}
+    finally:
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if metrics.enabled:
+        report["instrumentation"] = metrics.snapshot()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline performance benchmarks on synthetic data")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="run a subset of the benchmarks")
+    parser.add_argument("--output", default=None, help="JSON file to write (default: stdout)")
+    parser.add_argument("--work-dir", default=None, help="keep the generated corpus and caches here")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="show the managers' own output")
+    parser.add_argument("--instrument", action="store_true", help="include per-stage timers and counters")
+    parser.add_argument("--profile-dir", default=None, help="also capture a cProfile per stage into this directory")
+    args = parser.parse_args()
+    if args.instrument or args.profile_dir:
+        metrics.enable(profile_dir=args.profile_dir)
+
+    report = run(args.scale, args.only, args.work_dir, args.seed, args.verbose)
+    metrics.dump_profiles()
+    document = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(document + "\n")
+        print(f"Results written to {args.output}", file=sys.stderr)
+    else:
+        print(document)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import json
+import math
+import os
+from datetime import datetime, timedelta
+
+import mercantile
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from scipy.spatial import cKDTree
+
+from buildings_manager import TILE_ZOOM
+from kriging_models import METERS_PER_DEGREE
+from stub_services import synthetic_elevation
+
+# Synthetic inputs in the formats the managers read, all centred on a point inside the buildings AOI.
+# Every generator is deterministic for a given seed.
+
+CENTER = (43.05, 12.45)  # lat, lon
+
+NEW_HEADER = ["mcc", "mnc", "lac", "cell_id", "lat", "lon", "accuracy", "altitude", "measured_at", "net_type",
+              "rsrp", "rsrq", "rssi"]
+BANDS = [1, 3, 7, 20]
+
+
+def make_towers(n_towers, span_deg=0.2, seed=0, center=CENTER):
+    # (cell_id, lat, lon, band) rows scattered over a span_deg square
+    rng = np.random.default_rng(seed)
+    lats = center[0] + rng.uniform(-span_deg / 2, span_deg / 2, n_towers)
+    lons = center[1] + rng.uniform(-span_deg / 2, span_deg / 2, n_towers)
+    cell_ids = 204800000 + rng.choice(1000000, n_towers, replace=False)
+    bands = rng.choice(BANDS, n_towers)
+    return [(int(cell_id), float(lat), float(lon), int(band)) for cell_id, lat, lon, band in zip(cell_ids, lats, lons, bands)]
+
+
+def write_towers(path, towers):
+    # OpenCellID-style .clf: mcc-mnc;cell_id;lac;?;lat;lon;?;band and radio type
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'w') as f:
+        for cell_id, lat, lon, band in towers:
+            f.write(f"222-1;{cell_id};20101;0;{lat:.6f};{lon:.6f};0;B{band} LTE\n")
+    return path
+
+
+def _session_track(rng, n_rows, span_deg, center):
+    # Vehicle-like walk: slowly turning heading, about 10 m per fix, reflected at the span edges
+    heading = rng.uniform(0, 2 * np.pi) + np.cumsum(rng.normal(0, 0.05, n_rows))
+    steps = 10.0 / METERS_PER_DEGREE * np.column_stack((np.sin(heading), np.cos(heading)))
+    start = np.array(center) + rng.uniform(-span_deg / 3, span_deg / 3, 2)
+    offset = start + np.cumsum(steps, axis=0) - (np.array(center) - span_deg / 2)
+    # Fold the walk back into the [0, span) square
+    offset = np.abs((offset + span_deg) % (2 * span_deg) - span_deg)
+    return np.array(center) - span_deg / 2 + offset
+
+
+def _serving(track, towers):
+    # Nearest tower serves, signal falling off with log-distance plus shadowing
+    scale = np.array([1.0, math.cos(math.radians(CENTER[0]))]) * METERS_PER_DEGREE
+    tree = cKDTree(np.array([(lat, lon) for _, lat, lon, _ in towers]) * scale)
+    distance, nearest = tree.query(track * scale)
+    return nearest, np.maximum(distance, 10.0)
+
+
+def write_drive_tests(root_dir, towers, n_sessions, rows_per_session, legacy_fraction=0.3, span_deg=0.2, seed=0,
+                      center=CENTER):
+    # Sessions in both formats: current CSVs under dataset/, legacy headerless ones under dataset-old/car/.
+    # Returns the dataset directories to hand to ConnectivityManager.
+    rng = np.random.default_rng(seed)
+    new_dir = os.path.join(root_dir, "dataset")
+    legacy_dir = os.path.join(root_dir, "dataset-old", "car")
+    os.makedirs(new_dir, exist_ok=True)
+    os.makedirs(legacy_dir, exist_ok=True)
+    start = datetime(2025, 1, 1, 8, 0, 0)
+
+    for session in range(n_sessions):
+        track = _session_track(rng, rows_per_session, span_deg, center)
+        nearest, distance = _serving(track, towers)
+        signal = np.round(-45 - 35 * np.log10(distance) + rng.normal(0, 4, len(track))).astype(int)
+        altitude = 300 + 50 * np.sin(track[:, 0] * 100)
+        when = start + timedelta(hours=6 * session)
+
+        if rng.random() < legacy_fraction:
+            path = os.path.join(legacy_dir, f"signal-{when:%Y-%m-%d-%H-%M}.csv")
+            with open(path, 'w') as f:
+                for (lat, lon), alt, i, rsrp in zip(track, altitude, nearest, signal):
+                    f.write(f"{lat:.8f},{lon:.8f},{int(alt)},222,1,20101,{towers[i][0]},{rsrp},LTE,LTE,6300,36\n")
+        else:
+            path = os.path.join(new_dir, f"{when:%Y-%m-%d-%H-%M-%S}.csv")
+            with open(path, 'w') as f:
+                f.write(",".join(NEW_HEADER) + "\n")
+                for row, ((lat, lon), alt, i, rsrp) in enumerate(zip(track, altitude, nearest, signal)):
+                    stamp = (when + timedelta(seconds=row)).isoformat(timespec='milliseconds') + "Z"
+                    f.write(f"222,1,20101,{towers[i][0]},{lat:.8f},{lon:.8f},10.0,{alt:.2f},\"{stamp}\",LTE,"
+                            f"{rsrp},-10,{rsrp + 30}\n")
+
+    return [new_dir, os.path.join(root_dir, "dataset-old", "car")]
+
+
+def write_building_tiles(tiles_dir, n_buildings, spacing_m=25.0, seed=0, center=CENTER):
+    # A square grid of n_buildings rectangular footprints around the centre, written as the Microsoft
+    # GlobalML GeoJSON the BuildingsManager converts (nested "properties" with height and confidence),
+    # one file per zoom-9 quadkey. Returns the (min_lon, min_lat, max_lon, max_lat) of the grid.
+    rng = np.random.default_rng(seed)
+    side = math.ceil(math.sqrt(n_buildings))
+    step_lat = spacing_m / METERS_PER_DEGREE
+    step_lon = step_lat / math.cos(math.radians(center[0]))
+    rows, cols = np.divmod(np.arange(n_buildings), side)
+    lats = center[0] + (rows - side / 2) * step_lat
+    lons = center[1] + (cols - side / 2) * step_lon
+    half_lat = rng.uniform(0.2, 0.4, n_buildings) * step_lat
+    half_lon = rng.uniform(0.2, 0.4, n_buildings) * step_lon
+    heights = rng.gamma(2.0, 4.0, n_buildings)
+
+    tiles = {}
+    for lat, lon, dlat, dlon, height in zip(lats, lons, half_lat, half_lon, heights):
+        ring = [[lon - dlon, lat - dlat], [lon + dlon, lat - dlat], [lon + dlon, lat + dlat], [lon - dlon, lat + dlat],
+                [lon - dlon, lat - dlat]]
+        feature = {
+            "type": "Feature",
+            "properties": {"type": "Feature", "properties": {"height": float(height), "confidence": 0.9}},
+            "geometry": {"type": "Polygon", "coordinates": [ring]}
+        }
+        quad_key = mercantile.quadkey(mercantile.tile(lon, lat, TILE_ZOOM))
+        tiles.setdefault(quad_key, []).append(feature)
+
+    os.makedirs(tiles_dir, exist_ok=True)
+    for quad_key, features in tiles.items():
+        with open(os.path.join(tiles_dir, f"{quad_key}.geojson"), 'w') as f:
+            json.dump({"type": "FeatureCollection", "features": features}, f)
+
+    return (float((lons - half_lon).min()), float((lats - half_lat).min()),
+            float((lons + half_lon).max()), float((lats + half_lat).max()))
+
+
+def write_dem_tiles(elevation_dir, tiles_per_side, tile_px, resolution_deg=0.0001, center=CENTER):
+    # tiles_per_side**2 float32 GeoTIFFs (EPSG:4326) of synthetic terrain tiling a square around the centre.
+    # Returns the (min_lon, min_lat, max_lon, max_lat) covered.
+    os.makedirs(elevation_dir, exist_ok=True)
+    extent = tile_px * resolution_deg
+    west = center[1] - tiles_per_side * extent / 2
+    north = center[0] + tiles_per_side * extent / 2
+    offsets = (np.arange(tile_px) + 0.5) * resolution_deg
+
+    for ty in range(tiles_per_side):
+        for tx in range(tiles_per_side):
+            tile_west, tile_north = west + tx * extent, north - ty * extent
+            lons, lats = np.meshgrid(tile_west + offsets, tile_north - offsets)
+            with rasterio.open(
+                    os.path.join(elevation_dir, f"dem_{ty}_{tx}.tif"), 'w', driver="GTiff", width=tile_px,
+                    height=tile_px, count=1, dtype="float32", crs="EPSG:4326", nodata=-9999,
+                    transform=from_origin(tile_west, tile_north, resolution_deg, resolution_deg), tiled=True
+            ) as dataset:
+                dataset.write(synthetic_elevation(lons, lats), 1)
+
+    return west, north - tiles_per_side * extent, west + tiles_per_side * extent, north
+
+
+def random_points(bounds, n, seed=0):
+    # n uniform (lats, lons) inside (min_lon, min_lat, max_lon, max_lat)
+    rng = np.random.default_rng(seed)
+    min_lon, min_lat, max_lon, max_lat = bounds
+    return rng.uniform(min_lat, max_lat, n), rng.uniform(min_lon, max_lon, n)
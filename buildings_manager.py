@@ -1,14 +1,34 @@
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import requests
 from shapely import geometry, Polygon
 import mercantile
+import json
 import os
-import tempfile
-import folium
+import time
+from collections import OrderedDict
+from io import BytesIO, StringIO
+from instrumentation import count, stage, timed
+
+TILE_ZOOM = 9
+DATASET_LINKS_URL = "https://minedbuildings.z5.web.core.windows.net/global-buildings/dataset-links.csv"
+
+
+def parse_properties(properties):
+    # Older GDAL/pyogrio builds hand the nested "properties" object back as a JSON string
+    if isinstance(properties, str):
+        properties = json.loads(properties)
+    properties = properties or {}
+    return float(properties.get("height", "nan")), float(properties.get("confidence", "nan"))
 
 
 class BuildingsManager:
-    def __init__(self, tiles_dir="buildings"):
+    # edge_margin_deg: padding of the tile bounds a not yet converted tile is matched on, at least the size of
+    # the largest footprint, so buildings straddling a tile edge are found whether or not their tile is converted.
+    # failure_ttl_s: how long a failed download (of a tile or of dataset-links.csv) is not attempted again
+    def __init__(self, tiles_dir="buildings", max_cached_tiles=16, links_ttl_s=7 * 24 * 3600, edge_margin_deg=0.01,
+                 links_url=DATASET_LINKS_URL, download_timeout_s=60, failure_ttl_s=600):
         self.aoi_points = [
             (11.8367914, 43.6265258),
             (12.864006, 43.6413863),
@@ -24,114 +44,314 @@ class BuildingsManager:
         self.aoi_shape = geometry.shape(self.aoi_geom)
         self.minx, self.miny, self.maxx, self.maxy = self.aoi_shape.bounds
         self.tiles_dir = tiles_dir
-        os.makedirs(self.tiles_dir, exist_ok=True)
+        self.cache_dir = os.path.join(tiles_dir, "cache")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_cached_tiles = max_cached_tiles
+        self.links_ttl_s = links_ttl_s
+        self.edge_margin_deg = edge_margin_deg
+        self.links_url = links_url
+        self.download_timeout_s = download_timeout_s
+        self.failure_ttl_s = failure_ttl_s
         self.quad_keys = self.get_tile_aoi_intersection()
-        self.ms_csv = pd.read_csv(
-            "https://minedbuildings.z5.web.core.windows.net/global-buildings/dataset-links.csv",
-            dtype=str
-        )
-        self.downloaded_tiles = self.get_tile_buildings()
-        self.geo_buildings = self.merge_downloaded_tiles()
+        self.tile_bounds, self.tile_sources = self._load_tile_index()
+        self.tile_cache = OrderedDict()
+        self._ms_csv = None
+        self._geo_buildings = None
+        self._failed_downloads = {}  # quadkey, or the links URL -> time.monotonic() of the last failure
 
     def get_tile_aoi_intersection(self):
         quad_keys = set()
-        for tile in list(mercantile.tiles(self.minx, self.miny, self.maxx, self.maxy, zooms=9)):
+        for tile in list(mercantile.tiles(self.minx, self.miny, self.maxx, self.maxy, zooms=TILE_ZOOM)):
             quad_keys.add(mercantile.quadkey(tile))
-        return list(quad_keys)
+        return sorted(quad_keys)
+
+    @property
+    def ms_csv(self):
+        # dataset-links.csv is only needed to download missing tiles; keep a local copy for links_ttl_s
+        if self._ms_csv is None:
+            local_path = os.path.join(self.cache_dir, "dataset-links.csv")
+            fresh = os.path.exists(local_path) and time.time() - os.path.getmtime(local_path) < self.links_ttl_s
+
+            if not fresh and not self._failed_recently(self.links_url):
+                try:
+                    self._fetch_csv(self.links_url).to_csv(local_path, index=False)
+                except Exception as e:
+                    self._failed_downloads[self.links_url] = time.monotonic()
+                    if not os.path.exists(local_path):
+                        raise
+                    print(f"[WARN] Failed to refresh dataset links, using cached copy: {e}")
+            if not os.path.exists(local_path):
+                raise RuntimeError(f"Dataset links unavailable, not retrying for {self.failure_ttl_s} s")
+
+            self._ms_csv = pd.read_csv(local_path, dtype=str)
+        return self._ms_csv
+
+    def _failed_recently(self, key):
+        failed_at = self._failed_downloads.get(key)
+        return failed_at is not None and time.monotonic() - failed_at < self.failure_ttl_s
+
+    def _get(self, url):
+        response = requests.get(url, timeout=self.download_timeout_s)
+        response.raise_for_status()
+        return response
+
+    def _fetch_csv(self, url):
+        return pd.read_csv(StringIO(self._get(url).text), dtype=str)
+
+    def _tile_index_path(self):
+        return os.path.join(self.cache_dir, "index.json")
+
+    def _load_tile_index(self):
+        # quadkey -> bounds of the converted tile's buildings (None if the tile has none), and
+        # quadkey -> [mtime_ns, size] of the local GeoJSON it was converted from (None if downloaded)
+        try:
+            with open(self._tile_index_path(), 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}, {}
+        if "bounds" not in index:
+            return index, {}  # bounds-only index: tiles with a local source get converted again
+        return index["bounds"], index["sources"]
+
+    def _save_tile_index(self):
+        with open(self._tile_index_path(), 'w') as f:
+            json.dump({"bounds": self.tile_bounds, "sources": self.tile_sources}, f)
+
+    def _source_stamp(self, quad_key):
+        try:
+            stat = os.stat(os.path.join(self.tiles_dir, f"{quad_key}.geojson"))
+        except OSError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def _drop_if_stale(self, quad_key):
+        # A converted tile whose local GeoJSON appeared, changed or was replaced gets converted again
+        if quad_key in self.tile_bounds and self.tile_sources.get(quad_key) != self._source_stamp(quad_key):
+            del self.tile_bounds[quad_key]
+            self.tile_sources.pop(quad_key, None)
+            self.tile_cache.pop(quad_key, None)
+            self._geo_buildings = None
+
+    def _download_tile(self, quad_key):
+        rows = self.ms_csv[self.ms_csv["QuadKey"] == quad_key]
+        if rows.empty:
+            return None
+
+        gdfs = []
+        for _, row in rows.iterrows():
+            url = row["Url"]
+            compression = "gzip" if url.endswith(".gz") else None
+            df = pd.read_json(BytesIO(self._get(url).content), lines=True, compression=compression)
+            df["geometry"] = df["geometry"].apply(geometry.shape)
+            gdfs.append(gpd.GeoDataFrame(df, crs=4326))
+        return pd.concat(gdfs, ignore_index=True)
+
+    def _convert_tile(self, quad_key):
+        # One-off conversion of a tile (local GeoJSON or download) into typed GeoParquet
+        geojson_path = os.path.join(self.tiles_dir, f"{quad_key}.geojson")
+        source = self._source_stamp(quad_key)
+        if source is not None:
+            with stage("buildings.read_geojson"):
+                gdf = gpd.read_file(geojson_path)
+        elif self._failed_recently(quad_key):
+            count("buildings.download_skipped")
+            return None
+        else:
+            try:
+                with stage("buildings.download_tile"):
+                    gdf = self._download_tile(quad_key)
+            except Exception as e:
+                # Not recorded in the index: the download is retried once failure_ttl_s has passed
+                self._failed_downloads[quad_key] = time.monotonic()
+                print(f"[WARN] Failed to download buildings tile {quad_key}: {e}")
+                return None
+
+        if gdf is None:
+            self.tile_bounds[quad_key] = None
+            self.tile_sources[quad_key] = source
+            self._save_tile_index()
+            return None
+
+        gdf = gdf.to_crs('EPSG:4326')
+        gdf = gdf[gdf.geometry.intersects(self.aoi_shape)]
+        heights, confidences = zip(*map(parse_properties, gdf["properties"])) if len(gdf) else ((), ())
+
+        # Ids stay stable however tiles get loaded: quadkey digits followed by the building's index in the tile
+        tile = gpd.GeoDataFrame({
+            "id": int(quad_key) * 10 ** 8 + np.arange(len(gdf), dtype=np.int64),
+            "height": pd.array(heights, dtype="float64"),
+            "confidence": pd.array(confidences, dtype="float64"),
+            "geometry": gdf.geometry.values
+        }, crs='EPSG:4326')
+
+        tile.to_parquet(self._parquet_path(quad_key))
+        self.tile_bounds[quad_key] = tile.total_bounds.tolist() if len(tile) else None
+        self.tile_sources[quad_key] = source
+        self._save_tile_index()
+        return tile
+
+    def _parquet_path(self, quad_key):
+        return os.path.join(self.cache_dir, f"{quad_key}.parquet")
+
+    def load_tile(self, quad_key):
+        self._drop_if_stale(quad_key)
+        if quad_key in self.tile_cache:
+            count("buildings.tile_cache_hits")
+            self.tile_cache.move_to_end(quad_key)
+            return self.tile_cache[quad_key]
+
+        count("buildings.tile_cache_misses")
+        if quad_key in self.tile_bounds and self.tile_bounds[quad_key] is None:
+            return None
+
+        parquet_path = self._parquet_path(quad_key)
+        if quad_key in self.tile_bounds and os.path.exists(parquet_path):
+            with stage("buildings.read_parquet"):
+                tile = gpd.read_parquet(parquet_path)
+        else:
+            count("buildings.tile_conversions")
+            with stage("buildings.convert_tile"):
+                tile = self._convert_tile(quad_key)
+        if tile is None:
+            return None
+
+        with stage("buildings.sindex_build"):
+            _ = tile.sindex  # force creation of spatial index
+        self.tile_cache[quad_key] = tile
+        if len(self.tile_cache) > self.max_cached_tiles:
+            self.tile_cache.popitem(last=False)
+        return tile
+
+    def tiles_for_bounds(self, min_lon, min_lat, max_lon, max_lat):
+        # Converted tiles are matched on their buildings' bounds (buildings can straddle tile edges),
+        # tiles not converted yet on their mercantile bounds padded by edge_margin_deg
+        quad_keys = []
+        for quad_key in self.quad_keys:
+            bounds = self._tile_query_bounds(quad_key)
+            if bounds is None:
+                continue
+            west, south, east, north = bounds
+            if west <= max_lon and min_lon <= east and south <= max_lat and min_lat <= north:
+                quad_keys.append(quad_key)
+        return quad_keys
+
+    def _tile_query_bounds(self, quad_key):
+        self._drop_if_stale(quad_key)
+        if quad_key in self.tile_bounds:
+            return self.tile_bounds[quad_key]
+        west, south, east, north = mercantile.bounds(mercantile.quadkey_to_tile(quad_key))
+        margin = self.edge_margin_deg
+        return west - margin, south - margin, east + margin, north + margin
+
+    def buildings_in_bounds(self, min_lon, min_lat, max_lon, max_lat):
+        # Only the buildings intersecting the box, gathered tile by tile through each tile's sindex
+        bbox = geometry.box(min_lon, min_lat, max_lon, max_lat)
+        parts = []
+        for quad_key in self.tiles_for_bounds(min_lon, min_lat, max_lon, max_lat):
+            tile = self.load_tile(quad_key)
+            if tile is None or tile.empty:
+                continue
+            parts.append(tile.iloc[np.sort(tile.sindex.query(bbox, predicate='intersects'))])
+
+        parts = [part for part in parts if not part.empty]
+        if not parts:
+            return gpd.GeoDataFrame(columns=["id", "height", "confidence", "geometry"], geometry="geometry", crs='EPSG:4326')
+        return pd.concat(parts, ignore_index=True)
 
     def get_tile_buildings(self):
-        downloaded_tiles = []
-        with tempfile.TemporaryDirectory() as tmpdir:
-            for quad_key in self.quad_keys:
-                out_path = os.path.join(self.tiles_dir, f"{quad_key}.geojson")
-                if os.path.exists(out_path):
-                    downloaded_tiles.append(out_path)
-                    continue
-
-                rows = self.ms_csv[self.ms_csv["QuadKey"] == quad_key]
-                if rows.empty:
-                    continue
-
-                gdfs = []
-                for _, row in rows.iterrows():
-                    url = row["Url"]
-                    df = pd.read_json(url, lines=True)
-                    df["geometry"] = df["geometry"].apply(geometry.shape)
-                    gdf = gpd.GeoDataFrame(df, crs=4326)
-                    gdf = gdf[gdf.geometry.intersects(self.aoi_shape)]
-                    gdfs.append(gdf)
-
-                if gdfs:
-                    full_gdf = pd.concat(gdfs, ignore_index=True)
-                    full_gdf.to_file(out_path, driver="GeoJSON")
-                    downloaded_tiles.append(out_path)
-
-        return downloaded_tiles
-
-    def merge_downloaded_tiles(self):
-        combined_gdf = gpd.GeoDataFrame()
-        idx = 0
-        for tile_path in self.downloaded_tiles:
-            gdf = gpd.read_file(tile_path)
-            gdf = gdf[gdf.geometry.intersects(self.aoi_shape)]
-            gdf['id'] = range(idx, idx + len(gdf))
-            idx += len(gdf)
-            combined_gdf = pd.concat([combined_gdf, gdf], ignore_index=True)
-
-        combined_gdf = combined_gdf.to_crs('EPSG:4326')
-        return combined_gdf
+        # Eagerly converts (downloading if needed) every AOI tile, e.g. to warm the cache offline
+        converted = []
+        for quad_key in self.quad_keys:
+            if self.load_tile(quad_key) is not None:
+                converted.append(self._parquet_path(quad_key))
+        return converted
+
+    @timed("buildings.merge_downloaded_tiles")
+    def merge_downloaded_tiles(self, quad_keys=None):
+        tiles = [self.load_tile(quad_key) for quad_key in (self.quad_keys if quad_keys is None else quad_keys)]
+        tiles = [tile for tile in tiles if tile is not None]
+        if not tiles:
+            return gpd.GeoDataFrame(columns=["id", "height", "confidence", "geometry"], geometry="geometry", crs='EPSG:4326')
+        return pd.concat(tiles, ignore_index=True)
 
+    @property
+    def geo_buildings(self):
+        # Whole-AOI frame, only materialized for callers that need every building at once
+        if self._geo_buildings is None:
+            self._geo_buildings = self.merge_downloaded_tiles()
+        return self._geo_buildings
+
+    @timed("buildings.get_height_building")
     def get_height_building(self, latitude, longitude):
         point = geometry.Point(longitude, latitude)
 
-        if self.geo_buildings.empty:
-            print("No buildings to plot.")
-            return -1
-
-        _ = self.geo_buildings.sindex  # force creation of spatial index
+        for quad_key in self.tiles_for_bounds(longitude, latitude, longitude, latitude):
+            tile = self.load_tile(quad_key)
+            if tile is None or tile.empty:
+                continue
 
-        possible_matches_index = list(self.geo_buildings.sindex.intersection(point.bounds))
-        possible_matches = self.geo_buildings.iloc[possible_matches_index]
+            possible_matches_index = list(tile.sindex.intersection(point.bounds))
+            possible_matches = tile.iloc[possible_matches_index]
 
-        for _, row in possible_matches.iterrows():
-            if row['geometry'].covers(point):
-                row_id = row['id']
-                row_polygon = row['geometry']
-                row_altitude = float(row['properties'].split(",")[0].split(":")[1])
-                return row_id, row_polygon, row_altitude
+            for _, row in possible_matches.iterrows():
+                if row['geometry'].covers(point):
+                    return row['id'], row['geometry'], float(row['height'])
 
         return -1
 
-    def plot_buildings(self, latitude, longitude, side_m, building_map_path):
-        if self.geo_buildings.empty:
-            print("No buildings to plot.")
-            return
+    @timed("buildings.get_height_buildings")
+    def get_height_buildings(self, lats, lons):
+        # Batch version of get_height_building: returns (building ids, heights) arrays,
+        # with id -1 and height NaN where no building covers the point
+        lats = np.atleast_1d(np.asarray(lats, dtype=float))
+        lons = np.atleast_1d(np.asarray(lons, dtype=float))
+        ids = np.full(len(lats), -1, dtype=np.int64)
+        heights = np.full(len(lats), np.nan)
+        if len(lats) == 0:
+            return ids, heights
 
-        # Define bounding box around center point
-        half_deg = side_m / 111320 / 2  # Roughly convert meters to degrees
-        min_lat = latitude - half_deg
-        max_lat = latitude + half_deg
-        min_lon = longitude - half_deg
-        max_lon = longitude + half_deg
+        points = gpd.points_from_xy(lons, lats)
+        unresolved = np.ones(len(lats), dtype=bool)
 
-        bbox = geometry.box(min_lon, min_lat, max_lon, max_lat)
-        # print(f"Total buildings loaded: {len(self.geo_buildings)}")
-        filtered = self.geo_buildings[self.geo_buildings.geometry.intersects(bbox)]
-        # print(f"Filtered buildings in view: {len(filtered)}")
+        for quad_key in self.tiles_for_bounds(lons.min(), lats.min(), lons.max(), lats.max()):
+            west, south, east, north = self._tile_query_bounds(quad_key)
+            candidates = np.flatnonzero(
+                unresolved & (lons >= west) & (lons <= east) & (lats >= south) & (lats <= north)
+            )
+            if len(candidates) == 0:
+                continue
+
+            tile = self.load_tile(quad_key)
+            if tile is None or tile.empty:
+                continue
+
+            # Pairs (point, building) where the building covers the point; keep the first building per point
+            point_idx, building_idx = tile.sindex.query(points[candidates], predicate='covered_by')
+            point_idx, first = np.unique(point_idx, return_index=True)
+            building_idx = building_idx[first]
 
-        # Create folium map
-        m = folium.Map(location=[latitude, longitude], zoom_start=17)
+            hits = candidates[point_idx]
+            ids[hits] = tile["id"].to_numpy()[building_idx]
+            heights[hits] = tile["height"].to_numpy()[building_idx]
+            unresolved[hits] = False
 
-        if not filtered.empty:
-            geojson = folium.GeoJson(filtered.to_json(), name="Buildings")
-            geojson.add_to(m)
+            if not unresolved.any():
+                break
 
-        folium.Marker(
-            [latitude + half_deg, longitude - half_deg],
-            tooltip=f"Area: {side_m} m"
-        ).add_to(m)
+        return ids, heights
 
-        folium.Marker([latitude, longitude], tooltip="Center Point").add_to(m)
+    def buildings_around(self, latitude, longitude, side_m):
+        # Buildings intersecting a side_m square centred on the point
+        half_deg = side_m / 111320 / 2  # Roughly convert meters to degrees
+        return self.buildings_in_bounds(longitude - half_deg, latitude - half_deg, longitude + half_deg, latitude + half_deg)
+
+    def plot_buildings(self, latitude, longitude, side_m, building_map_path, tiles_url=None):
+        from map_renderer import render_buildings_map
+
+        buildings = self.buildings_around(latitude, longitude, side_m) if tiles_url is None else None
+        if buildings is not None and buildings.empty:
+            print("No buildings to plot.")
+            return
 
-        m.save(building_map_path)
+        render_buildings_map(buildings, latitude, longitude, side_m, building_map_path, tiles_url=tiles_url)
         print(f"Map saved to {building_map_path}")
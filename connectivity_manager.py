@@ -1,11 +1,13 @@
-import glob
-import csv
-import folium
+import json
 import os
-from scipy.spatial import ConvexHull
 import numpy as np
-from shapely.geometry import Point, Polygon
-from pykrige.ok import OrdinaryKriging
+import shapely
+from shapely import STRtree
+from shapely.geometry import Polygon
+from instrumentation import count, stage, timed
+from kriging_models import KrigingRegistry
+from observation_store import ObservationStore
+from signal_rasters import SignalRasterStore
 
 band_frequencies_numeric = {
     1: 2100,      # MHz
@@ -22,7 +24,8 @@ band_frequencies_numeric = {
 }
 
 class ConnectivityManager:
-    def __init__(self, dataset_dirs=None, tower_files=None):
+    def __init__(self, dataset_dirs=None, tower_files=None, cache_dir='connectivity/cache', workers=None,
+                 max_live_models=128, n_closest_points=None, thin_resolution_m=None):
         self.dataset_dirs = dataset_dirs or [
             'connectivity/dataset',
             'connectivity/dataset-old/bike',
@@ -34,57 +37,107 @@ class ConnectivityManager:
             'connectivity/towers/tim_lteitaly.clf',
             'connectivity/towers/vodafone_lteitaly.clf'
         ]
+        # None for a read-only manager (restored from a snapshot): anything that would rebuild or write state raises
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.max_live_models = max_live_models
+        # Neighbourhood-limited kriging for dense cells, see KrigingRegistry
+        self.n_closest_points = n_closest_points
+        self.thin_resolution_m = thin_resolution_m
+        self.store = None
+        self.models = None
         self.observations = []
         self.observed_cell_ids = set()
+        self.cell_index = {}
         self.towers = []
+        self.coverage_tree = None
+        self.coverage_owners = None
+        self.signal_rasters = None
 
-    def _parse_datasets(self, map_obj):
-        for folder in self.dataset_dirs:
-            for file_path in glob.glob(f'{folder}/*.csv'):
-                file_name = os.path.basename(file_path)
-
-                if 'ocid' in file_name and 'dataset' in folder:
-                    continue
-
-                formatted_date = file_name.split('.')[0]
-                trail_coordinates = []
-
-                with open(file_path, 'r') as file:
-                    reader = csv.reader(file) if 'dataset-old' in folder else csv.DictReader(file)
-
-                    for row in reader:
-                        try:
-                            if 'dataset-old' in folder:
-                                lat = float(row[0])
-                                lon = float(row[1])
-                                alt = int(row[2])
-                                cell_id = int(row[6])
-                                signal = int(row[7])
-                            else:
-                                lat = float(row["lat"])
-                                lon = float(row["lon"])
-                                alt = int(float(row["altitude"]))
-                                cell_id = int(row["cell_id"])
-                                signal = int(row["rsrp"]) if row["net_type"] == "LTE" else int(row["rssi"])
-
-                            self.observations.append({
-                                "lat": lat,
-                                "lon": lon,
-                                "alt": alt,
-                                "cell_id": cell_id,
-                                "signal": signal
-                            })
-
-                            self.observed_cell_ids.add(cell_id)
-                            trail_coordinates.append((lat, lon))
-
-                        except (ValueError, IndexError, KeyError):
-                            continue
-
-                if trail_coordinates:
-                    folium.PolyLine(trail_coordinates, color='blue', tooltip=formatted_date).add_to(map_obj)
-
-    def _parse_towers(self, map_obj):
+    def _require_writable(self, action):
+        if self.cache_dir is None:
+            raise RuntimeError(
+                f"Cannot {action}: this ConnectivityManager is read-only (no cache_dir), e.g. restored from a snapshot"
+            )
+
+    @timed("connectivity.parse_datasets")
+    def _parse_datasets(self):
+        self._require_writable("parse the datasets")
+        self.store = ObservationStore(self.dataset_dirs, cache_dir=self.cache_dir, workers=self.workers).load()
+        self.observations = self.store.view()
+        self.observed_cell_ids = set(self.store.cell_ids.tolist())
+
+        # Contiguous per-cell arrays, so tower matching does not rescan all observations
+        self.cell_index = self.store.cell_index()
+        self.models = KrigingRegistry(
+            self.cell_index,
+            cache_dir=self.cache_dir,
+            max_live=self.max_live_models,
+            n_closest_points=self.n_closest_points,
+            thin_resolution_m=self.thin_resolution_m
+        )
+
+    def observations_for_cell(self, cell_id):
+        return self.cell_index.get(cell_id)
+
+    def signal_model(self, cell_id):
+        return self.models.get(cell_id) if self.models is not None else None
+
+    def _coverage_hull(self, cell_id, lat, lon, hull_cache):
+        matching_obs = self.observations_for_cell(cell_id)
+        n_samples = len(matching_obs["signal"])
+        if n_samples < 3:
+            return []
+
+        # Cells only grow by appending sessions, so an unchanged sample count within the same
+        # store generation means the hull is still valid
+        key = str(cell_id)
+        cached = hull_cache.get(key)
+        if (cached and cached["generation"] == self.store.generation and cached["samples"] == n_samples
+                and cached["tower"] == [lat, lon]):
+            count("connectivity.hull_cache_hits")
+            return [tuple(vertex) for vertex in cached["coverage"]]
+
+        count("connectivity.hull_cache_misses")
+        from scipy.spatial import ConvexHull
+
+        coverage = []
+        # include the tower location
+        np_points = np.vstack([np.column_stack((matching_obs["lat"], matching_obs["lon"])), [(lat, lon)]])
+        try:
+            with stage("connectivity.convex_hull"):
+                hull = ConvexHull(np_points)
+            coverage = [tuple(np_points[i]) for i in hull.vertices]
+        except Exception as e:
+            print(f"[WARN] Failed to compute convex hull for cell_id {cell_id}: {e}")
+
+        hull_cache[key] = {
+            "generation": self.store.generation,
+            "samples": n_samples,
+            "tower": [lat, lon],
+            "coverage": [list(map(float, vertex)) for vertex in coverage]
+        }
+        return coverage
+
+    def _hull_cache_path(self):
+        return os.path.join(self.cache_dir, 'hulls.json')
+
+    @timed("connectivity.parse_towers")
+    def _parse_towers(self):
+        self._require_writable("parse the towers")
+        self.coverage_tree = None
+        self.towers = []
+
+        try:
+            with open(self._hull_cache_path(), 'r') as f:
+                hull_cache = json.load(f)
+        except (OSError, ValueError):
+            hull_cache = {}
+
+        # A cell listed more than once (e.g. in two operators' files) keeps its first entry: rasters,
+        # hull cache and coverage index are all keyed by cell_id
+        seen = set()
+        duplicates = 0
         for tower_file in self.tower_files:
             with open(tower_file, 'r') as file:
                 for line in file:
@@ -105,100 +158,161 @@ class ConnectivityManager:
                     except ValueError:
                         continue
 
+                    if cell_id in seen:
+                        duplicates += 1
+                        continue
+
                     if cell_id in self.observed_cell_ids:
-                        matching_obs = [obs for obs in self.observations if obs["cell_id"] == cell_id]
-                        coverage = []
-
-                        if len(matching_obs) >= 3:
-                            # ---- maybe redundant ----
-                            lats = np.array([obs['lat'] for obs in matching_obs])
-                            lons = np.array([obs['lon'] for obs in matching_obs])
-                            signals = np.array([obs['signal'] for obs in matching_obs])
-                            if all(element == signals[0] for element in signals):
-                                signals[0] = signals[0] + 10^-2 # without we got an error (uniform values are not allowed)
-                            OK = OrdinaryKriging(
-                                lats, lons, signals,
-                                variogram_model='linear',  # or 'spherical', 'exponential'
-                                verbose=False,
-                                enable_plotting=False
-                            )
-                            points = [(obs["lat"], obs["lon"]) for obs in matching_obs]
-                            points.append((lat, lon))  # include the tower location
-
-                            np_points = np.array(points)
-                            try:
-                                hull = ConvexHull(np_points)
-                                coverage = [tuple(np_points[i]) for i in hull.vertices]
-
-                                # # Draw convex hull on map
-                                # folium.Polygon(
-                                #     locations=coverage,
-                                #     color='black',
-                                #     weight=1,
-                                #     fill=True,
-                                #     fill_opacity=0.1
-                                # ).add_to(map_obj)
-                            except Exception as e:
-                                print(f"[WARN] Failed to compute convex hull for cell_id {cell_id}: {e}")
+                        seen.add(cell_id)
+                        coverage = self._coverage_hull(cell_id, lat, lon, hull_cache)
 
                         tower = {
                             "lat": lat,
                             "lon": lon,
                             "cell_id": cell_id,
                             "band": band,
+                            "band_label": band_str,
                             "five_g": five_g,
-                            "coverage": coverage,
-                            "signal_int": OK
+                            "coverage": coverage
                         }
                         self.towers.append(tower)
 
-                        folium.CircleMarker(
-                            location=(lat, lon),
-                            radius=4,
-                            color='red',
-                            fill=True,
-                            fill_opacity=0.8,
-                            popup=f"Cell ID: {cell_id} {band_str} {'5G' if five_g else ''}"
-                        ).add_to(map_obj)
-
-    def generate_map(self, save_path):
-        m = folium.Map(location=(43.041169, 12.560277), zoom_start=12)
-
-        self._parse_datasets(m)
-        self._parse_towers(m)
-
-        # # random print
-        # azz = 875
-        # print(f"Sample observation: {self.observations[azz]}")
-        # print(f"Sample tower: {self.towers[azz]}")
-        #
-        # # Draw convex hull on map
-        # folium.Polygon(
-        #     locations=self.towers[azz]["coverage"],
-        #     color='black',
-        #     weight=1,
-        #     fill=True,
-        #     fill_opacity=0.1
-        # ).add_to(m)
-
-        m.save(save_path)
+        if duplicates:
+            print(f"[WARN] Skipped {duplicates} duplicate tower entries")
+        with open(self._hull_cache_path(), 'w') as f:
+            json.dump(hull_cache, f)
+
+    def refresh(self):
+        # Ingests sessions added since load, recomputing hulls, models and rasters only for the
+        # cells they touched. Returns the set of dirty cell_ids.
+        self._require_writable("refresh")
+        if self.store is None:
+            self.load()  # nothing loaded yet, so every cell is new
+            return set(self.store.cell_ids.tolist())
+
+        rows_before = len(self.store.data)
+        self.store.load()
+
+        if self.store.rebuilt:
+            dirty = set(self.store.cell_ids.tolist())
+            self.cell_index = self.store.cell_index()
+            self.models.cell_index = self.cell_index
+        else:
+            dirty = self.store.dirty_cells
+            for cell_id, new_obs in self.store.cell_index(rows_before).items():
+                old_obs = self.cell_index.get(cell_id)
+                if old_obs is None:
+                    self.cell_index[cell_id] = new_obs
+                else:
+                    self.cell_index[cell_id] = {key: np.concatenate((old_obs[key], new_obs[key])) for key in new_obs}
+
+        self.observations = self.store.view()
+        self.observed_cell_ids = set(self.store.cell_ids.tolist())
+        self.models.invalidate(dirty)
+
+        if dirty:
+            self._parse_towers()
+            if self.signal_rasters is not None:
+                self.bake_signal_rasters(
+                    self.signal_rasters.raster_dir,
+                    resolution_m=self.signal_rasters.index["resolution_m"],
+                    workers=self.workers
+                )
+
+        print(f"Refreshed {len(dirty)} dirty cells")
+        return dirty
+
+    def load(self):
+        # Observations, kriging models and towers with no visualization; generate_map renders on top of this
+        self._parse_datasets()
+        self._parse_towers()
+        return self
+
+    def generate_map(self, save_path, tiles_url=None):
+        # tiles_url: prefix of a map_renderer.export_tile_pyramid output to load trails and signal from
+        from map_renderer import render_connectivity_map
+
+        if self.store is None:
+            self.load()
+
+        render_connectivity_map(self, save_path, tiles_url=tiles_url)
         print(f"Map saved to {save_path}")
         print(f"Total observations: {len(self.observations)}")
         print(f"Total towers: {len(self.towers)}")
 
-    def get_covering_towers(self, lat, lon):
-        point = Point(lat, lon)
-        covering_towers = []
+    def _build_coverage_index(self):
+        # Coverage hulls in an STRtree, built once per tower set. Queried with the points as input
+        # and predicate='within', so preparing the hulls would buy nothing.
+        polygons = []
+        owners = []
+        for i, tower in enumerate(self.towers):
+            if len(tower["coverage"]) >= 3:
+                polygons.append(Polygon(tower["coverage"]))
+                owners.append(i)
+
+        self.coverage_tree = STRtree(polygons)
+        self.coverage_owners = np.array(owners, dtype=int)
+
+    def bake_signal_rasters(self, raster_dir='connectivity/rasters', resolution_m=25, workers=None):
+        self._require_writable("bake signal rasters")
+        self.signal_rasters = SignalRasterStore(raster_dir).bake(self, resolution_m=resolution_m, workers=workers)
+        return self.signal_rasters
+
+    def load_signal_rasters(self, raster_dir='connectivity/rasters'):
+        self.signal_rasters = SignalRasterStore(raster_dir).load()
+        return self.signal_rasters
 
-        for tower in self.towers:
+    def _predict_signal(self, cell_id, lats, lons, use_rasters, live_fallback):
+        if use_rasters and self.signal_rasters is not None and self.signal_rasters.has_cell(cell_id):
+            z = self.signal_rasters.sample_cell(cell_id, lats, lons)
+            missing = np.isnan(z)
+            count("connectivity.raster_samples", len(lats))
+            if live_fallback and missing.any():
+                count("connectivity.kriging_points", int(missing.sum()))
+                with stage("kriging.execute"):
+                    z[missing], _ = self.signal_model(cell_id).execute('points', lats[missing], lons[missing])
+            return z
+
+        count("connectivity.kriging_points", len(lats))
+        with stage("kriging.execute"):
+            z, _ = self.signal_model(cell_id).execute('points', lats, lons)  # dBm, variance
+        return z
+
+    @timed("connectivity.get_covering_towers")
+    def get_covering_towers_batch(self, lats, lons, use_rasters=True, live_fallback=True):
+        lats = np.atleast_1d(np.asarray(lats, dtype=float))
+        lons = np.atleast_1d(np.asarray(lons, dtype=float))
+        count("connectivity.points_queried", len(lats))
+        covering_towers = [[] for _ in range(len(lats))]
+
+        if self.coverage_tree is None:
+            with stage("connectivity.build_coverage_index"):
+                self._build_coverage_index()
+
+        # Hulls are stored as (lat, lon), same as the points
+        points = shapely.points(lats, lons)
+        point_idx, hull_idx = self.coverage_tree.query(points, predicate='within')
+
+        order = np.lexsort((point_idx, hull_idx))
+        point_idx, hull_idx = point_idx[order], hull_idx[order]
+        hulls, starts = np.unique(hull_idx, return_index=True)
+
+        # One model evaluation per tower over all the points inside its hull
+        for hull, selected in zip(hulls, np.split(point_idx, starts[1:])):
+            tower = self.towers[self.coverage_owners[hull]]
             try:
-                polygon = Polygon(tower["coverage"])
-                if polygon.contains(point):
-                    kriger_OK = tower["signal_int"]
-                    z, _ = kriger_OK.execute('points', lat, lon) # dBm, variance
-                    covering_towers.append((tower, z))  # (tower, signal strength)
+                z = self._predict_signal(tower["cell_id"], lats[selected], lons[selected], use_rasters, live_fallback)
             except Exception as e:
                 print(f"[WARN] Error checking coverage for cell_id {tower['cell_id']}: {e}")
                 continue
+
+            for point, signal in zip(selected, np.asarray(z, dtype=float)):
+                if not np.isnan(signal):
+                    covering_towers[point].append((tower, float(signal)))  # (tower, signal strength)
+
+        return covering_towers
+
+    def get_covering_towers(self, lat, lon, use_rasters=True, live_fallback=True):
+        covering_towers = self.get_covering_towers_batch([lat], [lon], use_rasters, live_fallback)[0]
         print(f"Total covering towers: {len(covering_towers)}")
-        return covering_towers
\ No newline at end of file
+        return covering_towers
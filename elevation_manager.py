@@ -1,20 +1,25 @@
 import requests
 import warnings
-import tempfile
-from owslib.wcs import WebCoverageService
-import rasterio
-import os
-import glob
-from rasterio.warp import transform
+import numpy as np
+from instrumentation import timed
+from raster_catalog import RasterCatalog
+from wcs_tiles import WCSTileCache, make_session
 
 class ElevationManager:
-    def __init__(self):
-        self.service_url = "https://tinitaly.pi.ingv.it/TINItaly_1_1/wcs"
-        self.coverage_id = "TINItaly_1_1:tinitaly_dem"
+    def __init__(self, elevation_dir="elevation/", service_url="https://tinitaly.pi.ingv.it/TINItaly_1_1/wcs",
+                 coverage_id="TINItaly_1_1:tinitaly_dem", wcs_cache_dir="elevation/wcs_cache", wcs_workers=8):
+        self.elevation_dir = elevation_dir
+        self._catalog = None
+        self.service_url = service_url
+        self.coverage_id = coverage_id
+        self.wcs_cache_dir = wcs_cache_dir
+        self.wcs_workers = wcs_workers
+        self._wcs = None
+        self._wcs_tiles = {}
 
         self._suppress_ssl_warnings()
-        self._patch_requests_ssl_verification()
-        self.wcs = WebCoverageService(self.service_url, version='1.0.0')
+        # The TINItaly certificate does not verify; one pooled session shared by all tile caches
+        self.session = make_session(pool_size=wcs_workers, verify=False)
 
     def _suppress_ssl_warnings(self):
         warnings.filterwarnings("ignore", message="Unverified HTTPS request")
@@ -26,65 +31,56 @@ class ElevationManager:
             return old_request(*args, **kwargs)
         requests.request = unsafe_request
 
-    def get_elevation_wcs(self, lat, lon, delta_lat=0.00009, delta_lon=0.00013):
-        bbox = (lon - delta_lon, lat - delta_lat, lon + delta_lon, lat + delta_lat)
-
-        try:
-            response = self.wcs.getCoverage(
-                identifier=self.coverage_id,
-                bbox=bbox,
-                format='GeoTIFF',
-                crs='EPSG:4326',
-                resx=delta_lon,
-                resy=delta_lat
+    @property
+    def wcs(self):
+        # owslib client, only created when something needs the service metadata
+        if self._wcs is None:
+            from owslib.wcs import WebCoverageService
+
+            self._patch_requests_ssl_verification()
+            self._wcs = WebCoverageService(self.service_url, version='1.0.0')
+        return self._wcs
+
+    def wcs_tiles(self, delta_lat=0.00009, delta_lon=0.00013):
+        key = (delta_lat, delta_lon)
+        if key not in self._wcs_tiles:
+            self._wcs_tiles[key] = WCSTileCache(
+                self.service_url,
+                self.coverage_id,
+                cache_dir=self.wcs_cache_dir,
+                res_lat=delta_lat,
+                res_lon=delta_lon,
+                max_workers=self.wcs_workers,
+                session=self.session
             )
-        except Exception as e:
-            print(f"Error fetching coverage: {e}")
-            return None
-
-        content = response.read()
-
-        with tempfile.NamedTemporaryFile(suffix=".tif") as tmp:
-            tmp.write(content)
-            tmp.flush()
-            try:
-                with rasterio.open(tmp.name) as dataset:
-                    elevation = list(dataset.sample([(lon, lat)]))[0][0]
-                    return elevation
-            except rasterio.errors.RasterioIOError:
-                print("Not a valid GeoTIFF — check request parameters or server response.")
-                return None
+        return self._wcs_tiles[key]
 
-    def get_elevation_tiff(self, lat, lon):
-        tif_files = glob.glob(os.path.join("elevation/", "*.tif"))
-
-        for file_path in tif_files:
-            try:
-                with rasterio.open(file_path) as dataset:
-                    bounds = dataset.bounds
+    @timed("elevation.get_elevations_wcs")
+    def get_elevations_wcs(self, lats, lons, delta_lat=0.00009, delta_lon=0.00013):
+        # Whole routes at once: every grid tile the points need is fetched in one concurrent pass
+        return self.wcs_tiles(delta_lat, delta_lon).get_elevations(lats, lons)
 
-                    # Transform the coordinate to the dataset's CRS if needed
-                    if dataset.crs.to_string() != "EPSG:4326":
-                        lon_t, lat_t = transform("EPSG:4326", dataset.crs, [lon], [lat])
-                        lon_t, lat_t = lon_t[0], lat_t[0]
-                    else:
-                        lon_t, lat_t = lon, lat
+    def get_elevation_wcs(self, lat, lon, delta_lat=0.00009, delta_lon=0.00013):
+        value = self.get_elevations_wcs([lat], [lon], delta_lat, delta_lon)[0]
+        return None if np.isnan(value) else value
 
-                    # Check if the point is within this raster's bounds
-                    if bounds.left <= lon_t <= bounds.right and bounds.bottom <= lat_t <= bounds.top:
-                        value = list(dataset.sample([(lon_t, lat_t)]))[0][0]
-                        nodata = dataset.nodata
+    @property
+    def catalog(self):
+        if self._catalog is None:
+            self._catalog = RasterCatalog(self.elevation_dir).load()
+        return self._catalog
 
-                        if value == nodata or value < -1000:
-                            print(f"Found in {file_path}, but it's a no-data value: {value}")
-                            continue  # Try the next file
+    @timed("elevation.get_elevations")
+    def get_elevations(self, lats, lons):
+        # Batch lookup over the DEM tiles, NaN where no tile has valid data
+        return self.catalog.get_elevations(lats, lons)
 
-                        # print(f"Value from {file_path}")
-                        return value
-            except Exception as e:
-                print(f"Error reading {file_path}: {e}")
-                continue
+    @timed("elevation.get_elevation_tiff")
+    def get_elevation_tiff(self, lat, lon):
+        value = self.get_elevations([lat], [lon])[0]
 
-        print("No valid elevation found in available TIFF files.")
-        return None
+        if np.isnan(value):
+            print("No valid elevation found in available TIFF files.")
+            return None
 
+        return value
@@ -0,0 +1,137 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+LAYERS = ("elevation", "building", "towers", "image")
+DEFAULT_TIMEOUTS = {"elevation": 30.0, "building": 30.0, "towers": 60.0, "image": 60.0}
+
+
+class EnvironmentService:
+    # "What is the environment at these waypoints": every configured manager answers for the whole batch
+    # at once, and the layers run concurrently, so a route costs about as much as its slowest layer.
+    # asyncio schedules the layers and enforces per-layer timeouts; the managers' blocking work (WCS/WMS
+    # requests, already fanned out over their pooled sessions, and the spatial / kriging lookups, which
+    # spend most of their time in numpy, shapely and GEOS with the GIL released) runs on a thread pool.
+    # A layer that fails or times out leaves None in its fields and a message under "errors"; the others
+    # are still returned. The managers' caches are not thread-safe, so each layer holds a lock for as long
+    # as its manager call actually runs: a timed-out call keeps it until it returns, and until then the
+    # layer is reported busy instead of being started again.
+    def __init__(self, connectivity=None, buildings=None, elevation=None, images=None, elevation_source="tiff",
+                 image_size_m=100, image_resolution_m=0.2, timeouts=None, workers=None):
+        self.connectivity = connectivity
+        self.buildings = buildings
+        self.elevation = elevation
+        self.images = images
+        self.elevation_source = elevation_source
+        self.image_size_m = image_size_m
+        self.image_resolution_m = image_resolution_m
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.executor = ThreadPoolExecutor(max_workers=workers or len(LAYERS))
+        self.last_timings = {}
+        self.layer_locks = {layer: threading.Lock() for layer in LAYERS}
+        self.state_lock = threading.Lock()
+        self.stalled = {}  # layer -> timed-out call still running
+
+    def available_layers(self):
+        sources = {
+            "elevation": self.elevation,
+            "building": self.buildings,
+            "towers": self.connectivity,
+            "image": self.images
+        }
+        return [layer for layer in LAYERS if sources[layer] is not None]
+
+    def _elevation_layer(self, lats, lons):
+        if self.elevation_source == "wcs":
+            values = self.elevation.get_elevations_wcs(lats, lons)
+        else:
+            values = self.elevation.get_elevations(lats, lons)
+        return [None if np.isnan(value) else float(value) for value in values]
+
+    def _building_layer(self, lats, lons):
+        ids, heights = self.buildings.get_height_buildings(lats, lons)
+        return [
+            None if building_id == -1 else {"id": int(building_id), "height": None if np.isnan(height) else float(height)}
+            for building_id, height in zip(ids, heights)
+        ]
+
+    def _towers_layer(self, lats, lons):
+        if self.connectivity.store is None:
+            self.connectivity.load()
+        return [
+            [{"cell_id": tower["cell_id"], "band": tower["band"], "five_g": tower["five_g"], "signal": signal}
+             for tower, signal in covering]
+            for covering in self.connectivity.get_covering_towers_batch(lats, lons)
+        ]
+
+    def _image_layer(self, lats, lons):
+        return self.images.get_image_arrays(lats, lons, self.image_size_m, self.image_resolution_m)
+
+    def _call_layer(self, layer, call, lats, lons):
+        # Runs on the pool; the layer lock serializes calls into the same manager
+        with self.layer_locks[layer]:
+            try:
+                return getattr(self, f"_{layer}_layer")(lats, lons)
+            finally:
+                with self.state_lock:
+                    call["done"] = True
+                    if self.stalled.get(layer) is call:
+                        del self.stalled[layer]
+
+    async def _run_layer(self, layer, lats, lons, timeout):
+        loop = asyncio.get_running_loop()
+        call = {"done": False}
+        with self.state_lock:
+            if layer in self.stalled:
+                return layer, None, "busy: a previous call that timed out is still running"
+
+        start = time.perf_counter()
+        try:
+            # On timeout the worker thread is abandoned rather than interrupted; its result is discarded
+            return layer, await asyncio.wait_for(
+                loop.run_in_executor(self.executor, self._call_layer, layer, call, lats, lons), timeout
+            ), None
+        except asyncio.TimeoutError:
+            with self.state_lock:
+                if not call["done"]:
+                    self.stalled[layer] = call
+            return layer, None, f"timed out after {timeout}s"
+        except Exception as e:
+            print(f"[WARN] Environment layer {layer} failed: {e}")
+            return layer, None, str(e)
+        finally:
+            self.last_timings[layer] = time.perf_counter() - start
+
+    async def query_async(self, lats, lons, layers=None, timeouts=None):
+        lats = np.atleast_1d(np.asarray(lats, dtype=float))
+        lons = np.atleast_1d(np.asarray(lons, dtype=float))
+        layers = [layer for layer in (layers or LAYERS) if layer in self.available_layers()]
+        timeouts = {**self.timeouts, **(timeouts or {})}
+        self.last_timings = {}
+
+        results = [{"lat": float(lat), "lon": float(lon), "errors": {}} for lat, lon in zip(lats, lons)]
+        for layer in layers:
+            for result in results:
+                result[layer] = None
+
+        outcomes = await asyncio.gather(*(self._run_layer(layer, lats, lons, timeouts[layer]) for layer in layers))
+        for layer, values, error in outcomes:
+            for i, result in enumerate(results):
+                if error is None:
+                    result[layer] = values[i]
+                else:
+                    result["errors"][layer] = error
+        return results
+
+    def query(self, lats, lons, layers=None, timeouts=None):
+        # Blocking entry point; from inside a running event loop await query_async instead
+        return asyncio.run(self.query_async(lats, lons, layers, timeouts))
+
+    def query_point(self, lat, lon, layers=None, timeouts=None):
+        return self.query([lat], [lon], layers, timeouts)[0]
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
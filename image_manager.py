@@ -1,57 +1,82 @@
-import requests
 import pyproj
-from io import BytesIO
-from PIL import Image
+from instrumentation import timed
+from ortho_tiles import OrthoTileCache
+from wcs_tiles import make_session
 
 class ImageManager:
-    def __init__(self):
-        self.wms_url = "https://siat.regione.umbria.it/arcgis/services/public/ORTOFOTO_2020_WGS84_UTM33N/MapServer/WMSServer"
+    def __init__(self, wms_url="https://siat.regione.umbria.it/arcgis/services/public/ORTOFOTO_2020_WGS84_UTM33N/MapServer/WMSServer",
+                 cache_dir="images/cache", workers=8):
+        self.wms_url = wms_url
         self.layer = "0"
-        self.crs = "EPSG:4326"
+        # The orthophoto is served natively in UTM 33N, which is also the grid the tiles are cached on
+        self.crs = "EPSG:32633"
         self.image_format = "image/png"
         self.project_to_utm = pyproj.Transformer.from_crs("EPSG:4326", "EPSG:32633", always_xy=True).transform
         self.project_to_wgs84 = pyproj.Transformer.from_crs("EPSG:32633", "EPSG:4326", always_xy=True).transform
+        self.session = make_session(pool_size=workers)
+        self.tiles = OrthoTileCache(
+            self.wms_url,
+            self.layer,
+            cache_dir=cache_dir,
+            image_format=self.image_format,
+            crs=self.crs,
+            max_workers=workers,
+            session=self.session
+        )
 
-    def get_image(self, lat, lon, bbox_size_m=100, resolution_m_per_pixel=0.2):
+    def _bbox(self, lat, lon, bbox_size_m):
         delta = bbox_size_m / 2
 
         # Convert lat/lon to UTM
         utm_x, utm_y = self.project_to_utm(lon, lat)
+        return utm_x - delta, utm_y - delta, utm_x + delta, utm_y + delta
 
-        # Define BBOX in UTM coordinates and convert back to lat/lon
-        minx, miny = utm_x - delta, utm_y - delta
-        maxx, maxy = utm_x + delta, utm_y + delta
-        min_lon, min_lat = self.project_to_wgs84(minx, miny)
-        max_lon, max_lat = self.project_to_wgs84(maxx, maxy)
+    @timed("images.get_image")
+    def get_image(self, lat, lon, bbox_size_m=100, resolution_m_per_pixel=0.2):
+        minx, miny, maxx, maxy = self._bbox(lat, lon, bbox_size_m)
 
         # Calculate image size
         width_pixels = int(bbox_size_m / resolution_m_per_pixel)
         height_pixels = int(bbox_size_m / resolution_m_per_pixel)
 
-        params = {
-            "SERVICE": "WMS",
-            "VERSION": "1.1.1",
-            "REQUEST": "GetMap",
-            "LAYERS": self.layer,
-            "STYLES": "",
-            "FORMAT": self.image_format,
-            "SRS": self.crs,
-            "BBOX": f"{min_lon},{min_lat},{max_lon},{max_lat}",
-            "WIDTH": str(width_pixels),
-            "HEIGHT": str(height_pixels),
-        }
-
-        response = requests.get(self.wms_url, params=params)
-
-        if response.status_code == 200 and "image" in response.headers.get("Content-Type", ""):
-            try:
-                img = Image.open(BytesIO(response.content))
-                return img
-            except Exception as e:
-                print(f"Error processing image: {e}")
-                return None
-        else:
-            print(f"Failed to fetch image: {response.status_code}")
-            print(response.text)
-            return None
+        image = self.tiles.mosaic(minx, miny, maxx, maxy, resolution_m_per_pixel, width_pixels, height_pixels)
+        if image is None:
+            print("Failed to fetch image: no tile could be retrieved")
+        return image
+
+    def get_image_array(self, lat, lon, bbox_size_m=100, resolution_m_per_pixel=0.2):
+        # RGBA array straight from the tile mosaic, at the cached level's native pixel size (no PIL round trip)
+        minx, miny, maxx, maxy = self._bbox(lat, lon, bbox_size_m)
+        return self.tiles.mosaic_array(minx, miny, maxx, maxy, self.tiles.level_for(resolution_m_per_pixel))
+
+    def write_mosaic(self, path, lats, lons, buffer_m=100, resolution_m_per_pixel=0.2):
+        # Streams the area around a route (or any set of points) to a .tif or .npy mosaic on disk, see OrthoMosaic
+        from ortho_mosaic import OrthoMosaic
+
+        xs, ys = self.project_to_utm(lons, lats)
+        return OrthoMosaic.build(
+            path,
+            self.tiles,
+            min(xs) - buffer_m,
+            min(ys) - buffer_m,
+            max(xs) + buffer_m,
+            max(ys) + buffer_m,
+            resolution_m_per_pixel
+        )
+
+    def prefetch(self, lats, lons, bbox_size_m=100, resolution_m_per_pixel=0.2):
+        # Every tile a flight corridor needs, fetched in one concurrent pass so the overlapping crops
+        # that follow are all served from the cache
+        level = self.tiles.level_for(resolution_m_per_pixel)
+        keys = []
+        for lat, lon in zip(lats, lons):
+            keys.extend(self.tiles.tile_keys(level, *self._bbox(lat, lon, bbox_size_m)))
+        self.tiles.get_tiles(keys)
+
+    def get_images(self, lats, lons, bbox_size_m=100, resolution_m_per_pixel=0.2):
+        self.prefetch(lats, lons, bbox_size_m, resolution_m_per_pixel)
+        return [self.get_image(lat, lon, bbox_size_m, resolution_m_per_pixel) for lat, lon in zip(lats, lons)]
 
+    def get_image_arrays(self, lats, lons, bbox_size_m=100, resolution_m_per_pixel=0.2):
+        self.prefetch(lats, lons, bbox_size_m, resolution_m_per_pixel)
+        return [self.get_image_array(lat, lon, bbox_size_m, resolution_m_per_pixel) for lat, lon in zip(lats, lons)]
@@ -0,0 +1,169 @@
+import cProfile
+import functools
+import json
+import os
+import re
+import threading
+import time
+
+# Named stage timers and counters for the load and query paths. Disabled unless UAV_INSTRUMENT is
+# set (or enable() is called), in which case every hook is a single flag check. UAV_PROFILE=<dir>
+# additionally records a cProfile per stage, dumped as <dir>/<stage>.prof by dump_profiles().
+#
+#     with stage("buildings.convert_tile"):
+#         ...
+#     count("wcs.bytes_fetched", len(content))
+#
+#     @timed("connectivity.parse_towers")
+#     def _parse_towers(self): ...
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self.profile = None
+
+    def __enter__(self):
+        if (self.registry.profile_dir is not None and threading.current_thread() is threading.main_thread()
+                and not getattr(self.registry.local, "profiling", False)):
+            # Only the outermost stage profiles, and only on the main thread: cProfile cannot nest
+            self.profile = self.registry.profiles.setdefault(self.name, cProfile.Profile())
+            self.registry.local.profiling = True
+            self.profile.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        if self.profile is not None:
+            self.profile.disable()
+            self.registry.local.profiling = False
+        self.registry.record(self.name, elapsed)
+        return False
+
+
+class Instrumentation:
+    def __init__(self, enabled=False, profile_dir=None):
+        self.enabled = enabled
+        self.profile_dir = profile_dir
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.timers = {}
+        self.counters = {}
+        self.profiles = {}
+
+    def enable(self, profile_dir=None):
+        self.enabled = True
+        self.profile_dir = profile_dir
+        return self
+
+    def disable(self):
+        self.enabled = False
+        self.profile_dir = None
+
+    def reset(self):
+        with self.lock:
+            self.timers.clear()
+            self.counters.clear()
+            self.profiles.clear()
+
+    def stage(self, name):
+        return _Stage(self, name) if self.enabled else _NULL_STAGE
+
+    def record(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timed(self, name):
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with self.stage(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "stages": {
+                    name: {"calls": calls, "total_s": total, "mean_s": total / calls, "max_s": worst}
+                    for name, (calls, total, worst) in sorted(self.timers.items())
+                },
+                "counters": dict(sorted(self.counters.items()))
+            }
+
+    def to_json(self, path=None):
+        document = json.dumps(self.snapshot(), indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(document + "\n")
+        return document
+
+    def to_prometheus(self, prefix="uav"):
+        # Prometheus text exposition format: one summary-like family per stage, one counter per counter
+        snapshot = self.snapshot()
+        lines = [
+            f"# TYPE {prefix}_stage_seconds_total counter",
+            *(f'{prefix}_stage_seconds_total{{stage="{name}"}} {stats["total_s"]:.9f}'
+              for name, stats in snapshot["stages"].items()),
+            f"# TYPE {prefix}_stage_calls_total counter",
+            *(f'{prefix}_stage_calls_total{{stage="{name}"}} {stats["calls"]}'
+              for name, stats in snapshot["stages"].items()),
+            f"# TYPE {prefix}_stage_max_seconds gauge",
+            *(f'{prefix}_stage_max_seconds{{stage="{name}"}} {stats["max_s"]:.9f}'
+              for name, stats in snapshot["stages"].items()),
+        ]
+        for name, value in snapshot["counters"].items():
+            metric = f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def dump_profiles(self, directory=None):
+        directory = directory or self.profile_dir
+        if directory is None:
+            return []
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        with self.lock:
+            for name, profile in self.profiles.items():
+                path = os.path.join(directory, f"{name}.prof")
+                profile.dump_stats(path)
+                paths.append(path)
+        return paths
+
+
+metrics = Instrumentation(
+    enabled=os.environ.get("UAV_INSTRUMENT", "") not in ("", "0") or bool(os.environ.get("UAV_PROFILE")),
+    profile_dir=os.environ.get("UAV_PROFILE") or None
+)
+
+stage = metrics.stage
+count = metrics.count
+timed = metrics.timed
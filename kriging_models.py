@@ -0,0 +1,311 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from instrumentation import count, stage
+
+METERS_PER_DEGREE = 111320
+
+
+def training_fingerprint(lats, lons, signals):
+    h = hashlib.sha1()
+    for arr in (lats, lons, signals):
+        h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def thin_samples(lats, lons, signals, resolution_m=None):
+    # Merge fixes falling in the same grid bin (exact duplicates when resolution_m is None)
+    # into one sample at their mean position with their mean signal
+    if resolution_m:
+        lat_step = resolution_m / METERS_PER_DEGREE
+        lon_step = lat_step / max(np.cos(np.radians(np.mean(lats))), 1e-6)
+        keys = np.column_stack((np.floor(lats / lat_step), np.floor(lons / lon_step)))
+    else:
+        keys = np.column_stack((lats, lons))
+
+    _, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    if len(counts) == len(lats):
+        return lats, lons, signals
+
+    return (
+        np.bincount(inverse, weights=lats) / counts,
+        np.bincount(inverse, weights=lons) / counts,
+        np.bincount(inverse, weights=signals) / counts
+    )
+
+
+class LocalKriging:
+    # Ordinary kriging restricted to the n closest samples of each query point, found with a
+    # KD-tree. Each query solves an (n+1)x(n+1) system instead of one over the whole cell.
+    # execute() mirrors OrdinaryKriging.execute('points', ...).
+    def __init__(self, lats, lons, signals, variogram_function, variogram_parameters, n_closest_points=32,
+                 batch_size=4096):
+        from scipy.spatial import cKDTree
+
+        self.lats, self.lons, self.signals = thin_samples(
+            np.asarray(lats, dtype=float), np.asarray(lons, dtype=float), np.asarray(signals, dtype=float)
+        )
+        self.variogram_function = variogram_function
+        self.variogram_model_parameters = variogram_parameters
+        self.n_closest_points = min(n_closest_points, len(self.signals))
+        self.batch_size = batch_size
+        self.tree = cKDTree(np.column_stack((self.lats, self.lons)))
+
+    def execute(self, style, xpoints, ypoints):
+        if style != 'points':
+            raise ValueError("LocalKriging only supports style='points'")
+
+        xpoints = np.atleast_1d(np.asarray(xpoints, dtype=float))
+        ypoints = np.atleast_1d(np.asarray(ypoints, dtype=float))
+        z = np.empty(len(xpoints))
+        ss = np.empty(len(xpoints))
+
+        for start in range(0, len(xpoints), self.batch_size):
+            end = start + self.batch_size
+            z[start:end], ss[start:end] = self._solve(xpoints[start:end], ypoints[start:end])
+        return z, ss
+
+    def _solve(self, xpoints, ypoints):
+        n = self.n_closest_points
+        query = np.column_stack((xpoints, ypoints))
+        bd, idx = self.tree.query(query, k=n)
+        bd = bd.reshape(len(query), n)
+        idx = idx.reshape(len(query), n)
+
+        coords = self.tree.data[idx]
+        d = np.linalg.norm(coords[:, :, None, :] - coords[:, None, :, :], axis=-1)
+
+        a = np.zeros((len(query), n + 1, n + 1))
+        a[:, :n, :n] = -self.variogram_function(self.variogram_model_parameters, d)
+        a[:, np.arange(n), np.arange(n)] = 0.0
+        a[:, n, :n] = 1.0
+        a[:, :n, n] = 1.0
+
+        b = np.zeros((len(query), n + 1))
+        b[:, :n] = -self.variogram_function(self.variogram_model_parameters, bd)
+        b[:, n] = 1.0
+
+        try:
+            x = np.linalg.solve(a, b[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            x = np.einsum('mij,mj->mi', np.linalg.pinv(a), b)
+
+        z = np.sum(x[:, :n] * self.signals[idx], axis=1)
+        ss = np.sum(x * -b, axis=1)
+
+        # Exact hits return the sample itself, as exact kriging does
+        exact = bd[:, 0] <= 1e-10
+        z[exact] = self.signals[idx[exact, 0]]
+        ss[exact] = 0.0
+        return z, ss
+
+
+class KrigingRegistry:
+    # n_closest_points switches cells with more samples than that to LocalKriging, whose variogram is
+    # fitted on at most max_fit_samples samples. thin_resolution_m merges near-identical fixes first.
+    # params: variogram records by cell_id (as persisted under models/, e.g. restored from a snapshot),
+    # consulted before the models directory.
+    def __init__(self, cell_index, cache_dir='connectivity/cache', max_live=128, variogram_model='linear',
+                 n_closest_points=None, thin_resolution_m=None, max_fit_samples=2000, params=None):
+        self.cell_index = cell_index
+        self.models_dir = os.path.join(cache_dir, 'models') if cache_dir else None
+        self.max_live = max_live
+        self.variogram_model = variogram_model
+        self.n_closest_points = n_closest_points
+        self.thin_resolution_m = thin_resolution_m
+        self.max_fit_samples = max_fit_samples
+        self.live = OrderedDict()
+        self.params = dict(params or {})
+        self.fitted = 0
+        self.restored = 0
+        if self.models_dir:
+            os.makedirs(self.models_dir, exist_ok=True)
+
+    def training_data(self, cell_id):
+        obs = self.cell_index.get(cell_id)
+        if obs is None or len(obs["signal"]) < 3:
+            return None
+
+        lats, lons, signals = obs["lat"], obs["lon"], np.array(obs["signal"], dtype=float)
+        if self.thin_resolution_m:
+            lats, lons, signals = thin_samples(lats, lons, signals, self.thin_resolution_m)
+            if len(signals) < 3:
+                return None
+
+        if np.all(signals == signals[0]):
+            signals[0] = signals[0] + 1e-2  # without we got an error (uniform values are not allowed)
+        return lats, lons, signals
+
+    def is_local(self, n_samples):
+        return self.n_closest_points is not None and n_samples > self.n_closest_points
+
+    def get(self, cell_id):
+        if cell_id in self.live:
+            count("kriging.live_hits")
+            self.live.move_to_end(cell_id)
+            return self.live[cell_id]
+
+        count("kriging.live_misses")
+        data = self.training_data(cell_id)
+        if data is None:
+            return None
+
+        model = self._build(cell_id, *data)
+        self.live[cell_id] = model
+        if len(self.live) > self.max_live:
+            self.live.popitem(last=False)
+        return model
+
+    def invalidate(self, cell_ids):
+        for cell_id in cell_ids:
+            self.live.pop(cell_id, None)
+
+    def _params_path(self, cell_id):
+        return os.path.join(self.models_dir, f"{cell_id}.json")
+
+    def _load_params(self, cell_id, fingerprint, signals):
+        saved = self.params.get(cell_id)
+        if saved is None:
+            if not self.models_dir:
+                return None
+            try:
+                with open(self._params_path(cell_id), 'r') as f:
+                    saved = json.load(f)
+            except (OSError, ValueError):
+                return None
+
+        if (saved.get("fingerprint") != fingerprint or saved.get("variogram_model") != self.variogram_model
+                or saved.get("fit_samples") != self._fit_samples(len(signals))):
+            return None
+        self.params[cell_id] = saved
+        return saved["variogram_parameters"]
+
+    def export_params(self, cell_ids, fit=False):
+        # Valid variogram records for cell_ids, persisted or fitted in this process; fit=True fits the
+        # missing ones first
+        records = {}
+        for cell_id in cell_ids:
+            data = self.training_data(cell_id)
+            if data is None:
+                continue
+            if fit:
+                self.get(cell_id)
+            elif self._load_params(cell_id, training_fingerprint(*data), data[2]) is None:
+                continue
+            if cell_id in self.params:
+                records[cell_id] = self.params[cell_id]
+        return records
+
+    def _fit_samples(self, n_samples):
+        return min(n_samples, self.max_fit_samples) if self.is_local(n_samples) else n_samples
+
+    def _build(self, cell_id, lats, lons, signals):
+        from pykrige.ok import OrdinaryKriging
+
+        fingerprint = training_fingerprint(lats, lons, signals)
+        params = self._load_params(cell_id, fingerprint, signals)
+        local = self.is_local(len(signals))
+
+        if local:
+            # The variogram only needs a representative sample; pairwise fitting is quadratic
+            fit_idx = np.random.default_rng(0).permutation(len(signals))[:self.max_fit_samples]
+            fit_idx.sort()
+            fit_lats, fit_lons, fit_signals = lats[fit_idx], lons[fit_idx], signals[fit_idx]
+            if np.all(fit_signals == fit_signals[0]):
+                fit_signals = fit_signals.copy()
+                fit_signals[0] = fit_signals[0] + 1e-2
+        else:
+            fit_lats, fit_lons, fit_signals = lats, lons, signals
+
+        with stage("kriging.fit" if params is None else "kriging.restore"):
+            model = OrdinaryKriging(
+                fit_lats, fit_lons, fit_signals,
+                variogram_model=self.variogram_model,
+                variogram_parameters=params,
+                verbose=False,
+                enable_plotting=False
+            )
+        count("kriging.models_fitted" if params is None else "kriging.models_restored")
+
+        if params is not None:
+            self.restored += 1
+        else:
+            self.fitted += 1
+            self.params[cell_id] = {
+                "fingerprint": fingerprint,
+                "variogram_model": self.variogram_model,
+                "fit_samples": self._fit_samples(len(signals)),
+                "variogram_parameters": [float(p) for p in model.variogram_model_parameters]
+            }
+            if self.models_dir:
+                with open(self._params_path(cell_id), 'w') as f:
+                    json.dump(self.params[cell_id], f)
+
+        if local:
+            return LocalKriging(
+                lats, lons, signals,
+                model.variogram_function, model.variogram_model_parameters,
+                n_closest_points=self.n_closest_points
+            )
+        return model
+
+    def holdout_report(self, cell_ids, fraction=0.2, seed=0):
+        # Compares exact kriging with the configured neighbourhood/thinning mode on held-out samples
+        rng = np.random.default_rng(seed)
+        errors = {"exact": [], "local": []}
+        seconds = {"exact": 0.0, "local": 0.0}
+        cells = 0
+
+        for cell_id in cell_ids:
+            obs = self.cell_index.get(cell_id)
+            if obs is None or len(obs["signal"]) < 10:
+                continue
+
+            lats, lons = np.asarray(obs["lat"]), np.asarray(obs["lon"])
+            signals = np.asarray(obs["signal"], dtype=float)
+            perm = rng.permutation(len(signals))
+            n_test = max(1, int(len(signals) * fraction))
+            test, train = perm[:n_test], perm[n_test:]
+            train_index = {cell_id: {"lat": lats[train], "lon": lons[train], "signal": signals[train]}}
+
+            registries = {
+                "exact": KrigingRegistry(train_index, cache_dir=None, variogram_model=self.variogram_model),
+                "local": KrigingRegistry(
+                    train_index, cache_dir=None, variogram_model=self.variogram_model,
+                    n_closest_points=self.n_closest_points, thin_resolution_m=self.thin_resolution_m,
+                    max_fit_samples=self.max_fit_samples
+                )
+            }
+
+            cell_errors = {}
+            for name, registry in registries.items():
+                started = time.perf_counter()
+                model = registry.get(cell_id)
+                if model is None:
+                    break
+                z, _ = model.execute('points', lats[test], lons[test])
+                seconds[name] += time.perf_counter() - started
+                cell_errors[name] = np.asarray(z) - signals[test]
+
+            if len(cell_errors) == len(registries):
+                cells += 1
+                for name, err in cell_errors.items():
+                    errors[name].append(err)
+
+        report = {"cells": cells, "fraction": fraction}
+        for name, err in errors.items():
+            err = np.concatenate(err) if err else np.empty(0)
+            report[name] = {
+                "samples": int(len(err)),
+                "rmse": float(np.sqrt(np.mean(err ** 2))) if len(err) else None,
+                "mae": float(np.mean(np.abs(err))) if len(err) else None,
+                "bias": float(np.mean(err)) if len(err) else None,
+                "seconds": seconds[name]
+            }
+        return report
@@ -1,11 +1,27 @@
-from connectivity_manager import ConnectivityManager
-# from elevation_manager import ElevationManager
-from image_manager import ImageManager
-from buildings_manager import BuildingsManager
+import argparse
+import json
+import sys
+
+# Managers are imported inside the commands that need them: geopandas, pykrige, scipy, rasterio,
+# owslib and folium together take seconds to import, and a single lookup against a snapshot needs none.
+#
+#     python main.py                                    # demo run over every manager
+#     python main.py snapshot build environment.snap --rasters connectivity/rasters --embed-dem
+#     python main.py query 43.0655 12.5469 --snapshot environment.snap
+#     python main.py snapshot verify environment.snap
+
+LAT, LON = 43.065502633260664, 12.54686465354475
+QUERY_LAYERS = ("elevation", "building", "towers", "image")
+SNAPSHOT_LAYERS = ("connectivity", "buildings", "elevation")
+
+
+def demo(lat, lon):
+    from buildings_manager import BuildingsManager
+    from connectivity_manager import ConnectivityManager
+    from elevation_manager import ElevationManager
+    from image_manager import ImageManager
 
-if __name__ == "__main__":
     # Parameters
-    lat, lon = 43.065502633260664, 12.54686465354475
     img_path = "satellite_image.png"
     connectivity_map_path = "map_connectivity.html"
     building_map_path = "map_building.html"
@@ -43,3 +59,133 @@ if __name__ == "__main__":
     print(f"Image saved to {img_path}") if image and image.save(img_path) is None else print("No image returned.")
 
 
+def query_sources(layers, snapshot_path=None, elevation_source="tiff"):
+    # Only the managers the requested layers need; from the snapshot where it holds them
+    snapshot = None
+    if snapshot_path:
+        from snapshot import Snapshot
+        snapshot = Snapshot(snapshot_path).load()
+    has = (lambda layer: snapshot is not None and layer in snapshot.layers())
+
+    sources = {}
+    if "towers" in layers:
+        if has("connectivity"):
+            sources["connectivity"] = snapshot.connectivity()
+        else:
+            from connectivity_manager import ConnectivityManager
+            sources["connectivity"] = ConnectivityManager().load()
+    if "building" in layers:
+        if has("buildings"):
+            sources["buildings"] = snapshot.buildings()
+        else:
+            from buildings_manager import BuildingsManager
+            sources["buildings"] = BuildingsManager()
+    if "elevation" in layers:
+        if has("elevation") and elevation_source == "tiff":
+            sources["elevation"] = snapshot.elevation()
+        else:
+            from elevation_manager import ElevationManager
+            sources["elevation"] = ElevationManager()
+    if "image" in layers:
+        from image_manager import ImageManager
+        sources["images"] = ImageManager()
+    return sources
+
+
+def query(args):
+    from environment_service import EnvironmentService
+
+    # Manager progress output goes to stderr, stdout carries the JSON result only
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        service = EnvironmentService(
+            **query_sources(args.layers, args.snapshot, args.elevation_source),
+            elevation_source=args.elevation_source
+        )
+        result = service.query_point(args.lat, args.lon, layers=args.layers)
+        service.close()
+    finally:
+        sys.stdout = stdout
+
+    if result.get("image") is not None:
+        result["image"] = {"shape": list(result["image"].shape)}
+    print(json.dumps(result, indent=2))
+
+
+def snapshot_build(args):
+    from snapshot import build_snapshot
+
+    managers = {}
+    if "connectivity" in args.layers:
+        from connectivity_manager import ConnectivityManager
+        managers["connectivity"] = ConnectivityManager().load()
+        if args.rasters:
+            managers["connectivity"].load_signal_rasters(args.rasters)
+    if "buildings" in args.layers:
+        from buildings_manager import BuildingsManager
+        managers["buildings"] = BuildingsManager()
+    if "elevation" in args.layers:
+        from elevation_manager import ElevationManager
+        managers["elevation"] = ElevationManager()
+
+    build_snapshot(args.path, fit_models=args.fit_models, embed_dem=args.embed_dem, **managers)
+
+
+def snapshot_verify(args):
+    from snapshot import Snapshot
+
+    try:
+        Snapshot(args.path).load(verify=True)
+    except (OSError, ValueError) as e:
+        print(f"[WARN] {e}")
+        sys.exit(1)
+    print(f"{args.path}: OK")
+
+
+def snapshot_info(args):
+    from snapshot import Snapshot
+
+    print(json.dumps(Snapshot(args.path).load().info(), indent=2))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="UAV environment data: demo run, point queries and snapshots")
+    commands = parser.add_subparsers(dest="command")
+
+    demo_parser = commands.add_parser("demo", help="run every manager on one location (the default)")
+    demo_parser.add_argument("--lat", type=float, default=LAT)
+    demo_parser.add_argument("--lon", type=float, default=LON)
+
+    query_parser = commands.add_parser("query", help="environment at one point, as JSON")
+    query_parser.add_argument("lat", type=float)
+    query_parser.add_argument("lon", type=float)
+    query_parser.add_argument("--layers", nargs="+", choices=QUERY_LAYERS, default=["elevation", "building", "towers"])
+    query_parser.add_argument("--snapshot", default=None, help="serve the layers it holds from this snapshot")
+    query_parser.add_argument("--elevation-source", choices=("tiff", "wcs"), default="tiff")
+    query_parser.set_defaults(handler=query)
+
+    snapshot_parser = commands.add_parser("snapshot", help="build, verify or describe an environment snapshot")
+    snapshot_commands = snapshot_parser.add_subparsers(dest="snapshot_command", required=True)
+    build_parser = snapshot_commands.add_parser("build")
+    build_parser.add_argument("path")
+    build_parser.add_argument("--layers", nargs="+", choices=SNAPSHOT_LAYERS, default=list(SNAPSHOT_LAYERS))
+    build_parser.add_argument("--rasters", default=None, help="baked signal raster directory to include")
+    build_parser.add_argument("--fit-models", action="store_true", help="fit missing variograms before capturing")
+    build_parser.add_argument("--embed-dem", action="store_true", help="copy the DEM grids into the snapshot")
+    build_parser.set_defaults(handler=snapshot_build)
+    verify_parser = snapshot_commands.add_parser("verify")
+    verify_parser.add_argument("path")
+    verify_parser.set_defaults(handler=snapshot_verify)
+    info_parser = snapshot_commands.add_parser("info")
+    info_parser.add_argument("path")
+    info_parser.set_defaults(handler=snapshot_info)
+
+    args = parser.parse_args(argv)
+    if args.command in (None, "demo"):
+        demo(getattr(args, "lat", LAT), getattr(args, "lon", LON))
+    else:
+        args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+import json
+import math
+import os
+
+import folium
+import mercantile
+import numpy as np
+import shapely
+from branca.element import MacroElement
+from folium.plugins import FastMarkerCluster
+from jinja2 import Template
+from PIL import Image
+
+
+# folium rendering over already-loaded manager state. Kept out of the managers so headless
+# simulation runs never import folium or build HTML documents.
+#
+# HTML size is kept independent of the corpus: trails are Douglas-Peucker simplified to the
+# deepest zoom the map allows, towers go through a client-side marker cluster, and with
+# export_tile_pyramid the trails, buildings and signal rasters are written once as static z/x/y
+# tiles that the page fetches on demand (serve the output directory over HTTP, browsers refuse
+# fetch() on file://).
+
+EARTH_CIRCUMFERENCE_M = 40075016.686
+METERS_PER_DEGREE = 111320
+TILE_PX = 256
+DEFAULT_TILE_ZOOMS = {"trails": [10, 16], "buildings": [15, 16], "signal": [10, 14]}
+
+TOWER_MARKER_CALLBACK = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {radius: 4, color: 'red', fill: true, fillOpacity: 0.8});
+    marker.bindPopup(row[2]);
+    return marker;
+}
+"""
+
+
+class GeoJsonTileLayer(MacroElement):
+    # Leaflet grid layer that loads {z}/{x}/{y}.geojson tiles as they come into view and drops them on unload
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }}_features = L.layerGroup();
+        var {{ this.get_name() }} = L.gridLayer({
+            minZoom: {{ this.min_zoom }},
+            maxNativeZoom: {{ this.max_native_zoom }},
+            pane: 'overlayPane'
+        });
+        {{ this.get_name() }}.createTile = function (coords) {
+            var tile = document.createElement('div');
+            var url = {{ this.url|tojson }}.replace('{z}', coords.z).replace('{x}', coords.x).replace('{y}', coords.y);
+            fetch(url).then(function (response) {
+                return response.ok ? response.json() : null;
+            }).then(function (data) {
+                if (data && !tile._unloaded) {
+                    tile._features = L.geoJSON(data, {style: {{ this.style|tojson }}});
+                    {{ this.get_name() }}_features.addLayer(tile._features);
+                }
+            }).catch(function () {});
+            return tile;
+        };
+        {{ this.get_name() }}.on('tileunload', function (e) {
+            e.tile._unloaded = true;
+            if (e.tile._features) { {{ this.get_name() }}_features.removeLayer(e.tile._features); }
+        });
+        {{ this.get_name() }}.addTo({{ this._parent.get_name() }});
+        {{ this.get_name() }}_features.addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+    """)
+
+    def __init__(self, url, style, min_zoom, max_native_zoom):
+        super().__init__()
+        self._name = "GeoJsonTileLayer"
+        self.url = url
+        self.style = style
+        self.min_zoom = min_zoom
+        self.max_native_zoom = max_native_zoom
+
+
+def meters_per_pixel(zoom, lat):
+    return EARTH_CIRCUMFERENCE_M * math.cos(math.radians(lat)) / (TILE_PX * 2 ** zoom)
+
+
+def pixel_tolerance_deg(zoom, lat, tolerance_px=1.0):
+    return tolerance_px * meters_per_pixel(zoom, lat) / METERS_PER_DEGREE
+
+
+def simplify_trails(trails, zoom, lat, tolerance_px=1.0):
+    # Douglas-Peucker (shapely, topology not preserved) down to tolerance_px screen pixels at the zoom.
+    # Returns (names, lon/lat LineStrings) for the trails with at least two fixes.
+    names, lines = [], []
+    for name, coords in trails:
+        if len(coords) >= 2:
+            names.append(name)
+            lines.append(shapely.linestrings(coords[:, 1], coords[:, 0]))
+    if not lines:
+        return names, np.array([], dtype=object)
+    return names, shapely.simplify(np.array(lines, dtype=object), pixel_tolerance_deg(zoom, lat, tolerance_px),
+                                   preserve_topology=False)
+
+
+def _lat_lon_path(line):
+    return [(lat, lon) for lon, lat in shapely.get_coordinates(line).tolist()]
+
+
+def render_connectivity_map(manager, save_path, location=(43.041169, 12.560277), zoom_start=12, max_zoom=18,
+                            tiles_url=None):
+    # tiles_url: URL prefix of an export_tile_pyramid output; trails and signal then load on demand.
+    # Inline trails are drawn at every zoom up to max_zoom, so they are simplified for max_zoom; lower it
+    # (or use the pyramid, simplified per zoom) for a smaller page.
+    m = folium.Map(location=location, zoom_start=zoom_start, max_zoom=max_zoom)
+
+    if tiles_url is None:
+        names, lines = simplify_trails(manager.store.trails(), max_zoom, location[0])
+        for formatted_date, line in zip(names, lines):
+            folium.PolyLine(_lat_lon_path(line), color='blue', tooltip=formatted_date).add_to(m)
+    else:
+        add_tile_layers(m, tiles_url, buildings=False)
+
+    data = [
+        [tower["lat"], tower["lon"], f"Cell ID: {tower['cell_id']} {tower['band_label']} {'5G' if tower['five_g'] else ''}"]
+        for tower in manager.towers
+    ]
+    FastMarkerCluster(data, callback=TOWER_MARKER_CALLBACK, name="Towers").add_to(m)
+
+    m.save(save_path)
+    return m
+
+
+def render_buildings_map(buildings, latitude, longitude, side_m, save_path, zoom_start=17, tiles_url=None):
+    half_deg = side_m / METERS_PER_DEGREE / 2  # Roughly convert meters to degrees
+    m = folium.Map(location=[latitude, longitude], zoom_start=zoom_start)
+
+    if tiles_url is not None:
+        add_tile_layers(m, tiles_url, trails=False, signal=False)
+    elif not buildings.empty:
+        geojson = folium.GeoJson(_compact_geojson(buildings, zoom_start, latitude), name="Buildings")
+        geojson.add_to(m)
+
+    folium.Marker(
+        [latitude + half_deg, longitude - half_deg],
+        tooltip=f"Area: {side_m} m"
+    ).add_to(m)
+
+    folium.Marker([latitude, longitude], tooltip="Center Point").add_to(m)
+
+    m.save(save_path)
+    return m
+
+
+def _compact_geojson(buildings, zoom, lat):
+    # Only the height survives, outlines simplified to half a pixel and snapped to ~10 cm
+    geometry = shapely.simplify(buildings.geometry.values, pixel_tolerance_deg(zoom, lat, 0.5))
+    geometry = shapely.set_precision(geometry, 1e-6)
+    keep = ~shapely.is_empty(geometry)
+    features = [
+        {"type": "Feature", "properties": {"height": None if np.isnan(height) else float(height)},
+         "geometry": json.loads(shapely.to_geojson(geom))}
+        for height, geom in zip(buildings["height"].to_numpy()[keep], geometry[keep])
+    ]
+    return {"type": "FeatureCollection", "features": features}
+
+
+def add_tile_layers(m, tiles_url, trails=True, buildings=True, signal=True, manifest_dir=None):
+    # Zoom ranges come from the pyramid's tiles.json (read from manifest_dir, or tiles_url if it is a
+    # local path); without one every layer is assumed present with the export defaults
+    tiles_url = tiles_url.rstrip('/')
+    try:
+        with open(os.path.join(manifest_dir or tiles_url, "tiles.json"), 'r') as f:
+            layers = json.load(f)["layers"]
+    except (OSError, ValueError, KeyError):
+        layers = DEFAULT_TILE_ZOOMS
+
+    if signal and "signal" in layers:
+        min_zoom, max_zoom = layers["signal"]
+        folium.TileLayer(
+            tiles=f"{tiles_url}/signal/{{z}}/{{x}}/{{y}}.png",
+            attr="Signal rasters",
+            name="Signal",
+            overlay=True,
+            min_zoom=min_zoom,
+            max_native_zoom=max_zoom,
+            opacity=0.7
+        ).add_to(m)
+    if trails and "trails" in layers:
+        min_zoom, max_zoom = layers["trails"]
+        m.add_child(GeoJsonTileLayer(f"{tiles_url}/trails/{{z}}/{{x}}/{{y}}.geojson",
+                                     {"color": "blue", "weight": 2}, min_zoom, max_zoom))
+    if buildings and "buildings" in layers:
+        min_zoom, max_zoom = layers["buildings"]
+        m.add_child(GeoJsonTileLayer(f"{tiles_url}/buildings/{{z}}/{{x}}/{{y}}.geojson",
+                                     {"color": "#3388ff", "weight": 1}, min_zoom, max_zoom))
+
+
+def _write_geojson_tile(path, features):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f, separators=(',', ':'))
+
+
+def _tiles_in(bounds, zoom):
+    west, south, east, north = bounds
+    return list(mercantile.tiles(west, south, east, north, zooms=zoom))
+
+
+def _export_trails(out_dir, manager, zooms):
+    trails = list(manager.store.trails())
+    if not trails:
+        return 0
+
+    lat = float(np.mean(manager.store.data["lat"]))
+    written = 0
+    for zoom in zooms:
+        names, lines = simplify_trails(trails, zoom, lat)
+        tree = shapely.STRtree(lines)
+        tiles = _tiles_in(shapely.total_bounds(lines), zoom)
+        boxes = shapely.box(*np.array([tuple(mercantile.bounds(tile)) for tile in tiles]).T)
+        tile_idx, line_idx = tree.query(boxes, predicate='intersects')
+
+        for i in np.unique(tile_idx):
+            west, south, east, north = mercantile.bounds(tiles[i])
+            selected = line_idx[tile_idx == i]
+            clipped = shapely.clip_by_rect(lines[selected], west, south, east, north)
+            features = [
+                {"type": "Feature", "properties": {"session": names[j]}, "geometry": json.loads(shapely.to_geojson(geom))}
+                for j, geom in zip(selected, clipped) if not shapely.is_empty(geom)
+            ]
+            if features:
+                tile = tiles[i]
+                _write_geojson_tile(os.path.join(out_dir, "trails", str(zoom), str(tile.x), f"{tile.y}.geojson"), features)
+                written += 1
+    return written
+
+
+def _export_buildings(out_dir, buildings_manager, bounds, zooms):
+    written = 0
+    for zoom in zooms:
+        for tile in _tiles_in(bounds, zoom):
+            west, south, east, north = mercantile.bounds(tile)
+            buildings = buildings_manager.buildings_in_bounds(west, south, east, north)
+            if buildings.empty:
+                continue
+            features = _compact_geojson(buildings, zoom, (south + north) / 2)["features"]
+            _write_geojson_tile(os.path.join(out_dir, "buildings", str(zoom), str(tile.x), f"{tile.y}.geojson"), features)
+            written += 1
+    return written
+
+
+def signal_colors(dbm, alpha=170):
+    # -120 dBm red, -90 yellow, -60 green and above; transparent where there is no prediction
+    t = np.clip((dbm + 120) / 60, 0, 1)
+    rgba = np.zeros(dbm.shape + (4,), dtype=np.uint8)
+    rgba[..., 0] = np.where(np.isnan(t), 0, 255 * np.minimum(1, 2 * (1 - t)))
+    rgba[..., 1] = np.where(np.isnan(t), 0, 255 * np.minimum(1, 2 * t))
+    rgba[..., 3] = np.where(np.isnan(dbm), 0, alpha)
+    return rgba
+
+
+def _export_signal(out_dir, signal_rasters, zooms):
+    bands = signal_rasters.index["bands"]
+    if not bands:
+        return 0
+
+    # Extent of the band composites, in the rasters' (lat, lon) grid
+    south = min(entry["row0"] for entry in bands.values()) * signal_rasters.lat_step
+    west = min(entry["col0"] for entry in bands.values()) * signal_rasters.lon_step
+    north = max(entry["row0"] + entry["shape"][0] for entry in bands.values()) * signal_rasters.lat_step
+    east = max(entry["col0"] + entry["shape"][1] for entry in bands.values()) * signal_rasters.lon_step
+
+    written = 0
+    offsets = np.arange(TILE_PX) + 0.5
+    for zoom in zooms:
+        n = 2 ** zoom
+        for tile in _tiles_in((west, south, east, north), zoom):
+            # Pixel centres of the Web Mercator tile
+            lons = (tile.x + offsets / TILE_PX) / n * 360 - 180
+            lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (tile.y + offsets / TILE_PX) / n))))
+            grid_lat, grid_lon = np.meshgrid(lats, lons, indexing='ij')
+
+            best = np.full(grid_lat.size, np.nan)
+            for band in bands:
+                signal, _ = signal_rasters.sample_band(int(band), grid_lat.ravel(), grid_lon.ravel())
+                best = np.fmax(best, signal)
+            if np.isnan(best).all():
+                continue
+
+            path = os.path.join(out_dir, "signal", str(zoom), str(tile.x), f"{tile.y}.png")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            Image.fromarray(signal_colors(best.reshape(TILE_PX, TILE_PX))).save(path, optimize=True)
+            written += 1
+    return written
+
+
+def export_tile_pyramid(out_dir, manager=None, buildings_manager=None, buildings_bounds=None, trail_zooms=range(10, 17),
+                        building_zooms=range(15, 17), signal_zooms=range(10, 15)):
+    # Static z/x/y pyramids for the layers whose source is given: session trails (GeoJSON, simplified per
+    # zoom and clipped per tile), buildings within buildings_bounds (GeoJSON) and the baked per-band
+    # max-signal composites (PNG). tiles.json records which layers and zoom ranges exist.
+    layers = {}
+    counts = {}
+    if manager is not None and manager.store is not None:
+        counts["trails"] = _export_trails(out_dir, manager, trail_zooms)
+        layers["trails"] = [min(trail_zooms), max(trail_zooms)]
+    if manager is not None and manager.signal_rasters is not None:
+        counts["signal"] = _export_signal(out_dir, manager.signal_rasters, signal_zooms)
+        layers["signal"] = [min(signal_zooms), max(signal_zooms)]
+    if buildings_manager is not None and buildings_bounds is not None:
+        counts["buildings"] = _export_buildings(out_dir, buildings_manager, buildings_bounds, building_zooms)
+        layers["buildings"] = [min(building_zooms), max(building_zooms)]
+
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "tiles.json"), 'w') as f:
+        json.dump({"layers": layers, "tiles": counts}, f)
+    return counts
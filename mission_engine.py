@@ -0,0 +1,201 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from kriging_models import METERS_PER_DEGREE
+from signal_rasters import SignalRasterStore
+from surface_model import SurfaceModel
+
+# Per-process environment, attached once by _init_worker
+_worker_state = None
+
+
+def make_mission(mission_id, times, lats, lons, alts):
+    # A mission is a timestamped waypoint list; times in seconds, altitudes in metres above sea level
+    return {
+        "id": mission_id,
+        "t": np.asarray(times, dtype=float),
+        "lat": np.asarray(lats, dtype=float),
+        "lon": np.asarray(lons, dtype=float),
+        "alt": np.asarray(alts, dtype=float)
+    }
+
+
+class MissionState:
+    # What a worker needs to evaluate missions: the surface model and the baked signal rasters, both
+    # opened as read-only memmaps so every worker shares the same page cache instead of a private copy.
+    # raster_dir may also be an environment snapshot file (see snapshot.py) holding baked rasters.
+    def __init__(self, surface_dir, raster_dir, config):
+        self.surface = SurfaceModel(surface_dir).load() if surface_dir else None
+        if raster_dir and os.path.isfile(raster_dir):
+            from snapshot import Snapshot
+
+            self.signal = Snapshot(raster_dir).load().signal_rasters()
+            if self.signal is None:
+                raise ValueError(f"Snapshot {raster_dir} has no baked signal rasters")
+        else:
+            self.signal = SignalRasterStore(raster_dir).load() if raster_dir else None
+        self.bands = [int(band) for band in self.signal.index["bands"]] if self.signal is not None else []
+        self.config = config
+
+
+def _init_worker(surface_dir, raster_dir, config):
+    global _worker_state
+    _worker_state = MissionState(surface_dir, raster_dir, config)
+
+
+def _evaluate_chunk(missions):
+    return [evaluate_mission(_worker_state, mission) for mission in missions]
+
+
+def segment_lengths_m(lats, lons):
+    # Equirectangular approximation, plenty for waypoint spacings of a few km
+    scale = math.cos(math.radians(float(np.mean(lats))))
+    return np.hypot(np.diff(lats), np.diff(lons) * scale) * METERS_PER_DEGREE
+
+
+def path_length_m(lats, lons):
+    return float(segment_lengths_m(lats, lons).sum()) if len(lats) > 1 else 0.0
+
+
+def densify(mission, spacing_m):
+    # Points along the path at most spacing_m apart (waypoints included), with interpolated time and altitude
+    lat, lon, alt, t = mission["lat"], mission["lon"], mission["alt"], mission["t"]
+    if len(lat) < 2:
+        return lat, lon, alt, t
+
+    lengths = segment_lengths_m(lat, lon)
+    counts = np.maximum(np.ceil(lengths / spacing_m).astype(np.int64), 1)
+    segment = np.repeat(np.arange(len(lengths)), counts)
+    f = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)) / np.repeat(counts, counts)
+
+    def along(values):
+        return np.append(values[:-1][segment] + f * np.diff(values)[segment], values[-1])
+
+    return along(lat), along(lon), along(alt), along(t)
+
+
+def _runs(mask):
+    # (start, end) index pairs of the runs of True in mask, end exclusive
+    padded = np.concatenate(([False], mask, [False])).astype(np.int8)
+    edges = np.flatnonzero(np.diff(padded))
+    return edges[0::2], edges[1::2]
+
+
+def evaluate_mission(state, mission):
+    config = state.config
+    lat, lon, alt, t = densify(mission, config["sample_spacing_m"])
+    metrics = {
+        "id": mission["id"],
+        "waypoints": len(mission["lat"]),
+        "duration_s": float(t[-1] - t[0]) if len(t) else 0.0,
+        "length_m": path_length_m(mission["lat"], mission["lon"])
+    }
+    # Time each sample stands for: until the next one
+    dt = np.append(np.diff(t), 0.0)
+
+    if state.surface is not None:
+        terrain = state.surface.terrain_height(lat, lon).astype(float)
+        agl = alt - terrain
+        clearance = state.surface.segment_clearance(
+            mission["lat"][:-1], mission["lon"][:-1], mission["alt"][:-1],
+            mission["lat"][1:], mission["lon"][1:], mission["alt"][1:]
+        ) if len(mission["lat"]) > 1 else np.array([])
+        known = np.isfinite(clearance)
+        metrics.update({
+            "min_clearance_m": float(clearance[known].min()) if known.any() else None,
+            "segments_below_margin": int(np.sum(clearance[known] < config["clearance_margin_m"])),
+            "terrain_min_m": float(np.nanmin(terrain)) if not np.isnan(terrain).all() else None,
+            "terrain_max_m": float(np.nanmax(terrain)) if not np.isnan(terrain).all() else None,
+            "min_agl_m": float(np.nanmin(agl)) if not np.isnan(agl).all() else None,
+            "no_surface_data_ratio": float(np.isnan(terrain).mean())
+        })
+
+    if state.signal is not None:
+        best_signal = np.full(len(lat), np.nan)
+        serving = np.full(len(lat), -1, dtype=np.int64)
+        for band in state.bands:
+            signal, cell = state.signal.sample_band(band, lat, lon)
+            better = signal > np.nan_to_num(best_signal, nan=-np.inf)
+            best_signal[better] = signal[better]
+            serving[better] = cell[better]
+
+        # Samples with no raster value count as uncovered; the signal statistics are over predicted samples
+        predicted = ~np.isnan(best_signal)
+        covered = best_signal >= config["min_signal_dbm"]
+        starts, ends = _runs(~covered)
+        gap_durations = np.array([dt[start:end].sum() for start, end in zip(starts, ends)])
+        # Handovers: changes of serving cell between consecutive covered samples, bridging any gap. Near a
+        # raster edge the interpolated signal can outreach the nearest-pixel server; those samples are skipped
+        cells = serving[covered & (serving >= 0)]
+        total_time = dt.sum()
+
+        metrics.update({
+            "coverage_ratio": float(dt[covered].sum() / total_time) if total_time > 0 else float(covered.mean()),
+            "gap_count": len(starts),
+            "longest_gap_s": float(gap_durations.max()) if len(gap_durations) else 0.0,
+            "total_gap_s": float(gap_durations.sum()),
+            "handover_count": int(np.count_nonzero(cells[1:] != cells[:-1])),
+            "min_signal_dbm": float(best_signal[predicted].min()) if predicted.any() else None,
+            "mean_signal_dbm": float(best_signal[predicted].mean()) if predicted.any() else None
+        })
+
+    return metrics
+
+
+class MissionEngine:
+    # Evaluates batches of missions for clearance, terrain and predicted connectivity. Missions are
+    # sharded over a process pool whose workers attach to the memmapped surface model
+    # (SurfaceModel.build) and signal rasters (ConnectivityManager.bake_signal_rasters) once at start-up;
+    # neither the managers nor the geometries they were built from are loaded in the workers.
+    # Pass surface_dir or raster_dir as None to skip that group of metrics. The pool is started on the
+    # first evaluate and kept for later batches; close() (or leaving a with block) shuts it down.
+    def __init__(self, surface_dir='surface', raster_dir='connectivity/rasters', workers=None, sample_spacing_m=10.0,
+                 min_signal_dbm=-110.0, clearance_margin_m=10.0, chunks_per_worker=4):
+        self.surface_dir = surface_dir
+        self.raster_dir = raster_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.chunks_per_worker = chunks_per_worker
+        self.config = {
+            "sample_spacing_m": sample_spacing_m,
+            "min_signal_dbm": min_signal_dbm,
+            "clearance_margin_m": clearance_margin_m
+        }
+        self._local_state = None
+        self._pool = None
+
+    def evaluate(self, missions):
+        # One metrics dict per mission, in input order
+        missions = list(missions)
+        if not missions:
+            return []
+
+        if self.workers == 1:
+            if self._local_state is None:
+                self._local_state = MissionState(self.surface_dir, self.raster_dir, self.config)
+            return [evaluate_mission(self._local_state, mission) for mission in missions]
+
+        n_chunks = min(len(missions), self.workers * self.chunks_per_worker)
+        bounds = np.linspace(0, len(missions), n_chunks + 1).astype(int)
+        chunks = [missions[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(self.surface_dir, self.raster_dir, self.config)
+            )
+        return [metrics for chunk in self._pool.map(_evaluate_chunk, chunks) for metrics in chunk]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
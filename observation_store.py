@@ -0,0 +1,285 @@
+import csv
+import glob
+import hashlib
+import json
+import os
+import uuid
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from instrumentation import count, stage
+
+# Raw rows of a single drive-test file, cached as-is (cell ids not yet interned)
+FILE_DTYPE = np.dtype([
+    ("lat", "f8"),
+    ("lon", "f8"),
+    ("alt", "i4"),
+    ("cell_id", "i8"),
+    ("signal", "i4")
+])
+
+# Consolidated store, cell ids interned into "cell" (index into ObservationStore.cell_ids)
+STORE_DTYPE = np.dtype([
+    ("lat", "f8"),
+    ("lon", "f8"),
+    ("alt", "i4"),
+    ("cell", "i4"),
+    ("signal", "i4"),
+    ("session", "i4")
+])
+
+STORE_VERSION = 2
+
+
+def list_dataset_files(dataset_dirs):
+    files = []
+    for folder in dataset_dirs:
+        for file_path in sorted(glob.glob(f'{folder}/*.csv')):
+            file_name = os.path.basename(file_path)
+            if 'ocid' in file_name and 'dataset' in folder:
+                continue
+            files.append((file_path, 'dataset-old' in folder))
+    return files
+
+
+def parse_observation_file(file_path, legacy):
+    rows = []
+
+    with open(file_path, 'r') as file:
+        reader = csv.reader(file) if legacy else csv.DictReader(file)
+
+        for row in reader:
+            try:
+                if legacy:
+                    lat = float(row[0])
+                    lon = float(row[1])
+                    alt = int(row[2])
+                    cell_id = int(row[6])
+                    signal = int(row[7])
+                else:
+                    lat = float(row["lat"])
+                    lon = float(row["lon"])
+                    alt = int(float(row["altitude"]))
+                    cell_id = int(row["cell_id"])
+                    signal = int(row["rsrp"]) if row["net_type"] == "LTE" else int(row["rssi"])
+            except (ValueError, IndexError, KeyError, TypeError):
+                continue
+
+            rows.append((lat, lon, alt, cell_id, signal))
+
+    return np.array(rows, dtype=FILE_DTYPE)
+
+
+def _file_key(file_path):
+    stat = os.stat(file_path)
+    raw = f"{os.path.abspath(file_path)}:{stat.st_mtime_ns}:{stat.st_size}"
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def _parse_job(job):
+    file_path, legacy, cache_path = job
+    data = parse_observation_file(file_path, legacy)
+    np.save(cache_path, data)
+    return cache_path
+
+
+# Read-only list-of-dicts view over the columnar store, for code written against the old list
+class ObservationView(Sequence):
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store.data)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        row = self.store.data[i]
+        return {
+            "lat": float(row["lat"]),
+            "lon": float(row["lon"]),
+            "alt": int(row["alt"]),
+            "cell_id": int(self.store.cell_ids[row["cell"]]),
+            "signal": int(row["signal"])
+        }
+
+
+class ObservationStore:
+    # Append-only columnar store. store.bin holds STORE_DTYPE rows, store.json is the manifest of
+    # ingested files, sessions and interned cell ids. New files are appended; if a known file
+    # changed or disappeared the store is rebuilt (under a new generation) from the per-file cache.
+    def __init__(self, dataset_dirs, cache_dir='connectivity/cache', workers=None):
+        self.dataset_dirs = dataset_dirs
+        self.cache_dir = cache_dir
+        self.files_dir = os.path.join(cache_dir, 'observations')
+        self.meta_path = os.path.join(cache_dir, 'store.json')
+        self.data_path = os.path.join(cache_dir, 'store.bin')
+        self.workers = workers
+        self.data = np.empty(0, dtype=STORE_DTYPE)
+        self.cell_ids = np.empty(0, dtype=np.int64)
+        self.sessions = []
+        self.generation = None
+        self.dirty_cells = set()
+        self.rebuilt = False
+
+    @classmethod
+    def from_arrays(cls, data, cell_ids, sessions, generation, dataset_dirs=()):
+        # Read-only store over rows held elsewhere (an environment snapshot); nothing is read from cache_dir
+        store = cls(list(dataset_dirs))
+        store.data = data
+        store.cell_ids = np.asarray(cell_ids, dtype=np.int64)
+        store.sessions = list(sessions)
+        store.generation = generation
+        return store
+
+    def load(self):
+        os.makedirs(self.files_dir, exist_ok=True)
+        files = list_dataset_files(self.dataset_dirs)
+        keys = {file_path: _file_key(file_path) for file_path, _ in files}
+
+        meta = self._read_manifest()
+        self.rebuilt = meta is None or any(keys.get(path) != key for path, key in meta["files"].items())
+        if self.rebuilt:
+            meta = {
+                "version": STORE_VERSION,
+                "generation": uuid.uuid4().hex,
+                "rows": 0,
+                "files": {},
+                "sessions": [],
+                "cell_ids": []
+            }
+
+        new_files = [(file_path, legacy) for file_path, legacy in files if file_path not in meta["files"]]
+        self._parse_missing(new_files, keys)
+        self.dirty_cells = self._append(new_files, keys, meta)
+        self._open(meta)
+        return self
+
+    def _read_manifest(self):
+        if not os.path.exists(self.meta_path):
+            return None
+
+        try:
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta.get("version") != STORE_VERSION or os.path.getsize(self.data_path) < meta["rows"] * STORE_DTYPE.itemsize:
+                return None
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[WARN] Ignoring observation cache: {e}")
+            return None
+
+        return meta
+
+    def _open(self, meta):
+        self.generation = meta["generation"]
+        self.sessions = meta["sessions"]
+        self.cell_ids = np.array(meta["cell_ids"], dtype=np.int64)
+        if meta["rows"]:
+            self.data = np.memmap(self.data_path, dtype=STORE_DTYPE, mode='r', shape=(meta["rows"],))
+        else:
+            self.data = np.empty(0, dtype=STORE_DTYPE)
+
+    def _parse_missing(self, files, keys):
+        jobs = []
+        for file_path, legacy in files:
+            cache_path = os.path.join(self.files_dir, f"{keys[file_path]}.npy")
+            if not os.path.exists(cache_path):
+                jobs.append((file_path, legacy, cache_path))
+
+        count("observations.file_cache_hits", len(files) - len(jobs))
+        if not jobs:
+            return
+
+        count("observations.files_parsed", len(jobs))
+        with stage("observations.parse_csv"):
+            if self.workers == 1 or len(jobs) == 1:
+                for job in jobs:
+                    _parse_job(job)
+            else:
+                with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                    list(pool.map(_parse_job, jobs, chunksize=4))
+
+        print(f"Parsed {len(jobs)} dataset files")
+
+    def _append(self, files, keys, meta):
+        if not files:
+            return set()
+
+        chunks = [np.load(os.path.join(self.files_dir, f"{keys[file_path]}.npy")) for file_path, _ in files]
+        raw_cells = np.concatenate([chunk["cell_id"] for chunk in chunks])
+
+        # Intern cell ids; codes of already known cells never change, so existing rows stay valid
+        codes_by_id = {cell_id: code for code, cell_id in enumerate(meta["cell_ids"])}
+        new_ids, inverse = np.unique(raw_cells, return_inverse=True)
+        for cell_id in new_ids.tolist():
+            if cell_id not in codes_by_id:
+                codes_by_id[cell_id] = len(meta["cell_ids"])
+                meta["cell_ids"].append(cell_id)
+        id_codes = np.array([codes_by_id[cell_id] for cell_id in new_ids.tolist()], dtype=np.int32)
+
+        rows = np.empty(len(raw_cells), dtype=STORE_DTYPE)
+        rows["cell"] = id_codes[inverse.ravel()]
+        offset = 0
+        for (file_path, _), chunk in zip(files, chunks):
+            end = offset + len(chunk)
+            for field in ("lat", "lon", "alt", "signal"):
+                rows[field][offset:end] = chunk[field]
+            rows["session"][offset:end] = len(meta["sessions"])
+            meta["sessions"].append(os.path.basename(file_path).split('.')[0])
+            meta["files"][file_path] = keys[file_path]
+            offset = end
+
+        # Drop any tail left by an interrupted append before writing the new rows
+        mode = 'wb' if meta["rows"] == 0 else 'r+b'
+        with open(self.data_path, mode) as f:
+            f.truncate(meta["rows"] * STORE_DTYPE.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(rows.tobytes())
+        meta["rows"] += len(rows)
+
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+        print(f"Ingested {len(files)} new sessions ({len(rows)} observations, {len(new_ids)} cells touched)")
+        return set(new_ids.tolist())
+
+    def view(self):
+        return ObservationView(self)
+
+    def cell_index(self, start_row=0):
+        # Group rows (from start_row on) by interned cell with a single stable sort;
+        # each cell gets contiguous arrays
+        data = self.data[start_row:]
+        cells = np.asarray(data["cell"])
+        order = np.argsort(cells, kind='stable')
+        bounds = np.searchsorted(cells[order], np.arange(len(self.cell_ids) + 1))
+
+        lats = np.asarray(data["lat"])[order]
+        lons = np.asarray(data["lon"])[order]
+        signals = np.asarray(data["signal"])[order].astype(float)
+
+        index = {}
+        for code, cell_id in enumerate(self.cell_ids.tolist()):
+            start, end = bounds[code], bounds[code + 1]
+            if start == end:
+                continue
+            index[cell_id] = {
+                "lat": lats[start:end],
+                "lon": lons[start:end],
+                "signal": signals[start:end]
+            }
+        return index
+
+    def trails(self):
+        # Yields (session name, Nx2 lat/lon array) in ingestion order
+        sessions = np.asarray(self.data["session"])
+        bounds = np.searchsorted(sessions, np.arange(len(self.sessions) + 1))
+        coords = np.column_stack((self.data["lat"], self.data["lon"]))
+        for session, name in enumerate(self.sessions):
+            start, end = bounds[session], bounds[session + 1]
+            if end > start:
+                yield name, coords[start:end]
@@ -0,0 +1,102 @@
+import json
+import os
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+
+class OrthoMosaic:
+    # Large-area orthophoto mosaic streamed tile batch by tile batch to disk, so memory stays bounded by
+    # the tile working set whatever the output size. A ".tif" path gives a tiled, georeferenced GeoTIFF;
+    # anything else an RGBA .npy memmap with a .json sidecar holding the transform, whose windows are
+    # plain NumPy views of the mapped file.
+    def __init__(self, path):
+        self.path = path
+        self.transform = None
+        self.crs = None
+        self.pixels = None
+        self.dataset = None
+
+    @property
+    def is_geotiff(self):
+        return self.path.lower().endswith((".tif", ".tiff"))
+
+    def _meta_path(self):
+        return f"{self.path}.json"
+
+    @classmethod
+    def build(cls, path, tile_cache, minx, miny, maxx, maxy, resolution_m_per_pixel, batch_tiles=64):
+        mosaic = cls(path)
+        level = tile_cache.level_for(resolution_m_per_pixel)
+        resolution = tile_cache.resolution(level)
+        x0, y0, width, height = tile_cache.pixel_grid(level, minx, miny, maxx, maxy)
+        transform = from_origin(x0, y0, resolution, resolution)
+
+        if mosaic.is_geotiff:
+            profile = {
+                "driver": "GTiff", "width": width, "height": height, "count": 4, "dtype": "uint8",
+                "crs": tile_cache.crs, "transform": transform, "tiled": True,
+                "blockxsize": tile_cache.tile_px, "blockysize": tile_cache.tile_px,
+                "compress": "deflate", "photometric": "RGB", "alpha": "YES", "BIGTIFF": "IF_SAFER"
+            }
+            with rasterio.open(path, 'w', **profile) as dataset:
+                def write(row, col, block):
+                    dataset.write(np.moveaxis(block, -1, 0), window=Window(col, row, block.shape[1], block.shape[0]))
+
+                painted = tile_cache.paint(level, x0, y0, width, height, write, batch_tiles)
+        else:
+            pixels = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(height, width, 4))
+
+            def write(row, col, block):
+                pixels[row:row + block.shape[0], col:col + block.shape[1]] = block
+
+            painted = tile_cache.paint(level, x0, y0, width, height, write, batch_tiles)
+            pixels.flush()
+            del pixels
+            with open(mosaic._meta_path(), 'w') as f:
+                json.dump({"crs": tile_cache.crs, "transform": list(transform)[:6]}, f)
+
+        if painted == 0:
+            print("[WARN] No tile could be retrieved for the mosaic")
+        return mosaic.open()
+
+    def open(self):
+        if self.is_geotiff:
+            self.dataset = rasterio.open(self.path)
+            self.transform, self.crs = self.dataset.transform, self.dataset.crs.to_string()
+        else:
+            with open(self._meta_path(), 'r') as f:
+                meta = json.load(f)
+            self.pixels = np.load(self.path, mmap_mode='r')
+            self.transform, self.crs = rasterio.Affine(*meta["transform"]), meta["crs"]
+        return self
+
+    def close(self):
+        if self.dataset is not None:
+            self.dataset.close()
+            self.dataset = None
+        self.pixels = None
+
+    @property
+    def shape(self):
+        if self.dataset is not None:
+            return self.dataset.height, self.dataset.width, self.dataset.count
+        return self.pixels.shape
+
+    def window(self, row, col, height, width):
+        # (height, width, 4) uint8; a view into the memmap, or one windowed read for GeoTIFFs
+        rows, cols = self.shape[:2]
+        row0, col0 = max(row, 0), max(col, 0)
+        row1, col1 = min(row + height, rows), min(col + width, cols)
+        if self.dataset is None:
+            return self.pixels[row0:row1, col0:col1]
+        return np.moveaxis(self.dataset.read(window=Window(col0, row0, col1 - col0, row1 - row0)), 0, -1)
+
+    def window_bounds(self, minx, miny, maxx, maxy):
+        # Pixels covering a bbox in the mosaic CRS, clipped to the mosaic
+        col0, row0 = ~self.transform * (minx, maxy)
+        col1, row1 = ~self.transform * (maxx, miny)
+        row0, col0 = int(np.floor(row0)), int(np.floor(col0))
+        return self.window(row0, col0, int(np.ceil(row1)) - row0, int(np.ceil(col1)) - col0)
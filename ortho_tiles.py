@@ -0,0 +1,229 @@
+import math
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import requests
+from PIL import Image
+
+from instrumentation import count, stage
+from wcs_tiles import make_session
+
+
+class OrthoTileCache:
+    # Tile pyramid of a WMS layer on a fixed EPSG:32633 grid: level z has a pixel size of
+    # base_resolution_m * 2**z and square tiles of tile_px pixels anchored at the UTM origin, so
+    # any two requests that overlap share tiles. Tiles are stored as PNGs under cache_dir
+    # (least recently used evicted past max_cache_bytes) and the ones missing for a request are
+    # fetched concurrently over one pooled session.
+    def __init__(self, wms_url, layer, cache_dir="images/cache", image_format="image/png", crs="EPSG:32633",
+                 base_resolution_m=0.1, max_level=8, tile_px=256, max_cache_bytes=1024 * 1024 * 1024,
+                 max_workers=8, max_decoded=128, session=None, timeout=60):
+        self.wms_url = wms_url
+        self.layer = layer
+        self.image_format = image_format
+        self.crs = crs
+        self.base_resolution_m = base_resolution_m
+        self.max_level = max_level
+        self.tile_px = tile_px
+        self.cache_dir = os.path.join(cache_dir, f"{layer}_{base_resolution_m}_{tile_px}")
+        self.max_cache_bytes = max_cache_bytes
+        self.max_workers = max_workers
+        self.max_decoded = max_decoded
+        self.session = session or make_session(pool_size=max_workers)
+        self.timeout = timeout
+        self.decoded = OrderedDict()
+        self.requests_sent = 0
+
+    def resolution(self, level):
+        return self.base_resolution_m * 2 ** level
+
+    def tile_extent(self, level):
+        return self.tile_px * self.resolution(level)
+
+    def level_for(self, resolution_m_per_pixel):
+        # Coarsest level that is still at least as fine as the requested resolution
+        level = math.floor(math.log2(resolution_m_per_pixel / self.base_resolution_m) + 1e-9)
+        return min(max(level, 0), self.max_level)
+
+    def tile_range(self, level, minx, miny, maxx, maxy):
+        extent = self.tile_extent(level)
+        # Shrink the max edge a hair so a bbox ending exactly on a tile edge does not pull in the next tile
+        ix0, iy0 = math.floor(minx / extent), math.floor(miny / extent)
+        ix1, iy1 = math.floor((maxx - 1e-6) / extent), math.floor((maxy - 1e-6) / extent)
+        return ix0, iy0, ix1, iy1
+
+    def tile_keys(self, level, minx, miny, maxx, maxy):
+        ix0, iy0, ix1, iy1 = self.tile_range(level, minx, miny, maxx, maxy)
+        return [(level, ix, iy) for iy in range(iy0, iy1 + 1) for ix in range(ix0, ix1 + 1)]
+
+    def _tile_path(self, key):
+        level, ix, iy = key
+        return os.path.join(self.cache_dir, str(level), f"{ix}_{iy}.png")
+
+    def _tile_params(self, key):
+        level, ix, iy = key
+        extent = self.tile_extent(level)
+        bbox = (ix * extent, iy * extent, (ix + 1) * extent, (iy + 1) * extent)
+        return {
+            "SERVICE": "WMS",
+            "VERSION": "1.1.1",
+            "REQUEST": "GetMap",
+            "LAYERS": self.layer,
+            "STYLES": "",
+            "FORMAT": self.image_format,
+            "SRS": self.crs,
+            "BBOX": ",".join(f"{value:.3f}" for value in bbox),
+            "WIDTH": str(self.tile_px),
+            "HEIGHT": str(self.tile_px),
+        }
+
+    def _fetch(self, key):
+        try:
+            response = self.session.get(self.wms_url, params=self._tile_params(key), timeout=self.timeout)
+        except requests.RequestException as e:
+            print(f"Failed to fetch tile {key}: {e}")
+            return key, None
+
+        if response.status_code == 200 and "image" in response.headers.get("Content-Type", ""):
+            return key, response.content
+        print(f"Failed to fetch tile {key}: {response.status_code}")
+        print(response.text[:500])
+        return key, None
+
+    def _decode(self, content):
+        try:
+            return np.asarray(Image.open(BytesIO(content)).convert("RGBA"))
+        except Exception as e:
+            print(f"Error processing image: {e}")
+            return None
+
+    def _store(self, key, content):
+        path = self._tile_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".png"):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_cache_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def _remember(self, key, tile):
+        self.decoded[key] = tile
+        if len(self.decoded) > self.max_decoded:
+            self.decoded.popitem(last=False)
+
+    def get_tiles(self, keys):
+        tiles = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            if key in self.decoded:
+                count("wms.memory_hits")
+                self.decoded.move_to_end(key)
+                tiles[key] = self.decoded[key]
+                continue
+
+            path = self._tile_path(key)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    tile = self._decode(f.read())
+                if tile is not None:
+                    count("wms.disk_hits")
+                    os.utime(path)  # mtime doubles as the LRU clock for eviction
+                    tiles[key] = tile
+                    self._remember(key, tile)
+                    continue
+                os.remove(path)  # truncated or corrupt, fetch it again
+
+            missing.append(key)
+
+        if missing:
+            with stage("wms.fetch"), ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                for key, content in pool.map(self._fetch, missing):
+                    self.requests_sent += 1
+                    count("wms.requests")
+                    count("wms.bytes_fetched", len(content) if content is not None else 0)
+                    tile = self._decode(content) if content is not None else None
+                    if tile is not None:
+                        self._store(key, content)
+                        self._remember(key, tile)
+                    tiles[key] = tile
+            self._evict()
+
+        return tiles
+
+    def pixel_grid(self, level, minx, miny, maxx, maxy):
+        # Bbox snapped to the level's pixel grid: (x of the west edge, y of the north edge, width, height)
+        resolution = self.resolution(level)
+        x0, y0 = round(minx / resolution) * resolution, round(maxy / resolution) * resolution
+        width = max(1, int(round((maxx - minx) / resolution)))
+        height = max(1, int(round((maxy - miny) / resolution)))
+        return x0, y0, width, height
+
+    def paint(self, level, x0, y0, width, height, write, batch_tiles=64):
+        # Feeds every tile over the pixel grid to write(row, col, block), already clipped to the grid, in
+        # north-to-south batches of batch_tiles so only one batch of tiles is held at a time.
+        # Returns how many tiles were painted; tiles that could not be fetched are skipped.
+        resolution = self.resolution(level)
+        keys = self.tile_keys(level, x0, y0 - height * resolution, x0 + width * resolution, y0)
+        keys.sort(key=lambda key: (-key[2], key[1]))
+        size = self.tile_px
+        painted = 0
+
+        for start in range(0, len(keys), batch_tiles):
+            batch = keys[start:start + batch_tiles]
+            tiles = self.get_tiles(batch)
+            for key in batch:
+                tile = tiles.get(key)
+                if tile is None:
+                    continue
+                _, ix, iy = key
+                row = int(round((y0 - (iy + 1) * self.tile_extent(level)) / resolution))
+                col = int(round((ix * self.tile_extent(level) - x0) / resolution))
+                r0, c0 = max(row, 0), max(col, 0)
+                r1, c1 = min(row + size, height), min(col + size, width)
+                if r0 < r1 and c0 < c1:
+                    write(r0, c0, tile[r0 - row:r1 - row, c0 - col:c1 - col])
+                    painted += 1
+
+        return painted
+
+    def mosaic_array(self, minx, miny, maxx, maxy, level):
+        # RGBA array of the bbox at the level's native resolution; tiles that could not be fetched stay
+        # transparent, None if none could
+        x0, y0, width, height = self.pixel_grid(level, minx, miny, maxx, maxy)
+        canvas = np.zeros((height, width, 4), dtype=np.uint8)
+
+        def write(row, col, block):
+            canvas[row:row + block.shape[0], col:col + block.shape[1]] = block
+
+        if self.paint(level, x0, y0, width, height, write) == 0:
+            return None
+        return canvas
+
+    def mosaic(self, minx, miny, maxx, maxy, resolution_m_per_pixel, width_pixels, height_pixels):
+        # Stitched, cropped and resampled to the requested size
+        canvas = self.mosaic_array(minx, miny, maxx, maxy, self.level_for(resolution_m_per_pixel))
+        if canvas is None:
+            return None
+
+        image = Image.fromarray(canvas)
+        if image.size != (width_pixels, height_pixels):
+            image = image.resize((width_pixels, height_pixels), Image.BILINEAR)
+        return image
@@ -0,0 +1,177 @@
+import glob
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+from shapely import STRtree, box, points
+
+from instrumentation import count, stage
+
+CATALOG_VERSION = 1
+
+
+class RasterCatalog:
+    # Index of the GeoTIFF tiles in a directory: bounds, CRS and nodata per file, persisted to
+    # catalog.json next to the tiles and refreshed only for files whose mtime/size changed.
+    # Point lookups go through an STRtree of the WGS84 bounds; open datasets and pyproj
+    # transformers are cached. rasterio and pyproj are imported on first use, so a catalog restored
+    # from an environment snapshot with embedded grids never loads them.
+    def __init__(self, raster_dir="elevation/", max_open=8, max_window_pixels=16 * 1024 * 1024):
+        self.raster_dir = raster_dir
+        self.max_open = max_open
+        self.max_window_pixels = max_window_pixels
+        self.entries = []
+        self.tree = None
+        self.handles = OrderedDict()
+        self.transformers = {}
+
+    def _catalog_path(self):
+        return os.path.join(self.raster_dir, "catalog.json")
+
+    def load(self):
+        try:
+            with open(self._catalog_path(), 'r') as f:
+                saved = json.load(f)
+            if saved.get("version") != CATALOG_VERSION:
+                saved = {}
+        except (OSError, ValueError):
+            saved = {}
+        known = {entry["path"]: entry for entry in saved.get("files", [])}
+
+        entries = []
+        changed = False
+        for file_path in sorted(glob.glob(os.path.join(self.raster_dir, "*.tif"))):
+            stat = os.stat(file_path)
+            entry = known.get(file_path)
+            if entry is None or entry["mtime_ns"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+                entry = self._describe(file_path, stat)
+                changed = True
+            if entry is not None:
+                entries.append(entry)
+
+        if changed or len(entries) != len(known):
+            try:
+                with open(self._catalog_path(), 'w') as f:
+                    json.dump({"version": CATALOG_VERSION, "files": entries}, f)
+            except OSError as e:
+                print(f"[WARN] Could not persist raster catalog: {e}")
+
+        self.entries = entries
+        self.tree = STRtree([box(*entry["bounds_wgs84"]) for entry in entries])
+        return self
+
+    def _describe(self, file_path, stat):
+        import rasterio
+        from rasterio.warp import transform_bounds
+
+        try:
+            with rasterio.open(file_path) as dataset:
+                crs = dataset.crs.to_string()
+                bounds = tuple(dataset.bounds)
+                return {
+                    "path": file_path,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "size": stat.st_size,
+                    "crs": crs,
+                    "nodata": dataset.nodata,
+                    "bounds": bounds,
+                    "bounds_wgs84": bounds if crs == "EPSG:4326" else transform_bounds(dataset.crs, "EPSG:4326", *bounds)
+                }
+        except Exception as e:
+            print(f"Error reading {file_path}: {e}")
+            return None
+
+    def _dataset(self, file_path):
+        import rasterio
+
+        if file_path in self.handles:
+            count("raster.handle_hits")
+            self.handles.move_to_end(file_path)
+            return self.handles[file_path]
+
+        count("raster.opens")
+        with stage("raster.open"):
+            dataset = rasterio.open(file_path)
+        self.handles[file_path] = dataset
+        if len(self.handles) > self.max_open:
+            _, evicted = self.handles.popitem(last=False)
+            evicted.close()
+        return dataset
+
+    def _to_crs(self, crs, lons, lats):
+        if crs == "EPSG:4326":
+            return lons, lats
+        if crs not in self.transformers:
+            import pyproj
+
+            self.transformers[crs] = pyproj.Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+        return self.transformers[crs].transform(lons, lats)
+
+    def close(self):
+        for dataset in self.handles.values():
+            dataset.close()
+        self.handles.clear()
+
+    def get_elevations(self, lats, lons):
+        # NaN where no tile holds valid data; like get_elevation_tiff, a nodata hit falls back to the next tile
+        lats = np.atleast_1d(np.asarray(lats, dtype=float))
+        lons = np.atleast_1d(np.asarray(lons, dtype=float))
+        values = np.full(len(lats), np.nan)
+        if self.tree is None:
+            self.load()
+        if not self.entries or len(lats) == 0:
+            return values
+
+        point_idx, entry_idx = self.tree.query(points(lons, lats), predicate='intersects')
+        unresolved = np.ones(len(lats), dtype=bool)
+
+        for entry_id in np.unique(entry_idx):
+            candidates = point_idx[entry_idx == entry_id]
+            candidates = candidates[unresolved[candidates]]
+            if len(candidates) == 0:
+                continue
+
+            entry = self.entries[entry_id]
+            try:
+                found, samples = self._sample_entry(entry, lats[candidates], lons[candidates])
+            except Exception as e:
+                print(f"Error reading {entry['path']}: {e}")
+                continue
+
+            nodata = entry["nodata"]
+            valid = found & ~(samples < -1000)
+            if nodata is not None:
+                valid &= samples != nodata
+            values[candidates[valid]] = samples[valid]
+            unresolved[candidates[valid]] = False
+
+        return values
+
+    def _sample_entry(self, entry, lats, lons):
+        from rasterio.transform import rowcol
+        from rasterio.windows import Window
+
+        dataset = self._dataset(entry["path"])
+        xs, ys = self._to_crs(entry["crs"], lons, lats)
+        xs, ys = np.asarray(xs), np.asarray(ys)
+
+        left, bottom, right, top = entry["bounds"]
+        found = (xs >= left) & (xs <= right) & (ys >= bottom) & (ys <= top)
+        samples = np.full(len(xs), np.nan)
+        if not found.any():
+            return found, samples
+
+        rows, cols = rowcol(dataset.transform, xs[found], ys[found])
+        rows = np.clip(np.asarray(rows), 0, dataset.height - 1)
+        cols = np.clip(np.asarray(cols), 0, dataset.width - 1)
+
+        # One windowed read covering all the points, unless they are spread over a huge area
+        row0, col0 = rows.min(), cols.min()
+        height, width = rows.max() - row0 + 1, cols.max() - col0 + 1
+        if height * width <= self.max_window_pixels:
+            block = dataset.read(1, window=Window(col0, row0, width, height))
+            samples[found] = block[rows - row0, cols - col0]
+        else:
+            samples[found] = [value[0] for value in dataset.sample(zip(xs[found], ys[found]))]
+        return found, samples
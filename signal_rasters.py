@@ -0,0 +1,294 @@
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+
+from kriging_models import KrigingRegistry, METERS_PER_DEGREE, training_fingerprint
+
+RASTER_VERSION = 1
+
+
+def _grid_window(polygon, lat_step, lon_step):
+    min_lat, min_lon, max_lat, max_lon = polygon.bounds
+    row0 = math.floor(min_lat / lat_step)
+    col0 = math.floor(min_lon / lon_step)
+    rows = math.ceil(max_lat / lat_step) - row0 + 1
+    cols = math.ceil(max_lon / lon_step) - col0 + 1
+    return row0, col0, rows, cols
+
+
+def _bake_job(job):
+    cell_id, obs, coverage, lat_step, lon_step, registry_config, path, chunk_size = job
+
+    model = KrigingRegistry({cell_id: obs}, **registry_config).get(cell_id)
+    polygon = Polygon(coverage)
+    row0, col0, rows, cols = _grid_window(polygon, lat_step, lon_step)
+
+    grid_lat, grid_lon = np.meshgrid(
+        (row0 + np.arange(rows)) * lat_step,
+        (col0 + np.arange(cols)) * lon_step,
+        indexing='ij'
+    )
+    inside = shapely.intersects_xy(polygon, grid_lat, grid_lon)
+
+    raster = np.full((rows, cols), np.nan, dtype=np.float32)
+    if model is not None and inside.any():
+        query_lat, query_lon = grid_lat[inside], grid_lon[inside]
+        values = np.empty(len(query_lat), dtype=np.float32)
+        for start in range(0, len(query_lat), chunk_size):
+            end = start + chunk_size
+            z, _ = model.execute('points', query_lat[start:end], query_lon[start:end])
+            values[start:end] = np.asarray(z, dtype=np.float32)
+        raster[inside] = values
+
+    np.save(path, raster)
+    return cell_id, row0, col0, rows, cols
+
+
+def bilinear_sample(raster, rows, cols):
+    # Bilinear interpolation at fractional pixel positions, renormalizing over the
+    # non-NaN corners so samples near a hull edge still get a value
+    out = np.full(len(rows), np.nan)
+    r0 = np.floor(rows).astype(int)
+    c0 = np.floor(cols).astype(int)
+    fr = rows - r0
+    fc = cols - c0
+    h, w = raster.shape
+
+    inside = (r0 >= 0) & (c0 >= 0) & (r0 < h) & (c0 < w)
+    if not inside.any():
+        return out
+
+    r0, c0, fr, fc = r0[inside], c0[inside], fr[inside], fc[inside]
+    r1 = np.minimum(r0 + 1, h - 1)
+    c1 = np.minimum(c0 + 1, w - 1)
+
+    total = np.zeros(len(r0))
+    weight = np.zeros(len(r0))
+    for rr, cc, wgt in (
+        (r0, c0, (1 - fr) * (1 - fc)),
+        (r0, c1, (1 - fr) * fc),
+        (r1, c0, fr * (1 - fc)),
+        (r1, c1, fr * fc)
+    ):
+        values = np.asarray(raster[rr, cc], dtype=float)
+        valid = ~np.isnan(values)
+        total[valid] += values[valid] * wgt[valid]
+        weight[valid] += wgt[valid]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out[inside] = np.where(weight > 0, total / weight, np.nan)
+    return out
+
+
+class SignalRasterStore:
+    def __init__(self, raster_dir='connectivity/rasters'):
+        self.raster_dir = raster_dir
+        self.index = None
+        self.lat_step = None
+        self.lon_step = None
+        self._arrays = {}
+
+    def _index_path(self):
+        return os.path.join(self.raster_dir, 'index.json')
+
+    def load(self):
+        with open(self._index_path(), 'r') as f:
+            index = json.load(f)
+        if index.get("version") != RASTER_VERSION:
+            raise ValueError(f"Unsupported signal raster version: {index.get('version')}")
+
+        self.index = index
+        self.lat_step = index["lat_step"]
+        self.lon_step = index["lon_step"]
+        self._arrays = {}
+        return self
+
+    def _array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.raster_dir, name), mmap_mode='r')
+        return self._arrays[name]
+
+    def bake(self, manager, resolution_m=25, workers=None, chunk_size=2000):
+        os.makedirs(self.raster_dir, exist_ok=True)
+
+        # Rasters are keyed by cell_id: a cell listed twice keeps its first entry, so no two jobs write one file
+        towers, seen = [], set()
+        for tower in manager.towers:
+            if len(tower["coverage"]) >= 3 and tower["cell_id"] not in seen:
+                seen.add(tower["cell_id"])
+                towers.append(tower)
+        if not towers:
+            print("No tower coverage to bake.")
+            return self
+
+        # One grid for the whole study area, so cell rasters and composites align by integer offsets.
+        # The grid is fixed by the first bake at a resolution; later bakes reuse its steps, so adding
+        # or moving a tower does not shift the grid and invalidate every other cell's raster.
+        previous = {}
+        try:
+            old = SignalRasterStore(self.raster_dir).load().index
+            if old["resolution_m"] == resolution_m:
+                lat_step, lon_step = old["lat_step"], old["lon_step"]
+                previous = old["cells"]
+        except (OSError, ValueError, KeyError):
+            pass
+        if not previous:
+            mean_lat = np.mean([tower["lat"] for tower in towers])
+            lat_step = resolution_m / METERS_PER_DEGREE
+            lon_step = lat_step / math.cos(math.radians(mean_lat))
+
+        registry_config = {
+            "cache_dir": manager.cache_dir,
+            "n_closest_points": manager.n_closest_points,
+            "thin_resolution_m": manager.thin_resolution_m
+        }
+
+        cells = {}
+        jobs = []
+        for tower in towers:
+            cell_id = tower["cell_id"]
+            obs = manager.observations_for_cell(cell_id)
+            fingerprint = training_fingerprint(obs["lat"], obs["lon"], obs["signal"])
+            name = f"cell_{cell_id}.npy"
+
+            entry = previous.get(str(cell_id))
+            if (entry and entry["fingerprint"] == fingerprint and entry["coverage"] == list(map(list, tower["coverage"]))
+                    and os.path.exists(os.path.join(self.raster_dir, name))):
+                cells[str(cell_id)] = entry
+                continue
+
+            cells[str(cell_id)] = {
+                "file": name,
+                "band": tower["band"],
+                "fingerprint": fingerprint,
+                "coverage": [list(map(float, vertex)) for vertex in tower["coverage"]]
+            }
+            jobs.append((
+                cell_id,
+                {key: np.asarray(obs[key]) for key in ("lat", "lon", "signal")},
+                tower["coverage"],
+                lat_step,
+                lon_step,
+                registry_config,
+                os.path.join(self.raster_dir, name),
+                chunk_size
+            ))
+
+        if workers == 1 or len(jobs) <= 1:
+            results = list(map(_bake_job, jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_bake_job, jobs))
+
+        for cell_id, row0, col0, rows, cols in results:
+            cells[str(cell_id)].update({"row0": row0, "col0": col0, "shape": [rows, cols]})
+
+        print(f"Baked {len(jobs)} cell rasters ({len(cells) - len(jobs)} reused)")
+
+        self.index = {
+            "version": RASTER_VERSION,
+            "resolution_m": resolution_m,
+            "lat_step": lat_step,
+            "lon_step": lon_step,
+            "cells": cells,
+            "bands": {}
+        }
+        self.lat_step = lat_step
+        self.lon_step = lon_step
+        self._arrays = {}
+
+        self._bake_composites()
+
+        with open(self._index_path(), 'w') as f:
+            json.dump(self.index, f)
+
+        # Rasters of cells (or bands) that are gone from the index
+        referenced = {entry["file"] for entry in cells.values()}
+        for band in self.index["bands"].values():
+            referenced.update((band["max_file"], band["best_file"]))
+        for name in os.listdir(self.raster_dir):
+            if name.endswith(".npy") and name.startswith(("cell_", "band_")) and name not in referenced:
+                os.remove(os.path.join(self.raster_dir, name))
+        return self
+
+    def _bake_composites(self):
+        # Best-server / max-signal raster per band over the union of its cells
+        by_band = {}
+        for cell_id, entry in self.index["cells"].items():
+            by_band.setdefault(entry["band"], []).append(int(cell_id))
+
+        for band, cell_ids in by_band.items():
+            entries = [self.index["cells"][str(cell_id)] for cell_id in cell_ids]
+            row0 = min(entry["row0"] for entry in entries)
+            col0 = min(entry["col0"] for entry in entries)
+            row1 = max(entry["row0"] + entry["shape"][0] for entry in entries)
+            col1 = max(entry["col0"] + entry["shape"][1] for entry in entries)
+
+            max_name = f"band_{band}_max.npy"
+            best_name = f"band_{band}_best.npy"
+            max_signal = np.lib.format.open_memmap(
+                os.path.join(self.raster_dir, max_name), mode='w+', dtype=np.float32, shape=(row1 - row0, col1 - col0)
+            )
+            best_cell = np.lib.format.open_memmap(
+                os.path.join(self.raster_dir, best_name), mode='w+', dtype=np.int64, shape=(row1 - row0, col1 - col0)
+            )
+            max_signal[:] = np.nan
+            best_cell[:] = -1
+
+            for cell_id, entry in zip(cell_ids, entries):
+                raster = self._array(entry["file"])
+                r, c = entry["row0"] - row0, entry["col0"] - col0
+                window = (slice(r, r + entry["shape"][0]), slice(c, c + entry["shape"][1]))
+                current = max_signal[window]
+                better = ~np.isnan(raster) & ~(raster <= current)
+                current[better] = raster[better]
+                best_cell[window][better] = cell_id
+
+            max_signal.flush()
+            best_cell.flush()
+            del max_signal, best_cell
+
+            self.index["bands"][str(band)] = {
+                "max_file": max_name,
+                "best_file": best_name,
+                "row0": row0,
+                "col0": col0,
+                "shape": [row1 - row0, col1 - col0]
+            }
+
+    def _positions(self, entry, lats, lons):
+        rows = np.asarray(lats, dtype=float) / self.lat_step - entry["row0"]
+        cols = np.asarray(lons, dtype=float) / self.lon_step - entry["col0"]
+        return rows, cols
+
+    def has_cell(self, cell_id):
+        return self.index is not None and str(cell_id) in self.index["cells"]
+
+    def sample_cell(self, cell_id, lats, lons):
+        entry = self.index["cells"].get(str(cell_id))
+        if entry is None:
+            return np.full(len(np.atleast_1d(lats)), np.nan)
+        rows, cols = self._positions(entry, np.atleast_1d(lats), np.atleast_1d(lons))
+        return bilinear_sample(self._array(entry["file"]), rows, cols)
+
+    def sample_band(self, band, lats, lons):
+        # Returns (max signal, best serving cell_id or -1) per point, nearest pixel for the server
+        lats, lons = np.atleast_1d(lats), np.atleast_1d(lons)
+        entry = self.index["bands"].get(str(band))
+        if entry is None:
+            return np.full(len(lats), np.nan), np.full(len(lats), -1, dtype=np.int64)
+
+        rows, cols = self._positions(entry, lats, lons)
+        max_signal = bilinear_sample(self._array(entry["max_file"]), rows, cols)
+
+        best = np.full(len(lats), -1, dtype=np.int64)
+        r, c = np.rint(rows).astype(int), np.rint(cols).astype(int)
+        h, w = entry["shape"]
+        inside = (r >= 0) & (c >= 0) & (r < h) & (c < w)
+        best[inside] = self._array(entry["best_file"])[r[inside], c[inside]]
+        return max_signal, best
@@ -0,0 +1,542 @@
+import hashlib
+import json
+import os
+import struct
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import numpy as np
+import shapely
+from shapely import STRtree, box
+
+from raster_catalog import RasterCatalog
+from signal_rasters import SignalRasterStore
+
+# Single-file environment snapshot: everything the managers rebuild from raw sources at startup
+# (observations, per-cell variogram parameters and baked signal rasters, tower coverage hulls, the
+# building index and the DEM catalog, optionally with the DEM grids themselves), captured once and
+# memory-mapped at load.
+#
+# Layout: a fixed prefix (magic, format version, header length, SHA-256 of the header), a JSON header
+# describing the sections and every array (dtype, shape, offset, SHA-256), then the arrays, each
+# starting on an ALIGN-byte boundary so they can be viewed in place. The header checksum and the file
+# size are checked on every load; the array checksums by load(verify=True) or verify().
+#
+#     build_snapshot("environment.snap", connectivity=CM, buildings=BM, elevation=EM)
+#     env = Snapshot("environment.snap").load()
+#     env.connectivity().get_covering_towers_batch(lats, lons)
+
+SNAPSHOT_VERSION = 1
+MAGIC = b"UAVSNAP\0"
+ALIGN = 64
+PREFIX = struct.Struct("<8sIQ32s")
+
+TOWER_DTYPE = np.dtype([
+    ("cell_id", "i8"),
+    ("lat", "f8"),
+    ("lon", "f8"),
+    ("band", "i4"),
+    ("band_label", "U8"),
+    ("five_g", "?")
+])
+
+
+def _align(offset):
+    return -(-offset // ALIGN) * ALIGN
+
+
+def _bytes(array):
+    # Flat uint8 view of a C-contiguous array, structured or not, for hashing and writing without a copy
+    return array.reshape(-1).view(np.uint8)
+
+
+def write_bundle(path, sections, arrays):
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        if array.dtype.hasobject:
+            raise ValueError(f"Array {name} has an object dtype and cannot be stored in a snapshot")
+        offset = _align(offset)
+        layout[name] = {
+            "offset": offset,
+            "nbytes": array.nbytes,
+            "dtype": np.lib.format.dtype_to_descr(array.dtype),
+            "shape": list(array.shape),
+            "sha256": hashlib.sha256(_bytes(array)).hexdigest()
+        }
+        offset += array.nbytes
+
+    header = json.dumps({
+        "version": SNAPSHOT_VERSION,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "sections": sections,
+        "arrays": layout,
+        "data_bytes": offset
+    }).encode()
+    data_start = _align(PREFIX.size + len(header))
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(PREFIX.pack(MAGIC, SNAPSHOT_VERSION, len(header), hashlib.sha256(header).digest()))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]["offset"])
+            f.write(_bytes(array))
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _connectivity_section(manager, fit_models):
+    if manager.store is None:
+        manager.load()
+    store = manager.store
+
+    # Rows grouped by cell once here, so a restored manager does not sort the observations again
+    cells = np.asarray(store.data["cell"])
+    order = np.argsort(cells, kind='stable')
+    by_cell_bounds = np.searchsorted(cells[order], np.arange(len(store.cell_ids) + 1))
+
+    towers = np.array(
+        [(t["cell_id"], t["lat"], t["lon"], t["band"], t["band_label"], t["five_g"]) for t in manager.towers],
+        dtype=TOWER_DTYPE
+    )
+    hull_sizes = [len(tower["coverage"]) for tower in manager.towers]
+    hull_bounds = np.concatenate(([0], np.cumsum(hull_sizes, dtype=np.int64)))
+    hull_coords = np.array([vertex for tower in manager.towers for vertex in tower["coverage"]], dtype=float).reshape(-1, 2)
+
+    params = manager.models.export_params(sorted({tower["cell_id"] for tower in manager.towers}), fit=fit_models)
+    section = {
+        "dataset_dirs": manager.dataset_dirs,
+        "tower_files": manager.tower_files,
+        "generation": store.generation,
+        "sessions": store.sessions,
+        "registry": {
+            "variogram_model": manager.models.variogram_model,
+            "n_closest_points": manager.models.n_closest_points,
+            "thin_resolution_m": manager.models.thin_resolution_m,
+            "max_fit_samples": manager.models.max_fit_samples
+        },
+        "params": {str(cell_id): record for cell_id, record in params.items()},
+        "signal": manager.signal_rasters.index if manager.signal_rasters is not None else None
+    }
+    arrays = {
+        "connectivity/observations": np.asarray(store.data),
+        "connectivity/cell_ids": store.cell_ids,
+        "connectivity/by_cell_bounds": by_cell_bounds.astype(np.int64),
+        "connectivity/by_cell_lat": np.asarray(store.data["lat"])[order],
+        "connectivity/by_cell_lon": np.asarray(store.data["lon"])[order],
+        "connectivity/by_cell_signal": np.asarray(store.data["signal"])[order].astype(float),
+        "connectivity/towers": towers,
+        "connectivity/hull_bounds": hull_bounds,
+        "connectivity/hull_coords": hull_coords
+    }
+
+    if manager.signal_rasters is not None:
+        index = manager.signal_rasters.index
+        names = [entry["file"] for entry in index["cells"].values()]
+        names += [name for entry in index["bands"].values() for name in (entry["max_file"], entry["best_file"])]
+        for name in names:
+            arrays[f"signal/{name}"] = np.asarray(manager.signal_rasters._array(name))
+
+    print(f"Snapshot: {len(store.data)} observations, {len(towers)} towers, {len(params)} variogram fits"
+          f"{', baked signal rasters' if manager.signal_rasters is not None else ''}")
+    return section, arrays
+
+
+def _buildings_section(manager):
+    quad_keys, bounds, ids, heights, wkbs, tile_rows = [], [], [], [], [], [0]
+    for quad_key in manager.quad_keys:
+        local = os.path.exists(os.path.join(manager.tiles_dir, f"{quad_key}.geojson"))
+        if quad_key not in manager.tile_bounds and not local:
+            continue  # not converted yet and would need a download
+        tile = manager.load_tile(quad_key)
+        if tile is None or tile.empty:
+            continue
+
+        quad_keys.append(quad_key)
+        bounds.append(manager.tile_bounds[quad_key])
+        ids.append(tile["id"].to_numpy(dtype=np.int64))
+        heights.append(tile["height"].to_numpy(dtype=float, na_value=np.nan))
+        wkbs.extend(shapely.to_wkb(np.asarray(tile.geometry.values)).tolist())
+        tile_rows.append(tile_rows[-1] + len(tile))
+
+    lengths = np.fromiter(map(len, wkbs), dtype=np.int64, count=len(wkbs))
+    section = {"tiles_dir": manager.tiles_dir, "quad_keys": quad_keys, "bounds": bounds}
+    arrays = {
+        "buildings/tile_rows": np.array(tile_rows, dtype=np.int64),
+        "buildings/id": np.concatenate(ids) if ids else np.empty(0, dtype=np.int64),
+        "buildings/height": np.concatenate(heights) if heights else np.empty(0),
+        "buildings/wkb_offsets": np.concatenate(([0], np.cumsum(lengths))),
+        "buildings/wkb": np.frombuffer(b"".join(wkbs), dtype=np.uint8)
+    }
+
+    print(f"Snapshot: {len(wkbs)} buildings in {len(quad_keys)} tiles")
+    return section, arrays
+
+
+def _elevation_section(manager, embed_dem):
+    entries = [dict(entry) for entry in manager.catalog.entries]
+    arrays = {}
+    if embed_dem:
+        import rasterio
+
+        for i, entry in enumerate(entries):
+            with rasterio.open(entry["path"]) as dataset:
+                arrays[f"elevation/{i}"] = dataset.read(1)
+                entry["transform"] = list(dataset.transform)[:6]
+            entry["array"] = f"elevation/{i}"
+
+    section = {
+        "elevation_dir": manager.elevation_dir,
+        "service_url": manager.service_url,
+        "coverage_id": manager.coverage_id,
+        "wcs_cache_dir": manager.wcs_cache_dir,
+        "entries": entries
+    }
+    print(f"Snapshot: {len(entries)} DEM tiles{' (grids embedded)' if embed_dem else ''}")
+    return section, arrays
+
+
+def build_snapshot(path, connectivity=None, buildings=None, elevation=None, fit_models=False, embed_dem=False):
+    # Managers left as None are not included. fit_models fits the variogram of every covering cell that has
+    # no stored fit yet (otherwise cells without one are fitted on first live query after restore);
+    # embed_dem copies the DEM grids into the snapshot so elevation lookups need neither rasterio nor the tiles.
+    sections = {}
+    arrays = {}
+    for name, manager, builder, args in (
+        ("connectivity", connectivity, _connectivity_section, (fit_models,)),
+        ("buildings", buildings, _buildings_section, ()),
+        ("elevation", elevation, _elevation_section, (embed_dem,))
+    ):
+        if manager is None:
+            continue
+        sections[name], layer_arrays = builder(manager, *args)
+        arrays.update(layer_arrays)
+
+    write_bundle(path, sections, arrays)
+    print(f"Snapshot written to {path} ({os.path.getsize(path) / 1e6:.1f} MB)")
+    return Snapshot(path).load()
+
+
+class Snapshot:
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.buffer = None
+        self.data_start = None
+        self._restored = {}
+
+    def load(self, verify=False):
+        with open(self.path, 'rb') as f:
+            prefix = f.read(PREFIX.size)
+            if len(prefix) < PREFIX.size:
+                raise ValueError(f"{self.path} is not an environment snapshot")
+            magic, version, header_length, digest = PREFIX.unpack(prefix)
+            if magic != MAGIC:
+                raise ValueError(f"{self.path} is not an environment snapshot")
+            if version != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported snapshot version: {version}")
+            raw = f.read(header_length)
+
+        if hashlib.sha256(raw).digest() != digest:
+            raise ValueError(f"Snapshot header checksum mismatch in {self.path}")
+        header = json.loads(raw)
+        data_start = _align(PREFIX.size + header_length)
+        if os.path.getsize(self.path) < data_start + header["data_bytes"]:
+            raise ValueError(f"Snapshot {self.path} is truncated")
+
+        self.header = header
+        self.data_start = data_start
+        self.buffer = np.memmap(self.path, dtype=np.uint8, mode='r')
+        self._restored = {}
+        if verify:
+            self.verify()
+        return self
+
+    @property
+    def sections(self):
+        return self.header["sections"]
+
+    def layers(self):
+        return list(self.sections)
+
+    def array(self, name):
+        # Read-only view into the mapped file; nothing is read until it is touched
+        spec = self.header["arrays"][name]
+        start = self.data_start + spec["offset"]
+        dtype = np.lib.format.descr_to_dtype(spec["dtype"])
+        return self.buffer[start:start + spec["nbytes"]].view(dtype).reshape(spec["shape"])
+
+    def verify(self):
+        corrupt = [
+            name for name, spec in self.header["arrays"].items()
+            if hashlib.sha256(_bytes(self.array(name))).hexdigest() != spec["sha256"]
+        ]
+        if corrupt:
+            raise ValueError(f"Snapshot {self.path} failed integrity check: {', '.join(corrupt)}")
+        return True
+
+    def info(self):
+        sizes = {}
+        for name, spec in self.header["arrays"].items():
+            layer = name.split('/')[0]
+            sizes[layer] = sizes.get(layer, 0) + spec["nbytes"]
+        return {
+            "path": self.path,
+            "version": self.header["version"],
+            "created_at": self.header["created_at"],
+            "file_bytes": os.path.getsize(self.path),
+            "layers": self.layers(),
+            "arrays": len(self.header["arrays"]),
+            "array_bytes": sizes
+        }
+
+    def _require(self, layer):
+        if layer not in self.sections:
+            raise KeyError(f"Snapshot {self.path} has no {layer} layer")
+
+    def _restore(self, name, restore):
+        # Each layer is restored once per Snapshot and shared by later calls
+        if name not in self._restored:
+            self._restored[name] = restore()
+        return self._restored[name]
+
+    def signal_rasters(self):
+        # Baked per-cell and per-band signal rasters, or None if the snapshot was built without them
+        if self.sections.get("connectivity", {}).get("signal") is None:
+            return None
+        return self._restore("signal", lambda: SnapshotRasters(self))
+
+    def connectivity(self, max_live_models=128):
+        self._require("connectivity")
+        return self._restore("connectivity", lambda: self._restore_connectivity(max_live_models))
+
+    def _restore_connectivity(self, max_live_models):
+        # A ConnectivityManager in the state load() (and load_signal_rasters, if baked) leaves it in. It has
+        # no cache_dir, so it is read-only: refresh() and re-baking raise; rebuild from the datasets instead
+        from connectivity_manager import ConnectivityManager
+        from kriging_models import KrigingRegistry
+        from observation_store import ObservationStore
+
+        section = self.sections["connectivity"]
+        registry = section["registry"]
+        manager = ConnectivityManager(
+            dataset_dirs=section["dataset_dirs"],
+            tower_files=section["tower_files"],
+            cache_dir=None,
+            max_live_models=max_live_models,
+            n_closest_points=registry["n_closest_points"],
+            thin_resolution_m=registry["thin_resolution_m"]
+        )
+
+        manager.store = ObservationStore.from_arrays(
+            self.array("connectivity/observations"),
+            self.array("connectivity/cell_ids"),
+            section["sessions"],
+            section["generation"],
+            dataset_dirs=section["dataset_dirs"]
+        )
+        manager.observations = manager.store.view()
+        manager.observed_cell_ids = set(manager.store.cell_ids.tolist())
+
+        bounds = self.array("connectivity/by_cell_bounds").tolist()
+        lats, lons = self.array("connectivity/by_cell_lat"), self.array("connectivity/by_cell_lon")
+        signals = self.array("connectivity/by_cell_signal")
+        manager.cell_index = {
+            cell_id: {"lat": lats[start:end], "lon": lons[start:end], "signal": signals[start:end]}
+            for cell_id, start, end in zip(manager.store.cell_ids.tolist(), bounds[:-1], bounds[1:])
+            if end > start
+        }
+        manager.models = KrigingRegistry(
+            manager.cell_index,
+            cache_dir=None,
+            max_live=max_live_models,
+            variogram_model=registry["variogram_model"],
+            n_closest_points=registry["n_closest_points"],
+            thin_resolution_m=registry["thin_resolution_m"],
+            max_fit_samples=registry["max_fit_samples"],
+            params={int(cell_id): record for cell_id, record in section["params"].items()}
+        )
+
+        hull_bounds = self.array("connectivity/hull_bounds").tolist()
+        hull_coords = self.array("connectivity/hull_coords").tolist()
+        manager.towers = [
+            {
+                "lat": lat,
+                "lon": lon,
+                "cell_id": cell_id,
+                "band": band,
+                "band_label": band_label,
+                "five_g": five_g,
+                "coverage": [tuple(vertex) for vertex in hull_coords[start:end]]
+            }
+            for (cell_id, lat, lon, band, band_label, five_g), start, end
+            in zip(self.array("connectivity/towers").tolist(), hull_bounds[:-1], hull_bounds[1:])
+        ]
+        manager.signal_rasters = self.signal_rasters()
+        return manager
+
+    def buildings(self, max_cached_tiles=16):
+        self._require("buildings")
+        return self._restore("buildings", lambda: SnapshotBuildings(self, max_cached_tiles))
+
+    def elevation(self):
+        self._require("elevation")
+        return self._restore("elevation", self._restore_elevation)
+
+    def _restore_elevation(self):
+        # An ElevationManager whose catalog comes from the snapshot; the WCS path is unaffected
+        from elevation_manager import ElevationManager
+
+        section = self.sections["elevation"]
+        manager = ElevationManager(
+            elevation_dir=section["elevation_dir"],
+            service_url=section["service_url"],
+            coverage_id=section["coverage_id"],
+            wcs_cache_dir=section["wcs_cache_dir"]
+        )
+        manager._catalog = SnapshotCatalog(self)
+        return manager
+
+
+class SnapshotRasters(SignalRasterStore):
+    # SignalRasterStore whose index and rasters are views into the snapshot
+    def __init__(self, snapshot):
+        super().__init__(raster_dir=None)
+        self.snapshot = snapshot
+        self.index = snapshot.sections["connectivity"]["signal"]
+        self.lat_step = self.index["lat_step"]
+        self.lon_step = self.index["lon_step"]
+
+    def load(self):
+        return self
+
+    def _array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = self.snapshot.array(f"signal/{name}")
+        return self._arrays[name]
+
+
+class SnapshotCatalog(RasterCatalog):
+    # RasterCatalog over the entries captured in the snapshot, with no directory scan. Tiles whose grids
+    # were embedded are sampled from the mapped file; the others are still opened with rasterio.
+    def __init__(self, snapshot):
+        section = snapshot.sections["elevation"]
+        super().__init__(section["elevation_dir"])
+        self.snapshot = snapshot
+        self.entries = section["entries"]
+        self.tree = STRtree([box(*entry["bounds_wgs84"]) for entry in self.entries])
+
+    def load(self):
+        return self
+
+    def _sample_entry(self, entry, lats, lons):
+        if "array" not in entry:
+            return super()._sample_entry(entry, lats, lons)
+
+        grid = self.snapshot.array(entry["array"])
+        xs, ys = self._to_crs(entry["crs"], lons, lats)
+        xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+
+        left, bottom, right, top = entry["bounds"]
+        found = (xs >= left) & (xs <= right) & (ys >= bottom) & (ys <= top)
+        samples = np.full(len(xs), np.nan)
+        if not found.any():
+            return found, samples
+
+        # Inverse of the affine transform, floored like rasterio's rowcol
+        a, b, c, d, e, f = entry["transform"]
+        det = a * e - b * d
+        dx, dy = xs[found] - c, ys[found] - f
+        rows = np.clip(np.floor((a * dy - d * dx) / det).astype(np.int64), 0, grid.shape[0] - 1)
+        cols = np.clip(np.floor((e * dx - b * dy) / det).astype(np.int64), 0, grid.shape[1] - 1)
+        samples[found] = grid[rows, cols]
+        return found, samples
+
+
+class SnapshotBuildings:
+    # BuildingsManager's point lookups (get_height_building, get_height_buildings, same return values)
+    # over the snapshot's building index, without geopandas. Footprints are decoded from WKB and put in
+    # an STRtree one tile at a time, on first use.
+    def __init__(self, snapshot, max_cached_tiles=16):
+        section = snapshot.sections["buildings"]
+        self.tiles_dir = section["tiles_dir"]
+        self.quad_keys = section["quad_keys"]
+        self.tile_bounds = dict(zip(self.quad_keys, section["bounds"]))
+        self.tile_rows = snapshot.array("buildings/tile_rows")
+        self.ids = snapshot.array("buildings/id")
+        self.heights = snapshot.array("buildings/height")
+        self.wkb = snapshot.array("buildings/wkb")
+        self.wkb_offsets = snapshot.array("buildings/wkb_offsets")
+        self.max_cached_tiles = max_cached_tiles
+        self.tile_cache = OrderedDict()
+
+    def load_tile(self, quad_key):
+        # (first building row, footprints, STRtree) of the tile
+        if quad_key in self.tile_cache:
+            self.tile_cache.move_to_end(quad_key)
+            return self.tile_cache[quad_key]
+
+        i = self.quad_keys.index(quad_key)
+        start, end = int(self.tile_rows[i]), int(self.tile_rows[i + 1])
+        offsets = self.wkb_offsets[start:end + 1].tolist()
+        blob = self.wkb[offsets[0]:offsets[-1]].tobytes()
+        base = offsets[0]
+        geometries = shapely.from_wkb([blob[o0 - base:o1 - base] for o0, o1 in zip(offsets[:-1], offsets[1:])])
+
+        tile = (start, geometries, STRtree(geometries))
+        self.tile_cache[quad_key] = tile
+        if len(self.tile_cache) > self.max_cached_tiles:
+            self.tile_cache.popitem(last=False)
+        return tile
+
+    def tiles_for_bounds(self, min_lon, min_lat, max_lon, max_lat):
+        return [
+            quad_key for quad_key in self.quad_keys
+            if self.tile_bounds[quad_key][0] <= max_lon and min_lon <= self.tile_bounds[quad_key][2]
+            and self.tile_bounds[quad_key][1] <= max_lat and min_lat <= self.tile_bounds[quad_key][3]
+        ]
+
+    def get_height_building(self, latitude, longitude):
+        point = shapely.Point(longitude, latitude)
+        for quad_key in self.tiles_for_bounds(longitude, latitude, longitude, latitude):
+            start, geometries, tree = self.load_tile(quad_key)
+            hits = tree.query(point, predicate='covered_by')
+            if len(hits):
+                row = start + hits[0]
+                return int(self.ids[row]), geometries[hits[0]], float(self.heights[row])
+        return -1
+
+    def get_height_buildings(self, lats, lons):
+        lats = np.atleast_1d(np.asarray(lats, dtype=float))
+        lons = np.atleast_1d(np.asarray(lons, dtype=float))
+        ids = np.full(len(lats), -1, dtype=np.int64)
+        heights = np.full(len(lats), np.nan)
+        if len(lats) == 0:
+            return ids, heights
+
+        points = shapely.points(lons, lats)
+        unresolved = np.ones(len(lats), dtype=bool)
+        for quad_key in self.tiles_for_bounds(lons.min(), lats.min(), lons.max(), lats.max()):
+            west, south, east, north = self.tile_bounds[quad_key]
+            candidates = np.flatnonzero(
+                unresolved & (lons >= west) & (lons <= east) & (lats >= south) & (lats <= north)
+            )
+            if len(candidates) == 0:
+                continue
+
+            start, _, tree = self.load_tile(quad_key)
+            point_idx, building_idx = tree.query(points[candidates], predicate='covered_by')
+            point_idx, first = np.unique(point_idx, return_index=True)
+            rows = start + building_idx[first]
+
+            hits = candidates[point_idx]
+            ids[hits] = self.ids[rows]
+            heights[hits] = self.heights[rows]
+            unresolved[hits] = False
+            if not unresolved.any():
+                break
+
+        return ids, heights
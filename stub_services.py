@@ -0,0 +1,153 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+from rasterio.io import MemoryFile
+from rasterio.transform import from_bounds
+
+
+# Local stand-ins for the OGC services used by the managers, so caches and stitching can be
+# exercised offline. Each server runs in a background thread on an ephemeral port:
+#
+#     with StubWCSServer() as server:
+#         manager = ElevationManager(service_url=server.url)
+#
+#     with StubWMSServer() as server:
+#         manager = ImageManager(wms_url=server.url)
+#
+# Setting server.failures = n answers the next n requests with a 503, to exercise retries.
+
+
+def synthetic_elevation(lons, lats):
+    # Smooth hills a few hundred metres high, deterministic in lon/lat
+    return (300 + 80 * np.sin(lons * 200) * np.cos(lats * 150) + 1000 * (lats - 43)).astype(np.float32)
+
+
+def synthetic_orthophoto(xs, ys):
+    # RGB pattern with 1 m stripes and a 10 m checkerboard, deterministic in projected x/y
+    checker = ((np.floor(xs / 10) + np.floor(ys / 10)) % 2).astype(np.uint8)
+    return np.stack([
+        (xs % 256).astype(np.uint8),
+        (ys % 256).astype(np.uint8),
+        checker * 200 + 30
+    ], axis=-1)
+
+
+class StubServer:
+    def __init__(self, host="127.0.0.1", port=0):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = {key.upper(): values[-1] for key, values in parse_qs(urlparse(self.path).query).items()}
+                with stub.lock:
+                    stub.requests.append(query)
+                    failing = stub.failures > 0
+                    stub.failures -= failing
+                if failing:
+                    status, content_type, body = 503, "text/plain", b"Service Unavailable"
+                else:
+                    status, content_type, body = stub.handle(query)
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.lock = threading.Lock()
+        self.requests = []
+        self.failures = 0
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def handle(self, query):
+        raise NotImplementedError
+
+    @staticmethod
+    def service_exception(message):
+        body = f'<?xml version="1.0"?><ServiceExceptionReport><ServiceException>{message}</ServiceException></ServiceExceptionReport>'
+        return 200, "application/vnd.ogc.se_xml", body.encode()
+
+
+class StubWCSServer(StubServer):
+    # GetCoverage (WCS 1.0.0, EPSG:4326, GeoTIFF) sampled from elevation_fn(lons, lats)
+    def __init__(self, elevation_fn=synthetic_elevation, **kwargs):
+        super().__init__(**kwargs)
+        self.elevation_fn = elevation_fn
+
+    def handle(self, query):
+        if query.get("REQUEST", "").lower() != "getcoverage":
+            return self.service_exception("Only GetCoverage is supported")
+
+        try:
+            west, south, east, north = map(float, query["BBOX"].split(","))
+            if "WIDTH" in query:
+                width, height = int(query["WIDTH"]), int(query["HEIGHT"])
+            else:
+                width = max(1, round((east - west) / float(query["RESX"])))
+                height = max(1, round((north - south) / float(query["RESY"])))
+        except (KeyError, ValueError) as e:
+            return self.service_exception(f"Bad request: {e}")
+
+        transform = from_bounds(west, south, east, north, width, height)
+        cols, rows = np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+        lons, lats = transform * (cols, rows)
+        data = self.elevation_fn(np.asarray(lons), np.asarray(lats)).astype(np.float32)
+
+        with MemoryFile() as memfile:
+            with memfile.open(driver="GTiff", width=width, height=height, count=1, dtype="float32",
+                              crs="EPSG:4326", transform=transform, nodata=-9999) as dataset:
+                dataset.write(data, 1)
+            return 200, "image/tiff", memfile.read()
+
+
+class StubWMSServer(StubServer):
+    # GetMap (WMS 1.1.1) in a projected SRS, rendered from image_fn(xs, ys) at pixel centres
+    def __init__(self, image_fn=synthetic_orthophoto, **kwargs):
+        super().__init__(**kwargs)
+        self.image_fn = image_fn
+
+    def handle(self, query):
+        if query.get("REQUEST", "").lower() != "getmap":
+            return self.service_exception("Only GetMap is supported")
+
+        try:
+            minx, miny, maxx, maxy = map(float, query["BBOX"].split(","))
+            width, height = int(query["WIDTH"]), int(query["HEIGHT"])
+        except (KeyError, ValueError) as e:
+            return self.service_exception(f"Bad request: {e}")
+
+        xs = minx + (np.arange(width) + 0.5) * (maxx - minx) / width
+        ys = maxy - (np.arange(height) + 0.5) * (maxy - miny) / height
+        xs, ys = np.meshgrid(xs, ys)
+
+        buffer = BytesIO()
+        Image.fromarray(self.image_fn(xs, ys)).save(buffer, format="PNG")
+        return 200, "image/png", buffer.getvalue()
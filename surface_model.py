@@ -0,0 +1,332 @@
+import glob
+import json
+import math
+import os
+
+import numpy as np
+import pyproj
+
+SURFACE_VERSION = 2
+SURFACE_CRS = "EPSG:32633"  # UTM 33N, same metric grid as ImageManager
+
+
+class SurfaceModel:
+    # Digital surface model on a metric grid: terrain (DTM) resampled from the DEM tiles plus
+    # rasterized building heights (DSM = DTM + building). Both layers are stored as memory-mapped
+    # (tiles_y, tiles_x, tile_size, tile_size) arrays, with a max-height pyramid of the DSM used
+    # to skip empty regions in segment queries. Altitudes are metres above sea level, like the DEM.
+    # Where a segment crosses no-data or leaves the grid its clearance is unknown, never clear.
+    # rasterio is only needed to build the model; loading and querying it is plain NumPy.
+    def __init__(self, surface_dir='surface'):
+        self.surface_dir = surface_dir
+        self.meta = None
+        self.dtm = None
+        self.dsm = None
+        self.levels = []
+        self.to_grid = pyproj.Transformer.from_crs("EPSG:4326", SURFACE_CRS, always_xy=True)
+
+    def _path(self, name):
+        return os.path.join(self.surface_dir, name)
+
+    def load(self):
+        with open(self._path('surface.json'), 'r') as f:
+            meta = json.load(f)
+        if meta.get("version") != SURFACE_VERSION:
+            raise ValueError(f"Unsupported surface model version: {meta.get('version')}")
+
+        self.meta = meta
+        self.dtm = np.load(self._path('dtm.npy'), mmap_mode='r')
+        self.dsm = np.load(self._path('dsm.npy'), mmap_mode='r')
+        self.levels = [
+            (factor, np.load(self._path(f'dsm_max_{factor}.npy'), mmap_mode='r'))
+            for factor in meta["pyramid"]
+        ]
+        return self
+
+    def build(self, bounds, buildings_manager=None, elevation_files=None, resolution_m=2.0, tile_size=256,
+              pyramid_factor=4):
+        import rasterio
+        from rasterio.warp import transform_bounds
+
+        # bounds: (min_lon, min_lat, max_lon, max_lat)
+        if tile_size % pyramid_factor:
+            raise ValueError("tile_size must be a multiple of pyramid_factor")
+        os.makedirs(self.surface_dir, exist_ok=True)
+        if elevation_files is None:
+            elevation_files = sorted(glob.glob(os.path.join("elevation/", "*.tif")))
+
+        min_x, min_y, max_x, max_y = transform_bounds("EPSG:4326", SURFACE_CRS, *bounds)
+        width = math.ceil((max_x - min_x) / resolution_m)
+        height = math.ceil((max_y - min_y) / resolution_m)
+        tiles_x = math.ceil(width / tile_size)
+        tiles_y = math.ceil(height / tile_size)
+
+        self.meta = {
+            "version": SURFACE_VERSION,
+            "crs": SURFACE_CRS,
+            "origin": [min_x, max_y],
+            "resolution_m": resolution_m,
+            "shape": [tiles_y * tile_size, tiles_x * tile_size],
+            "tile_size": tile_size,
+            "pyramid": []
+        }
+
+        layout = (tiles_y, tiles_x, tile_size, tile_size)
+        dtm = np.lib.format.open_memmap(self._path('dtm.npy'), mode='w+', dtype=np.float32, shape=layout)
+        dsm = np.lib.format.open_memmap(self._path('dsm.npy'), mode='w+', dtype=np.float32, shape=layout)
+
+        sources = [rasterio.open(path) for path in elevation_files]
+        try:
+            for ty in range(tiles_y):
+                for tx in range(tiles_x):
+                    terrain, surface = self._build_tile(ty, tx, sources, buildings_manager)
+                    dtm[ty, tx] = terrain
+                    dsm[ty, tx] = surface
+        finally:
+            for source in sources:
+                source.close()
+
+        dtm.flush()
+        dsm.flush()
+        del dtm, dsm
+
+        self._build_pyramid(pyramid_factor)
+
+        with open(self._path('surface.json'), 'w') as f:
+            json.dump(self.meta, f)
+        print(f"Surface model built: {tiles_y}x{tiles_x} tiles of {tile_size}px at {resolution_m} m")
+        return self.load()
+
+    def _tile_transform(self, ty, tx):
+        from rasterio.transform import from_origin
+
+        size = self.meta["tile_size"]
+        res = self.meta["resolution_m"]
+        x0, y0 = self.meta["origin"]
+        return from_origin(x0 + tx * size * res, y0 - ty * size * res, res, res)
+
+    def _build_tile(self, ty, tx, sources, buildings_manager):
+        import rasterio
+        from rasterio.features import rasterize
+        from rasterio.warp import Resampling, reproject, transform_bounds
+
+        size = self.meta["tile_size"]
+        transform = self._tile_transform(ty, tx)
+
+        terrain = np.full((size, size), np.nan, dtype=np.float32)
+        for source in sources:
+            if not np.isnan(terrain).any():
+                break
+            warped = np.full((size, size), np.nan, dtype=np.float32)
+            reproject(
+                source=rasterio.band(source, 1),
+                destination=warped,
+                src_nodata=source.nodata,
+                dst_transform=transform,
+                dst_crs=SURFACE_CRS,
+                dst_nodata=np.nan,
+                resampling=Resampling.bilinear
+            )
+            warped[warped < -1000] = np.nan
+            gaps = np.isnan(terrain)
+            terrain[gaps] = warped[gaps]
+
+        building_heights = np.zeros((size, size), dtype=np.float32)
+        if buildings_manager is not None:
+            res = self.meta["resolution_m"]
+            west, north = transform.c, transform.f
+            tile_bounds = transform_bounds(SURFACE_CRS, "EPSG:4326", west, north - size * res, west + size * res, north)
+            buildings = buildings_manager.buildings_in_bounds(*tile_bounds)
+            buildings = buildings[buildings["height"].notna() & (buildings["height"] > 0)]
+
+            if not buildings.empty:
+                # Lowest first, so where footprints overlap the tallest building wins
+                buildings = buildings.sort_values("height").to_crs(SURFACE_CRS)
+                building_heights = rasterize(
+                    zip(buildings.geometry, buildings["height"]),
+                    out_shape=(size, size),
+                    transform=transform,
+                    fill=0,
+                    dtype='float32'
+                )
+
+        return terrain, terrain + building_heights
+
+    def _build_pyramid(self, factor):
+        # Level k holds the max DSM height over factor**k x factor**k pixel blocks, NaN if any pixel
+        # of the block is no-data so the coarse pass never clears a segment over unknown surface
+        tiles_y, tiles_x, size, _ = self.dsm_shape()
+        dsm = np.load(self._path('dsm.npy'), mmap_mode='r')
+
+        height, width = tiles_y * size, tiles_x * size
+        block = factor
+        level = np.lib.format.open_memmap(
+            self._path(f'dsm_max_{block}.npy'), mode='w+', dtype=np.float32,
+            shape=(math.ceil(height / block), math.ceil(width / block))
+        )
+        per_tile = size // block
+        for ty in range(tiles_y):
+            for tx in range(tiles_x):
+                tile = np.asarray(dsm[ty, tx]).reshape(per_tile, block, per_tile, block)
+                level[ty * per_tile:(ty + 1) * per_tile, tx * per_tile:(tx + 1) * per_tile] = tile.max(axis=(1, 3))
+        level.flush()
+        self.meta["pyramid"] = [block]
+        previous = np.asarray(level)
+        del level
+
+        while max(previous.shape) > 1:
+            rows = math.ceil(previous.shape[0] / factor) * factor
+            cols = math.ceil(previous.shape[1] / factor) * factor
+            padded = np.full((rows, cols), -np.inf, dtype=np.float32)  # padding is off the grid, not no-data
+            padded[:previous.shape[0], :previous.shape[1]] = previous
+            previous = padded.reshape(rows // factor, factor, cols // factor, factor).max(axis=(1, 3))
+            block *= factor
+            np.save(self._path(f'dsm_max_{block}.npy'), previous)
+            self.meta["pyramid"].append(block)
+
+    def dsm_shape(self):
+        size = self.meta["tile_size"]
+        height, width = self.meta["shape"]
+        return height // size, width // size, size, size
+
+    def to_pixels(self, lats, lons):
+        # Fractional (row, col) on the full-resolution grid
+        xs, ys = self.to_grid.transform(np.asarray(lons, dtype=float), np.asarray(lats, dtype=float))
+        x0, y0 = self.meta["origin"]
+        res = self.meta["resolution_m"]
+        return (y0 - np.asarray(ys)) / res, (np.asarray(xs) - x0) / res
+
+    def _sample(self, layer, rows, cols):
+        size = self.meta["tile_size"]
+        height, width = self.meta["shape"]
+        r = np.floor(rows).astype(np.int64)
+        c = np.floor(cols).astype(np.int64)
+        out = np.full(r.shape, np.nan, dtype=np.float32)
+        inside = (r >= 0) & (c >= 0) & (r < height) & (c < width)
+        r, c = r[inside], c[inside]
+        out[inside] = layer[r // size, c // size, r % size, c % size]
+        return out
+
+    def surface_height(self, lats, lons):
+        rows, cols = self.to_pixels(np.atleast_1d(lats), np.atleast_1d(lons))
+        return self._sample(self.dsm, rows, cols)
+
+    def terrain_height(self, lats, lons):
+        rows, cols = self.to_pixels(np.atleast_1d(lats), np.atleast_1d(lons))
+        return self._sample(self.dtm, rows, cols)
+
+    def _segment_samples(self, rows0, cols0, rows1, cols1, spacing_px, max_samples):
+        # Flattened samples along each segment at most spacing_px apart: (segment index, t)
+        lengths = np.hypot(rows1 - rows0, cols1 - cols0)
+        counts = np.minimum(np.ceil(lengths / spacing_px).astype(np.int64) + 1, max_samples)
+        counts = np.maximum(counts, 2)
+        segment = np.repeat(np.arange(len(rows0)), counts)
+        starts = np.cumsum(counts) - counts
+        t = (np.arange(counts.sum()) - np.repeat(starts, counts)) / np.repeat(counts - 1, counts)
+        return segment, t
+
+    def _coarse_max(self, factor, level, rows0, cols0, rows1, cols1):
+        # Conservative max of the DSM along each segment at this pyramid level: samples every half
+        # block and takes the 3x3 block neighbourhood so corner-cut blocks are included. Blocks off
+        # the grid or holding no-data count as +inf, leaving those segments to the exact pass.
+        segment, t = self._segment_samples(rows0 / factor, cols0 / factor, rows1 / factor, cols1 / factor, 0.5, 1 << 20)
+        r = np.floor(rows0[segment] / factor + t * (rows1[segment] - rows0[segment]) / factor).astype(np.int64)
+        c = np.floor(cols0[segment] / factor + t * (cols1[segment] - cols0[segment]) / factor).astype(np.int64)
+
+        best = np.full(len(segment), -np.inf, dtype=np.float32)
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                rr, cc = r + dr, c + dc
+                inside = (rr >= 0) & (cc >= 0) & (rr < level.shape[0]) & (cc < level.shape[1])
+                values = np.full(len(segment), np.inf, dtype=np.float32)
+                values[inside] = level[rr[inside], cc[inside]]
+                best = np.maximum(best, np.nan_to_num(values, nan=np.inf))
+
+        out = np.full(len(rows0), -np.inf, dtype=np.float32)
+        np.maximum.at(out, segment, best)
+        return out
+
+    def _exact_clearance(self, rows0, cols0, alts0, rows1, cols1, alts1, exclude_px, chunk=1 << 21):
+        # Min of (altitude along the segment - DSM) sampled every half pixel, ignoring samples within
+        # exclude_px of either endpoint (e.g. the tower's own mast); NaN where a sample that counts has
+        # no surface data. Segments are processed in groups of about `chunk` samples to bound memory.
+        out = np.full(len(rows0), np.inf)
+        lengths = np.hypot(rows1 - rows0, cols1 - cols0)
+        per_segment = np.ceil(lengths / 0.5).astype(np.int64) + 1
+        cumulative = np.cumsum(per_segment)
+
+        start = 0
+        while start < len(rows0):
+            end = max(int(np.searchsorted(cumulative, cumulative[start] - per_segment[start] + chunk, side='right')),
+                      start + 1)
+            sl = slice(start, end)
+            segment, t = self._segment_samples(rows0[sl], cols0[sl], rows1[sl], cols1[sl], 0.5, 1 << 40)
+            rr = rows0[sl][segment] + t * (rows1[sl] - rows0[sl])[segment]
+            cc = cols0[sl][segment] + t * (cols1[sl] - cols0[sl])[segment]
+            alt = alts0[sl][segment] + t * (alts1[sl] - alts0[sl])[segment]
+
+            along = t * lengths[sl][segment]
+            keep = (along >= exclude_px) & (lengths[sl][segment] - along >= exclude_px)
+            clearance = alt - self._sample(self.dsm, rr, cc)
+            unknown = keep & np.isnan(clearance)
+            clearance[~keep | unknown] = np.inf
+
+            chunk_out = np.full(end - start, np.inf)
+            np.minimum.at(chunk_out, segment, clearance)
+            chunk_out[np.unique(segment[unknown])] = np.nan
+            out[sl] = chunk_out
+            start = end
+        return out
+
+    def _prepare(self, lats0, lons0, alts0, lats1, lons1, alts1):
+        rows0, cols0 = self.to_pixels(np.atleast_1d(lats0), np.atleast_1d(lons0))
+        rows1, cols1 = self.to_pixels(np.atleast_1d(lats1), np.atleast_1d(lons1))
+        alts0 = np.atleast_1d(np.asarray(alts0, dtype=float))
+        alts1 = np.atleast_1d(np.asarray(alts1, dtype=float))
+        valid = np.isfinite(rows0) & np.isfinite(cols0) & np.isfinite(alts0) \
+            & np.isfinite(rows1) & np.isfinite(cols1) & np.isfinite(alts1)
+        return rows0, cols0, alts0, rows1, cols1, alts1, valid
+
+    def segments_clear(self, lats0, lons0, alts0, lats1, lons1, alts1, margin_m=0.0, exclude_m=0.0):
+        # True where every point of the segment is at least margin_m above the surface; False where it
+        # is not, and where that is unknown (no surface data, off the grid or a NaN endpoint). Segments are
+        # resolved from the coarsest pyramid level down; only undecided ones are sampled at full resolution.
+        rows0, cols0, alts0, rows1, cols1, alts1, valid = self._prepare(lats0, lons0, alts0, lats1, lons1, alts1)
+        clear = np.zeros(len(rows0), dtype=bool)
+        pending = np.flatnonzero(valid)
+        lowest = np.minimum(alts0, alts1)
+
+        for factor, level in reversed(self.levels):
+            if len(pending) == 0:
+                break
+            top = self._coarse_max(factor, level, rows0[pending], cols0[pending], rows1[pending], cols1[pending])
+            resolved = lowest[pending] - top >= margin_m
+            clear[pending[resolved]] = True
+            pending = pending[~resolved]
+
+        if len(pending):
+            exclude_px = exclude_m / self.meta["resolution_m"]
+            clearance = self._exact_clearance(
+                rows0[pending], cols0[pending], alts0[pending],
+                rows1[pending], cols1[pending], alts1[pending], exclude_px
+            )
+            clear[pending] = clearance >= margin_m  # NaN compares False
+        return clear
+
+    def segment_clearance(self, lats0, lons0, alts0, lats1, lons1, alts1):
+        # Exact minimum clearance (m) above the surface along each segment, NaN where it is unknown
+        rows0, cols0, alts0, rows1, cols1, alts1, valid = self._prepare(lats0, lons0, alts0, lats1, lons1, alts1)
+        clearance = np.full(len(rows0), np.nan)
+        clearance[valid] = self._exact_clearance(
+            rows0[valid], cols0[valid], alts0[valid], rows1[valid], cols1[valid], alts1[valid], 0.0
+        )
+        return clearance
+
+    def line_of_sight(self, lats, lons, alts, tower_lats, tower_lons, mast_height_m=30.0, exclude_m=None):
+        # Pairwise UAV -> tower visibility. Towers carry no height, so the antenna is placed
+        # mast_height_m above the surface at the tower position; samples within exclude_m of the tower
+        # (its own building/mast) are ignored. Towers off the surface grid are never in sight.
+        if exclude_m is None:
+            exclude_m = 2 * self.meta["resolution_m"]
+        tower_alts = self.surface_height(tower_lats, tower_lons).astype(float) + mast_height_m
+        return self.segments_clear(lats, lons, alts, tower_lats, tower_lons, tower_alts, exclude_m=exclude_m)
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def drive_test_corpus(tmp_path):
+    # Synthetic towers and drive-test sessions over a 0.05 degree square, in the formats
+    # ConnectivityManager reads. Returns the ConnectivityManager keyword arguments.
+    from benchmarks import synthetic
+
+    towers = synthetic.make_towers(8, span_deg=0.05, seed=3)
+    tower_file = synthetic.write_towers(str(tmp_path / "towers" / "towers.clf"), towers)
+    dataset_dirs = synthetic.write_drive_tests(str(tmp_path / "connectivity"), towers, 4, 400, span_deg=0.05, seed=3)
+    return {"dataset_dirs": dataset_dirs, "tower_files": [tower_file], "cache_dir": str(tmp_path / "cache"), "workers": 1}
@@ -0,0 +1,156 @@
+import json
+import os
+
+import mercantile
+import numpy as np
+import pytest
+
+from buildings_manager import TILE_ZOOM, BuildingsManager
+from stub_services import StubServer
+
+LAT = 43.05
+LON = 12.45
+
+
+def write_tile(tiles_dir, quad_key, footprints):
+    # footprints: (west, south, east, north, height) rectangles, in the nested GlobalML layout
+    features = [
+        {
+            "type": "Feature",
+            "properties": {"type": "Feature", "properties": {"height": height, "confidence": 0.9}},
+            "geometry": {"type": "Polygon", "coordinates": [[[w, s], [e, s], [e, n], [w, n], [w, s]]]}
+        }
+        for w, s, e, n, height in footprints
+    ]
+    with open(os.path.join(tiles_dir, f"{quad_key}.geojson"), 'w') as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+
+
+class StubBuildingsServer(StubServer):
+    # dataset-links.csv at ?file=links and the tile of QUAD_KEY at ?file=tile, or 500s where status says so
+    def __init__(self, quad_key, links_status=200, tile_status=200):
+        super().__init__()
+        self.quad_key = quad_key
+        self.links_status = links_status
+        self.tile_status = tile_status
+
+    def handle(self, query):
+        if query.get("FILE") == "links":
+            body = f"Location,QuadKey,Url,Size\nItaly,{self.quad_key},{self.url}?file=tile,1KB\n"
+            return self.links_status, "text/csv", body.encode()
+        feature = {
+            "type": "Feature",
+            "properties": {"height": 9.5, "confidence": 0.8},
+            "geometry": {"type": "Polygon", "coordinates": [[
+                [LON - 0.0002, LAT - 0.0002], [LON + 0.0002, LAT - 0.0002],
+                [LON + 0.0002, LAT + 0.0002], [LON - 0.0002, LAT + 0.0002], [LON - 0.0002, LAT - 0.0002]
+            ]]}
+        }
+        return self.tile_status, "application/json", json.dumps(feature).encode()
+
+    def count(self, file):
+        return sum(request.get("FILE") == file for request in self.requests)
+
+
+@pytest.fixture
+def download_server():
+    servers = []
+
+    def start(**kwargs):
+        servers.append(StubBuildingsServer(mercantile.quadkey(mercantile.tile(LON, LAT, TILE_ZOOM)), **kwargs).start())
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def downloading_manager(server, tiles_dir, **kwargs):
+    return BuildingsManager(tiles_dir=str(tiles_dir), links_url=f"{server.url}?file=links", download_timeout_s=5, **kwargs)
+
+
+@pytest.fixture
+def straddling(tmp_path):
+    # A building assigned to tile A that extends across A's east edge into tile B
+    tile_a = mercantile.tile(LON, LAT, TILE_ZOOM)
+    tile_b = mercantile.Tile(tile_a.x + 1, tile_a.y, TILE_ZOOM)
+    edge = mercantile.bounds(tile_a).east
+
+    write_tile(tmp_path, mercantile.quadkey(tile_a), [(edge - 0.0005, LAT - 0.0002, edge + 0.0005, LAT + 0.0002, 12.0)])
+    write_tile(tmp_path, mercantile.quadkey(tile_b), [(edge + 0.01, LAT, edge + 0.0101, LAT + 0.0001, 5.0)])
+    return str(tmp_path), mercantile.quadkey(tile_a), (LAT, edge + 0.0002)
+
+
+def test_building_across_tile_edge_found_before_its_tile_is_converted(straddling):
+    tiles_dir, quad_key_a, (lat, lon) = straddling
+
+    cold = BuildingsManager(tiles_dir=tiles_dir)
+    result = cold.get_height_building(lat, lon)
+    assert result != -1 and result[2] == 12.0
+    assert quad_key_a in cold.tile_bounds
+
+
+def test_building_across_tile_edge_same_answer_whatever_the_cache_state(straddling):
+    tiles_dir, quad_key_a, (lat, lon) = straddling
+    lats, lons = np.array([lat, lat]), np.array([lon, lon + 0.002])
+
+    cold_ids, cold_heights = BuildingsManager(tiles_dir=tiles_dir).get_height_buildings(lats, lons)
+
+    warm = BuildingsManager(tiles_dir=tiles_dir)
+    warm.load_tile(quad_key_a)
+    warm_ids, warm_heights = warm.get_height_buildings(lats, lons)
+
+    assert cold_ids[0] != -1 and cold_ids[1] == -1
+    np.testing.assert_array_equal(cold_ids, warm_ids)
+    np.testing.assert_array_equal(cold_heights, warm_heights)
+    assert len(warm.buildings_in_bounds(lon, lat, lon, lat)) == 1
+
+
+def test_tile_converted_again_when_its_geojson_changes(tmp_path):
+    quad_key = mercantile.quadkey(mercantile.tile(LON, LAT, TILE_ZOOM))
+    footprint = (LON - 0.0002, LAT - 0.0002, LON + 0.0002, LAT + 0.0002)
+    write_tile(tmp_path, quad_key, [(*footprint, 8.0)])
+
+    manager = BuildingsManager(tiles_dir=str(tmp_path))
+    assert manager.get_height_building(LAT, LON)[2] == 8.0
+
+    write_tile(tmp_path, quad_key, [(*footprint, 20.0), (LON + 0.001, LAT, LON + 0.0012, LAT + 0.0002, 3.0)])
+    stat = os.stat(os.path.join(tmp_path, f"{quad_key}.geojson"))
+    os.utime(os.path.join(tmp_path, f"{quad_key}.geojson"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    # Both the running manager and a new one reading the persisted index pick up the new source
+    assert manager.get_height_building(LAT, LON)[2] == 20.0
+    fresh = BuildingsManager(tiles_dir=str(tmp_path))
+    _, heights = fresh.get_height_buildings([LAT, LAT + 0.0001], [LON, LON + 0.0011])
+    np.testing.assert_array_equal(heights, [20.0, 3.0])
+
+
+def test_downloaded_tile_converted_once(download_server, tmp_path):
+    server = download_server()
+    manager = downloading_manager(server, tmp_path)
+    assert manager.get_height_building(LAT, LON)[2] == 9.5
+    assert downloading_manager(server, tmp_path).get_height_building(LAT, LON)[2] == 9.5
+    assert (server.count("links"), server.count("tile")) == (1, 1)
+
+
+def test_failed_tile_download_attempted_once_within_ttl(download_server, tmp_path):
+    server = download_server(tile_status=500)
+    manager = downloading_manager(server, tmp_path)
+    for _ in range(3):
+        assert manager.get_height_building(LAT, LON) == -1
+    assert (server.count("links"), server.count("tile")) == (1, 1)
+
+    # Once the TTL has passed the tile is tried again, the links file is still fresh on disk
+    expired = downloading_manager(server, tmp_path, failure_ttl_s=0)
+    expired.get_height_building(LAT, LON)
+    expired.get_height_building(LAT, LON)
+    assert (server.count("links"), server.count("tile")) == (1, 3)
+
+
+def test_failed_links_download_attempted_once_within_ttl(download_server, tmp_path):
+    server = download_server(links_status=500)
+    manager = downloading_manager(server, tmp_path)
+    other_quad_key = mercantile.quadkey(mercantile.tile(LON + 0.5, LAT, TILE_ZOOM))
+    assert manager.get_height_building(LAT, LON) == -1
+    assert manager.load_tile(other_quad_key) is None
+    assert (server.count("links"), server.count("tile")) == (1, 0)
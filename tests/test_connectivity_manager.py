@@ -0,0 +1,125 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+import shapely
+from shapely.geometry import Point, Polygon
+
+from connectivity_manager import ConnectivityManager
+
+
+def query_points(manager, n=60, seed=0):
+    # Half at observed positions, half anywhere around the corpus (some outside every hull)
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(manager.store.data), n // 2, replace=False)
+    lats = np.concatenate((manager.store.data["lat"][rows], 43.05 + rng.uniform(-0.03, 0.03, n - n // 2)))
+    lons = np.concatenate((manager.store.data["lon"][rows], 12.45 + rng.uniform(-0.03, 0.03, n - n // 2)))
+    return lats, lons
+
+
+def covering_one_by_one(manager, lat, lon):
+    # The original per-point loop: every tower's hull tested, the model executed per point
+    point = Point(lat, lon)
+    covering = []
+    for tower in manager.towers:
+        if len(tower["coverage"]) >= 3 and Polygon(tower["coverage"]).contains(point):
+            z, _ = manager.signal_model(tower["cell_id"]).execute('points', [lat], [lon])
+            covering.append((tower["cell_id"], float(z[0])))
+    return covering
+
+
+@pytest.fixture
+def manager(drive_test_corpus):
+    return ConnectivityManager(**drive_test_corpus).load()
+
+
+def test_batch_equals_the_per_point_baseline(manager):
+    lats, lons = query_points(manager)
+    batch = manager.get_covering_towers_batch(lats, lons)
+
+    assert len(batch) == len(lats)
+    assert any(batch) and not all(batch)
+    for lat, lon, towers in zip(lats, lons, batch):
+        expected = covering_one_by_one(manager, lat, lon)
+        assert [tower["cell_id"] for tower, _ in towers] == [cell_id for cell_id, _ in expected]
+        np.testing.assert_allclose([signal for _, signal in towers], [signal for _, signal in expected], rtol=1e-9)
+
+
+def test_single_point_query_matches_the_batch(manager):
+    lats, lons = query_points(manager, n=10, seed=1)
+    batch = manager.get_covering_towers_batch(lats, lons)
+    for lat, lon, towers in zip(lats, lons, batch):
+        single = manager.get_covering_towers(lat, lon)
+        assert [(tower["cell_id"], signal) for tower, signal in single] == \
+            [(tower["cell_id"], pytest.approx(signal)) for tower, signal in towers]
+
+
+def same_state(refreshed, fresh, lats, lons):
+    assert [(t["cell_id"], t["band"], t["coverage"]) for t in refreshed.towers] == \
+        [(t["cell_id"], t["band"], t["coverage"]) for t in fresh.towers]
+    assert refreshed.cell_index.keys() == fresh.cell_index.keys()
+    for cell_id, obs in fresh.cell_index.items():
+        # Rows of a cell may come in another session order, so compare them as sets of fixes
+        for key in ("lat", "lon", "signal"):
+            np.testing.assert_array_equal(np.sort(refreshed.cell_index[cell_id][key]), np.sort(obs[key]))
+
+    for got, expected in zip(refreshed.get_covering_towers_batch(lats, lons), fresh.get_covering_towers_batch(lats, lons)):
+        assert [tower["cell_id"] for tower, _ in got] == [tower["cell_id"] for tower, _ in expected]
+        np.testing.assert_allclose([s for _, s in got], [s for _, s in expected], rtol=1e-6)
+
+
+@pytest.fixture
+def held_back(drive_test_corpus, tmp_path):
+    # The corpus minus its newest session, which the test adds back later
+    folder = drive_test_corpus["dataset_dirs"][0]
+    newest = sorted(os.listdir(folder))[-1]
+    shutil.move(os.path.join(folder, newest), tmp_path / newest)
+    return drive_test_corpus, lambda: shutil.move(tmp_path / newest, os.path.join(folder, newest))
+
+
+def test_refresh_after_a_new_session_equals_a_fresh_load(held_back, tmp_path):
+    corpus, add_session = held_back
+    manager = ConnectivityManager(**corpus).load()
+    lats, lons = query_points(manager)
+    manager.get_covering_towers_batch(lats, lons)  # fits the models that refresh has to invalidate
+    rows = len(manager.store.data)
+
+    add_session()
+    dirty = manager.refresh()
+    assert dirty and not manager.store.rebuilt
+    assert len(manager.store.data) > rows
+
+    fresh = ConnectivityManager(**{**corpus, "cache_dir": str(tmp_path / "fresh")}).load()
+    same_state(manager, fresh, lats, lons)
+
+
+def test_refresh_rebakes_only_dirty_rasters(held_back, tmp_path):
+    corpus, add_session = held_back
+    manager = ConnectivityManager(**corpus).load()
+    manager.bake_signal_rasters(str(tmp_path / "rasters"), resolution_m=50, workers=1)
+    before = {int(cell_id): entry["fingerprint"] for cell_id, entry in manager.signal_rasters.index["cells"].items()}
+
+    add_session()
+    dirty = manager.refresh()
+    after = {int(cell_id): entry["fingerprint"] for cell_id, entry in manager.signal_rasters.index["cells"].items()}
+    assert {cell_id for cell_id in before if after[cell_id] != before[cell_id]} == dirty & before.keys()
+
+    # Every raster, reused or rebaked, holds what the models of a fresh load predict at its grid nodes
+    fresh = ConnectivityManager(**{**corpus, "cache_dir": str(tmp_path / "fresh")}).load()
+    store = manager.signal_rasters
+    assert after.keys() == {t["cell_id"] for t in fresh.towers if len(t["coverage"]) >= 3}
+    for cell_id in after:
+        entry = store.index["cells"][str(cell_id)]
+        lats = (entry["row0"] + np.arange(entry["shape"][0])) * store.lat_step
+        lons = (entry["col0"] + np.arange(entry["shape"][1])) * store.lon_step
+        lats, lons = (grid.ravel() for grid in np.meshgrid(lats, lons, indexing='ij'))
+        inside = shapely.intersects_xy(Polygon(entry["coverage"]), lats, lons)
+        live, _ = fresh.signal_model(cell_id).execute('points', lats[inside], lons[inside])
+        np.testing.assert_allclose(store.sample_cell(cell_id, lats[inside], lons[inside]), live, atol=1e-3)
+
+
+def test_refresh_before_load_loads_everything(drive_test_corpus):
+    manager = ConnectivityManager(**drive_test_corpus)
+    dirty = manager.refresh()
+    assert dirty == set(manager.store.cell_ids.tolist()) and manager.towers
@@ -0,0 +1,81 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from environment_service import EnvironmentService
+
+
+class StubElevation:
+    # Answers lat + lon; blocks on `release` when one is set
+    def __init__(self, delay_s=0.0):
+        self.delay_s = delay_s
+        self.release = None
+        self.calls = 0
+
+    def get_elevations(self, lats, lons):
+        self.calls += 1
+        if self.release is not None:
+            self.release.wait()
+        time.sleep(self.delay_s)
+        return np.asarray(lats) + np.asarray(lons)
+
+
+class StubBuildings:
+    def __init__(self, delay_s=0.0):
+        self.delay_s = delay_s
+
+    def get_height_buildings(self, lats, lons):
+        time.sleep(self.delay_s)
+        ids = np.array([7, -1])[:len(lats)]
+        return ids, np.array([12.5, np.nan])[:len(lats)]
+
+
+@pytest.fixture
+def service():
+    elevation = StubElevation()
+    service = EnvironmentService(buildings=StubBuildings(), elevation=elevation)
+    yield service
+    if elevation.release is not None:
+        elevation.release.set()
+    service.close()
+
+
+def test_one_result_per_waypoint(service):
+    results = service.query([43.0, 43.1], [12.0, 12.1])
+    assert [result["errors"] for result in results] == [{}, {}]
+    assert [result["elevation"] for result in results] == pytest.approx([55.0, 55.2])
+    assert [result["building"] for result in results] == [{"id": 7, "height": 12.5}, None]
+    assert "towers" not in results[0] and "image" not in results[0]
+
+
+def test_stalled_layer_flagged_and_the_rest_returned(service):
+    service.elevation.release = threading.Event()
+
+    results = service.query([43.0, 43.1], [12.0, 12.1], timeouts={"elevation": 0.2})
+    assert [result["elevation"] for result in results] == [None, None]
+    assert results[0]["errors"]["elevation"].startswith("timed out")
+    assert results[0]["building"] == {"id": 7, "height": 12.5} and "building" not in results[0]["errors"]
+
+    # While the abandoned call still holds the manager the layer is not started again
+    results = service.query([43.0, 43.1], [12.0, 12.1], timeouts={"elevation": 0.2})
+    assert results[0]["errors"]["elevation"].startswith("busy")
+    assert service.elevation.calls == 1
+
+    service.elevation.release.set()
+    deadline = time.monotonic() + 5
+    while service.stalled and time.monotonic() < deadline:
+        time.sleep(0.01)
+    result = service.query_point(43.0, 12.0)
+    assert result["errors"] == {} and result["elevation"] == pytest.approx(55.0)
+
+
+def test_layers_run_concurrently():
+    service = EnvironmentService(buildings=StubBuildings(0.4), elevation=StubElevation(0.4))
+    start = time.perf_counter()
+    service.query([43.0, 43.1], [12.0, 12.1])
+    elapsed = time.perf_counter() - start
+    service.close()
+    assert elapsed < 0.7
+    assert min(service.last_timings.values()) >= 0.4
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+from pykrige.ok import OrdinaryKriging
+
+from kriging_models import KrigingRegistry, LocalKriging
+
+CELL = 204812345
+
+
+def cell_samples(n, seed=0):
+    # Signal falling off with distance from a tower at the origin of a 0.02 degree square
+    rng = np.random.default_rng(seed)
+    lats = 43.05 + rng.uniform(0, 0.02, n)
+    lons = 12.45 + rng.uniform(0, 0.02, n)
+    distance = np.hypot(lats - 43.05, lons - 12.45) * 111320
+    signals = np.round(-45 - 35 * np.log10(np.maximum(distance, 10)) + rng.normal(0, 3, n))
+    return {"lat": lats, "lon": lons, "signal": signals}
+
+
+@pytest.fixture
+def query():
+    rng = np.random.default_rng(7)
+    return 43.05 + rng.uniform(0, 0.02, 25), 12.45 + rng.uniform(0, 0.02, 25)
+
+
+def test_saved_variogram_restored_without_refitting(tmp_path, query):
+    index = {CELL: cell_samples(60)}
+    first = KrigingRegistry(index, cache_dir=str(tmp_path))
+    expected, _ = first.get(CELL).execute('points', *query)
+    assert (first.fitted, first.restored) == (1, 0)
+    assert (tmp_path / "models" / f"{CELL}.json").exists()
+
+    second = KrigingRegistry(index, cache_dir=str(tmp_path))
+    z, _ = second.get(CELL).execute('points', *query)
+    assert (second.fitted, second.restored) == (0, 1)
+    np.testing.assert_allclose(z, expected)
+    assert second.params[CELL] == first.params[CELL]
+
+
+def test_changed_samples_refit_the_variogram(tmp_path):
+    KrigingRegistry({CELL: cell_samples(60)}, cache_dir=str(tmp_path)).get(CELL)
+
+    changed = cell_samples(60)
+    changed["signal"] = changed["signal"].copy()
+    changed["signal"][0] -= 5
+    registry = KrigingRegistry({CELL: changed}, cache_dir=str(tmp_path))
+    registry.get(CELL)
+    assert (registry.fitted, registry.restored) == (1, 0)
+
+    # The refit record replaced the stale one, so the next process restores it
+    again = KrigingRegistry({CELL: changed}, cache_dir=str(tmp_path))
+    again.get(CELL)
+    assert (again.fitted, again.restored) == (0, 1)
+
+
+def test_params_handed_in_are_used_before_the_models_directory(query):
+    index = {CELL: cell_samples(60)}
+    fitted = KrigingRegistry(index, cache_dir=None)
+    expected, _ = fitted.get(CELL).execute('points', *query)
+
+    restored = KrigingRegistry(index, cache_dir=None, params=fitted.export_params([CELL]))
+    z, _ = restored.get(CELL).execute('points', *query)
+    assert (restored.fitted, restored.restored) == (0, 1)
+    np.testing.assert_allclose(z, expected)
+
+
+def test_uniform_cell_is_nudged_not_rejected():
+    samples = cell_samples(10)
+    samples["signal"] = np.full(10, -90.0)
+    lats, lons, signals = KrigingRegistry({CELL: samples}, cache_dir=None).training_data(CELL)
+    assert signals[0] == pytest.approx(-89.99)
+    assert (signals[1:] == -90.0).all()
+
+
+@pytest.mark.parametrize("extra", [0, 10])
+def test_local_kriging_over_every_sample_equals_exact_kriging(query, extra):
+    samples = cell_samples(40)
+    exact = OrdinaryKriging(samples["lat"], samples["lon"], samples["signal"], variogram_model='linear')
+    local = LocalKriging(
+        samples["lat"], samples["lon"], samples["signal"],
+        exact.variogram_function, exact.variogram_model_parameters, n_closest_points=40 + extra
+    )
+
+    z_exact, ss_exact = exact.execute('points', *query)
+    z_local, ss_local = local.execute('points', *query)
+    np.testing.assert_allclose(z_local, z_exact, rtol=1e-8)
+    np.testing.assert_allclose(ss_local, ss_exact, rtol=1e-6)
+
+    # At a sample position both return the sample itself
+    z, _ = local.execute('points', samples["lat"][:3], samples["lon"][:3])
+    np.testing.assert_allclose(z, samples["signal"][:3])
+
+
+def test_registry_switches_dense_cells_to_local_kriging(query):
+    index = {CELL: cell_samples(120)}
+    dense = KrigingRegistry(index, cache_dir=None, n_closest_points=32).get(CELL)
+    sparse = KrigingRegistry(index, cache_dir=None, n_closest_points=200).get(CELL)
+    assert isinstance(dense, LocalKriging) and not isinstance(sparse, LocalKriging)
+
+    # Neighbourhood-limited predictions stay close to the exact ones on a smooth field
+    z_dense, _ = dense.execute('points', *query)
+    z_sparse, _ = sparse.execute('points', *query)
+    assert np.sqrt(np.mean((z_dense - z_sparse) ** 2)) < 2.0
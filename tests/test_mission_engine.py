@@ -0,0 +1,95 @@
+import json
+
+import numpy as np
+import pytest
+
+from mission_engine import MissionEngine, MissionState, densify, evaluate_mission, make_mission
+from signal_rasters import RASTER_VERSION
+
+STEP = 0.001  # degrees per pixel, about 111 m x 81 m here
+ROW0, COL0 = 43000, 12000
+SECONDS_PER_COL = 10.0
+
+
+@pytest.fixture
+def raster_dir(tmp_path):
+    # One band over 10 x 30 px: -80 dBm for the first 10 columns, -130 for the next 10, -85 for the last 10.
+    # Cell 1 serves the west half and cell 2 the east half.
+    max_signal = np.full((10, 30), -130.0, dtype=np.float32)
+    max_signal[:, :10] = -80.0
+    max_signal[:, 20:] = -85.0
+    best_cell = np.full((10, 30), 1, dtype=np.int64)
+    best_cell[:, 15:] = 2
+    np.save(tmp_path / "band_700_max.npy", max_signal)
+    np.save(tmp_path / "band_700_best.npy", best_cell)
+    with open(tmp_path / "index.json", "w") as f:
+        json.dump({
+            "version": RASTER_VERSION,
+            "resolution_m": 100,
+            "lat_step": STEP,
+            "lon_step": STEP,
+            "cells": {},
+            "bands": {"700": {"max_file": "band_700_max.npy", "best_file": "band_700_best.npy",
+                              "row0": ROW0, "col0": COL0, "shape": [10, 30]}}
+        }, f)
+    return str(tmp_path)
+
+
+def eastbound(mission_id, col_start, col_end):
+    # Straight flight along pixel row 5 at a constant SECONDS_PER_COL
+    return make_mission(
+        mission_id,
+        [0.0, (col_end - col_start) * SECONDS_PER_COL],
+        [(ROW0 + 5) * STEP] * 2,
+        [(COL0 + col_start) * STEP, (COL0 + col_end) * STEP],
+        [120.0, 120.0]
+    )
+
+
+def state_for(raster_dir):
+    return MissionState(None, raster_dir, {"sample_spacing_m": 10.0, "min_signal_dbm": -110.0, "clearance_margin_m": 10.0})
+
+
+def test_gap_and_handover_metrics(raster_dir):
+    state = state_for(raster_dir)
+    mission = eastbound("m", 2, 27)
+    metrics = evaluate_mission(state, mission)
+
+    # Bilinear sampling crosses -110 dBm at column 9.6 going down and 19 + 20/45 coming back up
+    gap_s = (19 + 20 / 45 - 9.6) * SECONDS_PER_COL
+    assert metrics["gap_count"] == 1
+    assert metrics["longest_gap_s"] == pytest.approx(gap_s, abs=2 * SECONDS_PER_COL / 8)
+    assert metrics["total_gap_s"] == metrics["longest_gap_s"]
+    assert metrics["coverage_ratio"] == pytest.approx(1 - gap_s / 250, abs=0.01)
+    # Cell 1 to cell 2 once, across the gap
+    assert metrics["handover_count"] == 1
+
+    # Both signal statistics are over the same samples: every one with a prediction
+    lat, lon, _, _ = densify(mission, 10.0)
+    signal, _ = state.signal.sample_band(700, lat, lon)
+    assert metrics["min_signal_dbm"] == pytest.approx(-130.0)
+    assert metrics["mean_signal_dbm"] == pytest.approx(np.mean(signal))
+
+
+def test_samples_off_the_raster_are_gaps_without_signal(raster_dir):
+    state = state_for(raster_dir)
+    metrics = evaluate_mission(state, eastbound("edge", 22, 40))
+    assert metrics["gap_count"] == 1 and metrics["handover_count"] == 0
+    assert metrics["coverage_ratio"] == pytest.approx(8 / 18, abs=0.02)
+    assert metrics["min_signal_dbm"] == metrics["mean_signal_dbm"] == pytest.approx(-85.0)
+
+    metrics = evaluate_mission(state, eastbound("outside", 40, 50))
+    assert metrics["coverage_ratio"] == 0.0 and metrics["gap_count"] == 1
+    assert metrics["min_signal_dbm"] is None and metrics["mean_signal_dbm"] is None
+
+
+def test_pool_is_kept_across_batches(raster_dir):
+    missions = [eastbound(f"m{i}", i, 20 + i) for i in range(6)]
+    expected = MissionEngine(surface_dir=None, raster_dir=raster_dir, workers=1).evaluate(missions)
+
+    with MissionEngine(surface_dir=None, raster_dir=raster_dir, workers=2) as engine:
+        assert engine.evaluate(missions) == expected
+        pool = engine._pool
+        assert engine.evaluate(missions[::-1]) == expected[::-1]
+        assert engine._pool is pool
+    assert engine._pool is None
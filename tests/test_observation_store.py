@@ -0,0 +1,100 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from benchmarks import synthetic
+from observation_store import ObservationStore, list_dataset_files, parse_observation_file
+
+
+@pytest.fixture
+def sessions(tmp_path):
+    # Five drive-test sessions in both formats, staged outside the dataset directories
+    towers = synthetic.make_towers(6, seed=1)
+    dataset_dirs = synthetic.write_drive_tests(str(tmp_path / "staged"), towers, 5, 300, legacy_fraction=0.4, seed=1)
+    files = sorted(list_dataset_files(dataset_dirs), key=lambda item: os.path.basename(item[0]))
+    return tmp_path, [file_path for file_path, _ in files]
+
+
+def publish(tmp_path, file_paths):
+    # Copies staged sessions into the live dataset directories
+    for file_path in file_paths:
+        target = os.path.join(tmp_path, "live", os.path.relpath(file_path, tmp_path / "staged"))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(file_path, target)
+    return [str(tmp_path / "live" / "dataset"), str(tmp_path / "live" / "dataset-old" / "car")]
+
+
+def by_session(store):
+    # session name -> rows with cell ids resolved, in ingestion order; independent of how sessions were appended
+    sessions = np.asarray(store.data["session"])
+    return {
+        name: [
+            (float(row["lat"]), float(row["lon"]), int(row["alt"]), int(store.cell_ids[row["cell"]]), int(row["signal"]))
+            for row in store.data[sessions == index]
+        ]
+        for index, name in enumerate(store.sessions)
+    }
+
+
+def test_second_load_reuses_the_cache(sessions):
+    tmp_path, files = sessions
+    dataset_dirs = publish(tmp_path, files)
+    cache_dir = str(tmp_path / "cache")
+
+    first = ObservationStore(dataset_dirs, cache_dir=cache_dir, workers=1).load()
+    cached = sorted(os.listdir(first.files_dir))
+    second = ObservationStore(dataset_dirs, cache_dir=cache_dir, workers=1).load()
+
+    assert not second.rebuilt and second.dirty_cells == set()
+    assert second.generation == first.generation
+    assert sorted(os.listdir(second.files_dir)) == cached
+    np.testing.assert_array_equal(np.asarray(second.data), np.asarray(first.data))
+
+
+def test_store_matches_the_parsed_files(sessions):
+    tmp_path, files = sessions
+    store = ObservationStore(publish(tmp_path, files), cache_dir=str(tmp_path / "cache"), workers=2).load()
+
+    parsed = {}
+    for file_path, legacy in list_dataset_files(store.dataset_dirs):
+        rows = parse_observation_file(file_path, legacy)
+        parsed[os.path.basename(file_path).split('.')[0]] = [tuple(row.item()) for row in rows]
+    assert by_session(store) == parsed
+
+
+def test_appended_sessions_equal_a_fresh_parse(sessions):
+    tmp_path, files = sessions
+    cache_dir = str(tmp_path / "cache")
+    store = ObservationStore(publish(tmp_path, files[:3]), cache_dir=cache_dir, workers=1).load()
+    generation = store.generation
+
+    dataset_dirs = publish(tmp_path, files[3:])
+    store.load()
+    assert not store.rebuilt and store.generation == generation
+    assert len(store.sessions) == 5
+
+    fresh = ObservationStore(dataset_dirs, cache_dir=str(tmp_path / "fresh"), workers=1).load()
+    assert by_session(store) == by_session(fresh)
+    reloaded = ObservationStore(dataset_dirs, cache_dir=cache_dir, workers=1).load()
+    assert by_session(reloaded) == by_session(fresh)
+
+
+def test_changed_file_rebuilds_the_store(sessions):
+    tmp_path, files = sessions
+    dataset_dirs = publish(tmp_path, files)
+    cache_dir = str(tmp_path / "cache")
+    generation = ObservationStore(dataset_dirs, cache_dir=cache_dir, workers=1).load().generation
+
+    # Drop the last fix of one session
+    changed = os.path.join(tmp_path, "live", os.path.relpath(files[0], tmp_path / "staged"))
+    with open(changed) as f:
+        lines = f.readlines()
+    with open(changed, 'w') as f:
+        f.writelines(lines[:-1])
+
+    store = ObservationStore(dataset_dirs, cache_dir=cache_dir, workers=1).load()
+    fresh = ObservationStore(dataset_dirs, cache_dir=str(tmp_path / "fresh"), workers=1).load()
+    assert store.rebuilt and store.generation != generation
+    assert by_session(store) == by_session(fresh)
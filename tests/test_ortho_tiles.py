@@ -0,0 +1,120 @@
+import os
+
+import numpy as np
+import pytest
+
+from image_manager import ImageManager
+from ortho_tiles import OrthoTileCache
+from stub_services import StubWMSServer, synthetic_orthophoto
+
+LAT = 43.0655
+LON = 12.5469
+
+
+@pytest.fixture
+def wms_server():
+    with StubWMSServer() as server:
+        yield server
+
+
+def ortho_cache(server, cache_dir, **kwargs):
+    return OrthoTileCache(server.url, "ortho", cache_dir=str(cache_dir), tile_px=64, **kwargs)
+
+
+def expected_pixels(x0, y0, resolution, height, width):
+    # What the stub renders for a north-up grid whose top-left corner is (x0, y0)
+    xs = x0 + (np.arange(width) + 0.5) * resolution
+    ys = y0 - (np.arange(height) + 0.5) * resolution
+    return synthetic_orthophoto(*np.meshgrid(xs, ys))
+
+
+def expected_ortho_tile(cache, key):
+    level, ix, iy = key
+    resolution, extent = cache.resolution(level), cache.tile_extent(level)
+    xs = ix * extent + (np.arange(cache.tile_px) + 0.5) * resolution
+    ys = (iy + 1) * extent - (np.arange(cache.tile_px) + 0.5) * resolution
+    return synthetic_orthophoto(*np.meshgrid(xs, ys))
+
+
+def test_wms_memory_and_disk_hits(wms_server, tmp_path):
+    cache = ortho_cache(wms_server, tmp_path)
+    keys = cache.tile_keys(0, 289997, 4760000.5, 290009, 4760006)
+    assert len(keys) == 2
+
+    tiles = cache.get_tiles(keys)
+    assert len(wms_server.requests) == 2
+    for key in keys:
+        np.testing.assert_array_equal(tiles[key][..., :3], expected_ortho_tile(cache, key))
+
+    cache.get_tiles(keys)
+    assert len(wms_server.requests) == 2
+
+    fresh = ortho_cache(wms_server, tmp_path)
+    for key, tile in fresh.get_tiles(keys).items():
+        np.testing.assert_array_equal(tile, tiles[key])
+    assert len(wms_server.requests) == 2
+
+
+def test_wms_eviction_drops_least_recently_used_tile(wms_server, tmp_path):
+    cache = ortho_cache(wms_server, tmp_path)
+    first, second = (0, 45312, 743750), (0, 45313, 743750)
+    cache.get_tiles([first])
+    old_path = cache._tile_path(first)
+    size = os.path.getsize(old_path)
+    os.utime(old_path, (0, 0))
+
+    cache = ortho_cache(wms_server, tmp_path, max_cache_bytes=int(size * 1.5))
+    cache.get_tiles([second])
+    assert not os.path.exists(old_path)
+    assert len(wms_server.requests) == 2
+
+    ortho_cache(wms_server, tmp_path).get_tiles([first, second])
+    assert len(wms_server.requests) == 3
+
+
+def test_wms_retries_server_errors(wms_server, tmp_path):
+    wms_server.failures = 1
+    cache = ortho_cache(wms_server, tmp_path)
+    key = (0, 45312, 743750)
+    tile = cache.get_tiles([key])[key]
+    assert len(wms_server.requests) == 2
+    np.testing.assert_array_equal(tile[..., :3], expected_ortho_tile(cache, key))
+
+
+@pytest.mark.parametrize("resolution", [0.1, 0.2])
+def test_image_stitched_and_cropped_to_the_bbox(wms_server, tmp_path, resolution):
+    manager = ImageManager(wms_url=wms_server.url, cache_dir=str(tmp_path))
+    level = manager.tiles.level_for(resolution)
+    x0, y0, width, height = manager.tiles.pixel_grid(level, *manager._bbox(LAT, LON, 40))
+    expected = expected_pixels(x0, y0, resolution, height, width)
+
+    image = manager.get_image(LAT, LON, bbox_size_m=40, resolution_m_per_pixel=resolution)
+    assert image.size == (width, height)
+    np.testing.assert_array_equal(np.asarray(image)[..., :3], expected)
+    requests = len(wms_server.requests)
+    assert requests == len(manager.tiles.tile_keys(level, *manager._bbox(LAT, LON, 40)))
+
+    array = manager.get_image_array(LAT, LON, bbox_size_m=40, resolution_m_per_pixel=resolution)
+    np.testing.assert_array_equal(array[..., :3], expected)
+    assert (array[..., 3] == 255).all()
+    assert len(wms_server.requests) == requests
+
+
+@pytest.mark.parametrize("suffix", [".npy", ".tif"])
+def test_mosaic_matches_the_source_pixel_for_pixel(wms_server, tmp_path, suffix):
+    manager = ImageManager(wms_url=wms_server.url, cache_dir=str(tmp_path / "cache"))
+    lats, lons = [LAT, LAT + 0.0004], [LON, LON + 0.0006]
+    mosaic = manager.write_mosaic(str(tmp_path / f"route{suffix}"), lats, lons, buffer_m=15, resolution_m_per_pixel=0.1)
+    try:
+        height, width, bands = mosaic.shape
+        assert bands == 4
+        x0, y0, resolution = mosaic.transform.c, mosaic.transform.f, mosaic.transform.a
+        expected = expected_pixels(x0, y0, resolution, height, width)
+        np.testing.assert_array_equal(np.asarray(mosaic.window(0, 0, height, width))[..., :3], expected)
+
+        # A 5 m x 3 m window 2 m in from the top-left corner
+        window = mosaic.window_bounds(x0 + 2, y0 - 5, x0 + 7, y0 - 2)
+        assert window.shape == (30, 50, 4)
+        np.testing.assert_array_equal(np.asarray(window)[..., :3], expected[20:50, 20:70])
+    finally:
+        mosaic.close()
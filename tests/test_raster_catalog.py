@@ -0,0 +1,102 @@
+import glob
+import os
+
+import numpy as np
+import pyproj
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from benchmarks import synthetic
+from elevation_manager import ElevationManager
+from raster_catalog import RasterCatalog
+
+
+def write_tif(path, data, transform, crs, nodata=-9999):
+    with rasterio.open(path, 'w', driver="GTiff", width=data.shape[1], height=data.shape[0], count=1,
+                       dtype="float32", crs=crs, transform=transform, nodata=nodata) as dataset:
+        dataset.write(data.astype(np.float32), 1)
+
+
+@pytest.fixture
+def dem_dir(tmp_path):
+    # 2x2 synthetic DEM tiles over lon 12.44-12.46, lat 43.04-43.06, plus:
+    #   a_patch.tif, sorted first, overlapping them: 5 m in its north half, nodata in its south half
+    #   utm_patch.tif, in UTM 33N, east of the DEM tiles
+    synthetic.write_dem_tiles(str(tmp_path), 2, 100)
+
+    patch = np.full((40, 40), 5.0)
+    patch[20:] = -9999
+    write_tif(tmp_path / "a_patch.tif", patch, from_origin(12.445, 43.055, 0.0001, 0.0001), "EPSG:4326")
+
+    x0, y0 = pyproj.Transformer.from_crs("EPSG:4326", "EPSG:32633", always_xy=True).transform(12.461, 43.059)
+    ys, xs = np.mgrid[0:50, 0:50]
+    write_tif(tmp_path / "utm_patch.tif", 200 + xs + 0.5 * ys, from_origin(x0, y0, 20, 20), "EPSG:32633")
+    return str(tmp_path)
+
+
+def elevation_one_by_one(raster_dir, lat, lon):
+    # The original per-point scan: every file opened, the first valid value wins
+    for file_path in sorted(glob.glob(os.path.join(raster_dir, "*.tif"))):
+        with rasterio.open(file_path) as dataset:
+            x, y = lon, lat
+            if dataset.crs.to_string() != "EPSG:4326":
+                x, y = pyproj.Transformer.from_crs("EPSG:4326", dataset.crs, always_xy=True).transform(lon, lat)
+            bounds = dataset.bounds
+            if bounds.left <= x <= bounds.right and bounds.bottom <= y <= bounds.top:
+                value = list(dataset.sample([(x, y)]))[0][0]
+                if value == dataset.nodata or value < -1000:
+                    continue
+                return float(value)
+    return np.nan
+
+
+def query_points(n=200, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(43.035, 43.065, n), rng.uniform(12.435, 12.475, n)
+
+
+def test_batch_lookup_equals_the_per_file_scan(dem_dir):
+    lats, lons = query_points()
+    # Plus points in each half of the patch
+    lats = np.concatenate([lats, [43.0535, 43.054, 43.0515, 43.052]])
+    lons = np.concatenate([lons, [12.4465, 12.448, 12.4465, 12.448]])
+    values = RasterCatalog(dem_dir).load().get_elevations(lats, lons)
+    expected = np.array([elevation_one_by_one(dem_dir, lat, lon) for lat, lon in zip(lats, lons)])
+
+    np.testing.assert_allclose(values, expected, rtol=1e-6)
+    # Every case is exercised: the patch, its nodata half falling through, the UTM tile and no data at all
+    assert (values[-4:-2] == 5.0).all() and (values[-2:] != 5.0).all() and np.isfinite(values[-2:]).all()
+    assert (values > 200).any() and np.isnan(values).any()
+
+
+def test_catalog_reused_until_a_file_changes(dem_dir, monkeypatch):
+    RasterCatalog(dem_dir).load()
+    described = []
+    original = RasterCatalog._describe
+    monkeypatch.setattr(RasterCatalog, "_describe", lambda self, path, stat: described.append(path) or original(self, path, stat))
+
+    RasterCatalog(dem_dir).load()
+    assert described == []
+
+    patch = os.path.join(dem_dir, "a_patch.tif")
+    write_tif(patch, np.full((40, 40), 7.0), from_origin(12.445, 43.055, 0.0001, 0.0001), "EPSG:4326")
+    catalog = RasterCatalog(dem_dir).load()
+    assert described == [patch]
+    assert catalog.get_elevations([43.052], [12.447])[0] == 7.0
+
+
+def test_bounded_handle_cache_gives_the_same_values(dem_dir):
+    lats, lons = query_points(seed=1)
+    expected = RasterCatalog(dem_dir).load().get_elevations(lats, lons)
+
+    catalog = RasterCatalog(dem_dir, max_open=1, max_window_pixels=1).load()
+    np.testing.assert_array_equal(catalog.get_elevations(lats, lons), expected)
+    assert len(catalog.handles) == 1
+    catalog.close()
+
+
+def test_elevation_manager_single_point(dem_dir):
+    manager = ElevationManager(elevation_dir=dem_dir)
+    assert manager.get_elevation_tiff(43.054, 12.447) == 5.0
+    assert manager.get_elevation_tiff(43.0, 12.0) is None
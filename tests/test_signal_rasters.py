@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+import shapely
+from shapely.geometry import Polygon
+
+from connectivity_manager import ConnectivityManager
+from signal_rasters import SignalRasterStore
+
+
+@pytest.fixture
+def baked(drive_test_corpus, tmp_path):
+    manager = ConnectivityManager(**drive_test_corpus).load()
+    manager.bake_signal_rasters(str(tmp_path / "rasters"), resolution_m=50, workers=1)
+    return manager
+
+
+def pixel_centres(store, cell_id):
+    # Grid nodes of the cell's raster that fall inside its coverage hull
+    entry = store.index["cells"][str(cell_id)]
+    rows, cols = entry["shape"]
+    lats, lons = np.meshgrid(
+        (entry["row0"] + np.arange(rows)) * store.lat_step,
+        (entry["col0"] + np.arange(cols)) * store.lon_step,
+        indexing='ij'
+    )
+    inside = shapely.intersects_xy(Polygon(entry["coverage"]), lats, lons)
+    return lats[inside], lons[inside]
+
+
+def test_raster_matches_live_kriging_at_pixel_centres(baked):
+    store = SignalRasterStore(baked.signal_rasters.raster_dir).load()
+    assert store.index["cells"]
+    for cell_id in map(int, store.index["cells"]):
+        lats, lons = pixel_centres(store, cell_id)
+        live, _ = baked.signal_model(cell_id).execute('points', lats, lons)
+        # float32 storage
+        np.testing.assert_allclose(store.sample_cell(cell_id, lats, lons), live, atol=1e-3)
+
+
+def test_raster_close_to_live_kriging_between_pixels(baked):
+    store = baked.signal_rasters
+    for cell_id in map(int, store.index["cells"]):
+        lats, lons = pixel_centres(store, cell_id)
+        lats, lons = lats + store.lat_step / 2, lons + store.lon_step / 2
+        sampled = store.sample_cell(cell_id, lats, lons)
+        live, _ = baked.signal_model(cell_id).execute('points', lats, lons)
+        known = ~np.isnan(sampled)
+        assert known.mean() > 0.5
+        # Kriging is exact at the samples, so it can bend sharply between two nodes; compare on average
+        assert np.sqrt(np.mean((sampled[known] - np.asarray(live)[known]) ** 2)) < 1.5
+
+
+def test_band_composite_holds_the_best_cell(baked):
+    store = baked.signal_rasters
+    for band, entry in store.index["bands"].items():
+        cells = [int(cell_id) for cell_id, cell in store.index["cells"].items() if str(cell["band"]) == band]
+        lats, lons = pixel_centres(store, cells[0])
+        best_signal, best_cell = store.sample_band(int(band), lats, lons)
+        per_cell = np.array([store.sample_cell(cell_id, lats, lons) for cell_id in cells])
+        np.testing.assert_allclose(best_signal, np.nanmax(per_cell, axis=0), atol=1e-3)
+        assert set(best_cell.tolist()) <= set(cells)
+
+
+def test_cell_listed_twice_is_baked_once(drive_test_corpus, tmp_path):
+    # The same cells again in a second operator's file, with another band and position
+    tower_file = drive_test_corpus["tower_files"][0]
+    duplicate_file = str(tmp_path / "towers" / "other_operator.clf")
+    with open(tower_file) as f, open(duplicate_file, 'w') as out:
+        for line in f:
+            parts = line.strip().split(';')
+            parts[4] = f"{float(parts[4]) + 0.001:.6f}"
+            parts[7] = "B7 LTE"
+            out.write(";".join(parts) + "\n")
+
+    manager = ConnectivityManager(**{**drive_test_corpus, "tower_files": [tower_file, duplicate_file]}).load()
+    single = ConnectivityManager(**{**drive_test_corpus, "cache_dir": str(tmp_path / "single")}).load()
+    cell_ids = [tower["cell_id"] for tower in manager.towers]
+    assert len(cell_ids) == len(set(cell_ids)) == len(single.towers)
+    assert [tower["band"] for tower in manager.towers] == [tower["band"] for tower in single.towers]
+
+    manager.towers.extend(manager.towers)  # duplicates handed in directly are dropped by bake too
+    store = manager.bake_signal_rasters(str(tmp_path / "rasters"), resolution_m=50, workers=2)
+    assert len(store.index["cells"]) == len(set(cell_ids) & {t["cell_id"] for t in single.towers if len(t["coverage"]) >= 3})
+    for tower in single.towers:
+        if len(tower["coverage"]) >= 3:
+            assert store.index["cells"][str(tower["cell_id"])]["band"] == tower["band"]
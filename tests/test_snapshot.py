@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from benchmarks import synthetic
+from buildings_manager import BuildingsManager
+from connectivity_manager import ConnectivityManager
+from elevation_manager import ElevationManager
+from snapshot import Snapshot, build_snapshot
+
+
+@pytest.fixture
+def live(tmp_path, drive_test_corpus):
+    connectivity = ConnectivityManager(**drive_test_corpus).load()
+    connectivity.bake_signal_rasters(str(tmp_path / "rasters"), resolution_m=100, workers=1)
+
+    synthetic.write_building_tiles(str(tmp_path / "buildings"), 400)
+    buildings = BuildingsManager(tiles_dir=str(tmp_path / "buildings"))
+    dem_bounds = synthetic.write_dem_tiles(str(tmp_path / "elevation"), 2, 100)
+    elevation = ElevationManager(elevation_dir=str(tmp_path / "elevation"))
+
+    path = str(tmp_path / "environment.snap")
+    build_snapshot(path, connectivity=connectivity, buildings=buildings, elevation=elevation,
+                   fit_models=True, embed_dem=True)
+    return path, connectivity, buildings, elevation, dem_bounds
+
+
+def covering(manager, lats, lons):
+    return [
+        [(tower["cell_id"], tower["band"], round(float(signal), 6)) for tower, signal in towers]
+        for towers in manager.get_covering_towers_batch(lats, lons)
+    ]
+
+
+def test_restored_managers_answer_like_the_live_ones(live):
+    path, connectivity, buildings, elevation, dem_bounds = live
+    snapshot = Snapshot(path).load(verify=True)
+    assert sorted(snapshot.layers()) == ["buildings", "connectivity", "elevation"]
+
+    lats, lons = synthetic.random_points((12.425, 43.025, 12.475, 43.075), 300, seed=4)
+    restored = snapshot.connectivity()
+    assert covering(restored, lats, lons) == covering(connectivity, lats, lons)
+    assert restored.models.fitted == 0
+
+    ids, heights = snapshot.buildings().get_height_buildings(lats, lons)
+    live_ids, live_heights = buildings.get_height_buildings(lats, lons)
+    np.testing.assert_array_equal(ids, live_ids)
+    np.testing.assert_array_equal(heights, live_heights)
+    assert (ids != -1).any()
+
+    lats, lons = synthetic.random_points(dem_bounds, 300, seed=5)
+    np.testing.assert_array_equal(snapshot.elevation().get_elevations(lats, lons), elevation.get_elevations(lats, lons))
+
+
+def test_corrupted_array_fails_the_checksum(live):
+    path = live[0]
+    snapshot = Snapshot(path).load()
+    spec = snapshot.header["arrays"]["connectivity/observations"]
+    position = snapshot.data_start + spec["offset"] + spec["nbytes"] // 2
+    del snapshot
+
+    with open(path, 'r+b') as f:
+        f.seek(position)
+        byte = f.read(1)
+        f.seek(position)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+    Snapshot(path).load()  # the header is intact, so only the array checksums catch it
+    with pytest.raises(ValueError, match="integrity check: connectivity/observations"):
+        Snapshot(path).load(verify=True)
+
+
+def test_corrupted_header_fails_on_every_load(live):
+    path = live[0]
+    with open(path, 'r+b') as f:
+        f.seek(64)
+        byte = f.read(1)
+        f.seek(64)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+    with pytest.raises(ValueError, match="header checksum"):
+        Snapshot(path).load()
+
+
+def test_restored_connectivity_is_read_only(live, tmp_path):
+    restored = Snapshot(live[0]).load().connectivity()
+    with pytest.raises(RuntimeError, match="read-only"):
+        restored.refresh()
+    with pytest.raises(RuntimeError, match="read-only"):
+        restored.bake_signal_rasters(str(tmp_path / "rebaked"))
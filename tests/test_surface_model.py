@@ -0,0 +1,80 @@
+import json
+
+import numpy as np
+import pytest
+
+from surface_model import SURFACE_VERSION, SurfaceModel
+
+LAT = 43.05
+LON = 12.45
+SIZE = 16  # 2x2 tiles of 16 px at 2 m: a 64 m square
+RESOLUTION = 2.0
+GROUND = 100.0
+
+
+@pytest.fixture
+def surface(tmp_path):
+    # Flat 100 m surface with a no-data hole of 4x4 px around pixel (20, 20)
+    model = SurfaceModel(str(tmp_path))
+    x0, y0 = model.to_grid.transform(LON, LAT)
+    model.meta = {
+        "version": SURFACE_VERSION,
+        "origin": [x0, y0],
+        "resolution_m": RESOLUTION,
+        "shape": [2 * SIZE, 2 * SIZE],
+        "tile_size": SIZE,
+        "pyramid": []
+    }
+    grid = np.full((2 * SIZE, 2 * SIZE), GROUND, dtype=np.float32)
+    grid[18:22, 18:22] = np.nan
+    tiles = grid.reshape(2, SIZE, 2, SIZE).transpose(0, 2, 1, 3)
+    np.save(tmp_path / "dtm.npy", tiles)
+    np.save(tmp_path / "dsm.npy", tiles)
+    model._build_pyramid(4)
+    with open(tmp_path / "surface.json", "w") as f:
+        json.dump(model.meta, f)
+    return SurfaceModel(str(tmp_path)).load()
+
+
+def at(model, row, col):
+    # lat, lon of a fractional pixel position
+    x0, y0 = model.meta["origin"]
+    lon, lat = model.to_grid.transform(x0 + col * RESOLUTION, y0 - row * RESOLUTION, direction="INVERSE")
+    return lat, lon
+
+
+def segments(model, pixel_pairs, alts0, alts1):
+    starts = np.array([at(model, *start) for start, _ in pixel_pairs])
+    ends = np.array([at(model, *end) for _, end in pixel_pairs])
+    return starts[:, 0], starts[:, 1], np.asarray(alts0, float), ends[:, 0], ends[:, 1], np.asarray(alts1, float)
+
+
+def test_clear_over_known_surface(surface):
+    args = segments(surface, [((4.5, 4.5), (10.5, 28.5))], [150.0], [160.0])
+    assert surface.segments_clear(*args).tolist() == [True]
+    np.testing.assert_allclose(surface.segment_clearance(*args), [50.0], atol=0.1)
+    assert surface.segments_clear(*args, margin_m=60.0).tolist() == [False]
+
+
+def test_no_data_and_grid_edge_are_unknown_not_clear(surface):
+    pairs = [
+        ((4.5, 4.5), (10.5, 28.5)),   # known surface
+        ((20.5, 4.5), (20.5, 28.5)),  # crosses the no-data hole
+        ((10.5, 10.5), (10.5, 40.5)), # leaves the grid
+        ((-8.5, -8.5), (-2.5, -2.5)), # entirely off the grid
+        ((4.5, 4.5), (10.5, 28.5))    # NaN endpoint altitude
+    ]
+    args = segments(surface, pairs, [150.0] * 4 + [np.nan], [150.0] * 5)
+
+    assert surface.segments_clear(*args).tolist() == [True, False, False, False, False]
+    clearance = surface.segment_clearance(*args)
+    assert np.isfinite(clearance[0]) and np.isnan(clearance[1:]).all()
+
+
+def test_line_of_sight_to_tower_off_the_grid_is_not_clear(surface):
+    lat, lon = at(surface, 8.5, 8.5)
+    tower_on, tower_off = at(surface, 28.5, 8.5), at(surface, 60.5, 8.5)
+    visible = surface.line_of_sight(
+        [lat, lat], [lon, lon], [200.0, 200.0], [tower_on[0], tower_off[0]], [tower_on[1], tower_off[1]]
+    )
+    assert visible.tolist() == [True, False]
@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import pytest
+
+from elevation_manager import ElevationManager
+from stub_services import StubWCSServer, synthetic_elevation
+from wcs_tiles import WCSTileCache
+
+LATS = np.array([43.0012, 43.0047])  # both in one 0.01 degree tile
+LONS = np.array([12.5013, 12.5081])
+TILE = (1250, 4300)
+
+
+@pytest.fixture
+def wcs_server():
+    with StubWCSServer() as server:
+        yield server
+
+
+def wcs_cache(server, cache_dir, **kwargs):
+    return WCSTileCache(server.url, "dem", cache_dir=str(cache_dir), res_lat=0.0001, res_lon=0.0001, **kwargs)
+
+
+def test_wcs_memory_and_disk_hits(wcs_server, tmp_path):
+    cache = wcs_cache(wcs_server, tmp_path)
+    values = cache.get_elevations(LATS, LONS)
+    assert len(wcs_server.requests) == 1
+    # Sampled at the nearest pixel centre of a 0.0001 degree grid
+    np.testing.assert_allclose(values, synthetic_elevation(LONS, LATS), atol=2)
+
+    np.testing.assert_array_equal(cache.get_elevations(LATS, LONS), values)
+    assert len(wcs_server.requests) == 1
+
+    fresh = wcs_cache(wcs_server, tmp_path)
+    np.testing.assert_array_equal(fresh.get_elevations(LATS, LONS), values)
+    assert len(wcs_server.requests) == 1
+    assert fresh.requests_sent == 0
+
+
+def test_wcs_eviction_drops_least_recently_used_tile(wcs_server, tmp_path):
+    cache = wcs_cache(wcs_server, tmp_path)
+    cache.get_tiles([TILE])
+    old_path = cache._tile_path(TILE)
+    size = os.path.getsize(old_path)
+    os.utime(old_path, (0, 0))
+
+    cache = wcs_cache(wcs_server, tmp_path, max_cache_bytes=int(size * 1.5))
+    other = (TILE[0] + 1, TILE[1])
+    cache.get_tiles([other])
+    assert not os.path.exists(old_path)
+    assert os.path.exists(cache._tile_path(other))
+    assert len(wcs_server.requests) == 2
+
+    fresh = wcs_cache(wcs_server, tmp_path)
+    fresh.get_tiles([other])
+    assert len(wcs_server.requests) == 2
+    fresh.get_tiles([TILE])
+    assert len(wcs_server.requests) == 3
+
+
+def test_wcs_corrupt_disk_tile_is_fetched_again(wcs_server, tmp_path):
+    values = wcs_cache(wcs_server, tmp_path).get_elevations(LATS, LONS)
+    cache = wcs_cache(wcs_server, tmp_path)
+    with open(cache._tile_path(TILE), 'wb') as f:
+        f.write(b"truncated")
+
+    np.testing.assert_array_equal(cache.get_elevations(LATS, LONS), values)
+    assert len(wcs_server.requests) == 2
+    # The refetched tile replaced the corrupt file
+    assert wcs_cache(wcs_server, tmp_path).get_tiles([TILE])[TILE] is not None
+    assert len(wcs_server.requests) == 2
+
+
+def test_wcs_retries_server_errors(wcs_server, tmp_path):
+    wcs_server.failures = 2
+    values = wcs_cache(wcs_server, tmp_path).get_elevations(LATS, LONS)
+    assert len(wcs_server.requests) == 3
+    np.testing.assert_allclose(values, synthetic_elevation(LONS, LATS), atol=2)
+
+
+def test_route_costs_one_request_per_tile(wcs_server, tmp_path):
+    # 300 waypoints over 0.025 degrees of longitude touch three 0.01 degree tiles
+    lons = np.linspace(12.5005, 12.5255, 300)
+    lats = np.full(len(lons), 43.0045)
+    manager = ElevationManager(elevation_dir=str(tmp_path), service_url=wcs_server.url,
+                               wcs_cache_dir=str(tmp_path / "wcs"))
+
+    values = manager.get_elevations_wcs(lats, lons, delta_lat=0.0001, delta_lon=0.0001)
+    assert len(wcs_server.requests) == 3
+    np.testing.assert_allclose(values, synthetic_elevation(lons, lats), atol=2)
+    assert manager.get_elevation_wcs(lats[10], lons[10], delta_lat=0.0001, delta_lon=0.0001) == values[10]
+    assert len(wcs_server.requests) == 3
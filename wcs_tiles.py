@@ -0,0 +1,189 @@
+import math
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from instrumentation import count, stage
+
+
+def make_session(pool_size=8, retries=3, verify=True):
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.verify = verify
+    return session
+
+
+class WCSTileCache:
+    # Fetches a WCS 1.0.0 coverage on a fixed grid of tile_deg x tile_deg tiles. Tiles are stored as
+    # GeoTIFFs in cache_dir (least recently used evicted past max_cache_bytes), decoded in memory with
+    # MemoryFile and kept decoded in a small LRU. All tiles missing for a batch are fetched concurrently.
+    def __init__(self, service_url, coverage_id, cache_dir="elevation/wcs_cache", res_lat=0.00009,
+                 res_lon=0.00013, tile_deg=0.01, max_cache_bytes=512 * 1024 * 1024, max_workers=8,
+                 max_decoded=64, session=None, timeout=60):
+        self.service_url = service_url
+        self.coverage_id = coverage_id
+        self.res_lat = res_lat
+        self.res_lon = res_lon
+        self.tile_deg = tile_deg
+        self.cache_dir = os.path.join(cache_dir, f"{tile_deg}_{res_lat}_{res_lon}")
+        self.max_cache_bytes = max_cache_bytes
+        self.max_workers = max_workers
+        self.max_decoded = max_decoded
+        self.session = session or make_session(pool_size=max_workers)
+        self.timeout = timeout
+        self.decoded = OrderedDict()
+        self.requests_sent = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def tile_keys(self, lats, lons):
+        return (
+            np.floor(np.asarray(lons, dtype=float) / self.tile_deg).astype(np.int64),
+            np.floor(np.asarray(lats, dtype=float) / self.tile_deg).astype(np.int64)
+        )
+
+    def _tile_path(self, key):
+        return os.path.join(self.cache_dir, f"{key[0]}_{key[1]}.tif")
+
+    def _tile_params(self, key):
+        ix, iy = key
+        bbox = (ix * self.tile_deg, iy * self.tile_deg, (ix + 1) * self.tile_deg, (iy + 1) * self.tile_deg)
+        return {
+            "SERVICE": "WCS",
+            "VERSION": "1.0.0",
+            "REQUEST": "GetCoverage",
+            "COVERAGE": self.coverage_id,
+            "CRS": "EPSG:4326",
+            "BBOX": ",".join(f"{value:.10f}" for value in bbox),
+            "WIDTH": str(math.ceil(self.tile_deg / self.res_lon)),
+            "HEIGHT": str(math.ceil(self.tile_deg / self.res_lat)),
+            "FORMAT": "GeoTIFF"
+        }
+
+    def _fetch(self, key):
+        try:
+            response = self.session.get(self.service_url, params=self._tile_params(key), timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"Error fetching coverage: {e}")
+            return key, None
+        return key, response.content
+
+    def _decode(self, content):
+        from rasterio.io import MemoryFile
+
+        try:
+            with MemoryFile(content) as memfile:
+                with memfile.open() as dataset:
+                    return dataset.read(1), dataset.transform, dataset.nodata
+        except Exception:
+            print("Not a valid GeoTIFF — check request parameters or server response.")
+            return None
+
+    def _store(self, key, content):
+        path = self._tile_path(key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".tif"):
+                path = os.path.join(self.cache_dir, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_cache_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def _remember(self, key, tile):
+        self.decoded[key] = tile
+        if len(self.decoded) > self.max_decoded:
+            self.decoded.popitem(last=False)
+
+    def get_tiles(self, keys):
+        tiles = {}
+        missing = []
+        for key in keys:
+            if key in self.decoded:
+                count("wcs.memory_hits")
+                self.decoded.move_to_end(key)
+                tiles[key] = self.decoded[key]
+                continue
+
+            path = self._tile_path(key)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    tile = self._decode(f.read())
+                if tile is not None:
+                    count("wcs.disk_hits")
+                    os.utime(path)  # mtime doubles as the LRU clock for eviction
+                    tiles[key] = tile
+                    self._remember(key, tile)
+                    continue
+                os.remove(path)  # truncated or corrupt, fetch it again
+
+            missing.append(key)
+
+        if missing:
+            with stage("wcs.fetch"), ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                for key, content in pool.map(self._fetch, missing):
+                    self.requests_sent += 1
+                    count("wcs.requests")
+                    count("wcs.bytes_fetched", len(content) if content is not None else 0)
+                    tile = self._decode(content) if content is not None else None
+                    if tile is not None:
+                        self._store(key, content)
+                        self._remember(key, tile)
+                    tiles[key] = tile
+            self._evict()
+
+        return tiles
+
+    def get_elevations(self, lats, lons):
+        from rasterio.transform import rowcol
+
+        lats = np.atleast_1d(np.asarray(lats, dtype=float))
+        lons = np.atleast_1d(np.asarray(lons, dtype=float))
+        values = np.full(len(lats), np.nan)
+
+        ix, iy = self.tile_keys(lats, lons)
+        pairs = np.column_stack((ix, iy))
+        unique_keys, inverse = np.unique(pairs, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        tiles = self.get_tiles([tuple(key) for key in unique_keys.tolist()])
+
+        for tile_id, key in enumerate(unique_keys.tolist()):
+            tile = tiles.get(tuple(key))
+            if tile is None:
+                continue
+
+            data, transform, nodata = tile
+            selected = np.flatnonzero(inverse == tile_id)
+            rows, cols = rowcol(transform, lons[selected], lats[selected])
+            # Points were assigned to this tile by floor(), so only rounding can push them off its edge
+            rows = np.clip(np.asarray(rows), 0, data.shape[0] - 1)
+            cols = np.clip(np.asarray(cols), 0, data.shape[1] - 1)
+
+            samples = data[rows, cols].astype(float)
+            if nodata is not None:
+                samples[samples == nodata] = np.nan
+            values[selected] = samples
+
+        return values